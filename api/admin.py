@@ -1,9 +1,11 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from .models import User, AOI, GeographicalZone, Country, TreeSpecies, SurveyData, CanopyStatus, CrownDiameter, Metadata, GGZ, Photo
+from .caching import get_user_zone_ids
+from .storage import photo_url
 from django.utils.safestring import mark_safe
 import csv
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 
 # Register your models here.
 admin.site.register(User, UserAdmin)
@@ -15,152 +17,117 @@ from django.db.models.fields.related import ForeignKey
 import json
 import datetime
 
+class Echo:
+    """File-like object returning what is written to it, so csv.writer rows can be streamed."""
+    def write(self, value):
+        return value
+
+
 class ExportStreamMixin:
+    # rows fetched from the database at once, the memory used by an export does not depend on its size
+    export_chunk_size = 2000
+
+    def export_rows(self, queryset):
+        related = [field.name for field in self.model._meta.fields if isinstance(field, ForeignKey)]
+        return queryset.select_related(*related).iterator(chunk_size=self.export_chunk_size)
+
     def export_as_csv(self, request, queryset):
 
         meta = self.model._meta
         field_names = [field.name for field in meta.fields]
 
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename={}.csv'.format(meta)
-        writer = csv.writer(response)
-
-        writer.writerow(field_names)
-        for obj in queryset:
-            row = writer.writerow([getattr(obj, field) for field in field_names])
+        def rows():
+            writer = csv.writer(Echo())
+            yield writer.writerow(field_names)
+            for obj in self.export_rows(queryset):
+                yield writer.writerow([getattr(obj, field) for field in field_names])
 
+        response = StreamingHttpResponse(rows(), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename={}.csv'.format(meta)
         return response
 
-    export_as_csv.short_description = "Export selected as CSV"
+    export_as_csv.short_description = "Export selected data as a CSV file"
 
 
     def export_as_geojson(self, request, queryset):
         meta = self.model._meta
         fields = meta.fields
 
-        features = []
-        for obj in queryset:
-            properties = {}
-            for field in fields:
-                if isinstance(field, ForeignKey):
-                    related_obj = getattr(obj, field.name)
-                    properties[field.name] = str(related_obj)
-                else:
-                    properties[field.name] = getattr(obj, field.name)
-
-            feature = {
-                "type": "Feature",
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": [obj.longitude, obj.latitude]
-                },
-                "properties": properties
-            }
-            features.append(feature)
-
-        geojson = {
-            "type": "FeatureCollection",
-            "features": features,
-            "crs": {
-                "type": "EPSG",
-                "properties": {
-                    "code": 4326
+        def features():
+            yield '{"type": "FeatureCollection", "crs": {"type": "EPSG", "properties": {"code": 4326}}, "features": ['
+            separator = ''
+            for obj in self.export_rows(queryset):
+                properties = {}
+                for field in fields:
+                    if isinstance(field, ForeignKey):
+                        related_obj = getattr(obj, field.name)
+                        properties[field.name] = str(related_obj)
+                    else:
+                        properties[field.name] = getattr(obj, field.name)
+
+                feature = {
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [obj.longitude, obj.latitude]
+                    },
+                    "properties": properties
                 }
-            }
-        }
+                yield separator + self.json_serializable(feature)
+                separator = ','
+            yield ']}'
 
-        response = HttpResponse(content_type='application/json')
+        response = StreamingHttpResponse(features(), content_type='application/json')
         response['Content-Disposition'] = 'attachment; filename={}.geojson'.format(meta)
-        response.write(self.json_serializable(geojson))
         return response
 
-    export_as_geojson.short_description = "Export Selected as GeoJSON"
+    export_as_geojson.short_description = "Export selected data as a GeoJSON file"
 
     def json_serializable(self, obj):
         def converter(o):
             if isinstance(o, datetime.datetime):
                 return o.__str__()
 
-        return json.dumps(obj, default=converter, indent=4)
+        return json.dumps(obj, default=converter)
 
 
-from django.http import FileResponse
-from django.db.models import ForeignKey
-import geopandas as gpd
-from shapely.geometry import Point
-import uuid
-import tempfile
+from django.http import FileResponse, Http404
+from django.urls import path, reverse
+from django.utils.html import format_html
+from .exports import build_geodataframe, queue_export
+from .models import ExportJob, ObservationStats
 import os
-from shapely.wkt import dumps
+
 
 class ExportMixinPandas:
-    EPSG_code = 4326
     def create_geodataframe(self, queryset):
-        data = []
-        fields = self.model._meta.fields
-        exclude_fields = ['creation_date', 'update_date']  # exclude these fields
-        for obj in queryset:
-            row = {}
-            for field in fields:
-                if isinstance(field, ForeignKey):
-                    related_obj = getattr(obj, field.name)
-                    row[field.name] = str(related_obj)
-                elif field.name not in exclude_fields:  # exclude fields here
-                    row[field.name] = getattr(obj, field.name)
-            row['geometry'] = Point(obj.longitude, obj.latitude)
-            data.append(row)
-
-        gdf = gpd.GeoDataFrame(data, geometry='geometry')
-        gdf.set_crs(epsg=self.EPSG_code, inplace=True)
-
-        return gdf
-
-    from shapely.wkt import dumps
-
-    def generate_response(self, gdf, driver, content_type, extension):
-        filename_path = f"/tmp/{uuid.uuid4().hex}.{extension}"
-        try:
-            if extension == "csv":
-                # Convert the geometry column to WKT format with SRID for CSV
-                #epsg_code = self.EPSG_code
-                #gdf['geometry'] = gdf['geometry'].apply(lambda x: f"SRID={epsg_code};{x.wkt}")
-                gdf.to_csv(filename_path, index=False)
-            else:
-                gdf.to_file(filename_path, driver=driver)
-
-            response = FileResponse(open(filename_path, 'rb'), content_type=content_type)
-            response['Content-Disposition'] = f'attachment; filename="surveydata.{extension}"'
-        except Exception as e:
-            print(f"Error occurred: {e}")
-            raise
-        finally:
-            if os.path.exists(filename_path):
-                os.remove(filename_path)
-            elif os.path.isdir(filename_path):
-                shutil.rmtree(filename_path)
-        return response
+        return build_geodataframe(self.model, queryset)
+
+    def queue_export(self, request, queryset, format):
+        # the file is built by the export workers, the request only records what to export:
+        # the filters of the changelist when all its rows are selected, else the selected keys
+        changelist = request.GET.urlencode() if request.POST.get('select_across') == '1' else None
+        job = queue_export(request.user, queryset, format, changelist)
+        url = reverse('admin:api_exportjob_changelist')
+        self.message_user(request, format_html('The export of {} rows has been queued, download it from <a href="{}">Export jobs</a> when it is done.', job.rows, url))
 
     def export_as_csv_pandas(self, request, queryset):
-        gdf = self.create_geodataframe(queryset)
-        return self.generate_response(gdf, "", 'text/csv', 'csv')
+        self.queue_export(request, queryset, 'csv')
 
     export_as_csv_pandas.short_description = "Export selected data as a CSV file"
 
     def export_as_geopackage_pandas(self, request, queryset):
-        gdf = self.create_geodataframe(queryset)
-        return self.generate_response(gdf, "GPKG", 'application/geopackage', 'gpkg')
+        self.queue_export(request, queryset, 'gpkg')
 
     export_as_geopackage_pandas.short_description = "Export selected data as a GeoPackage file"
 
     def export_as_geojson_pandas(self, request, queryset):
-        gdf = self.create_geodataframe(queryset)
-        return self.generate_response(gdf, "GeoJSON", 'application/json', 'geojson')
+        self.queue_export(request, queryset, 'geojson')
 
     export_as_geojson_pandas.short_description = "Export selected data as a GeoJSON file"
 
     def export_as_shapefile_pandas(self, request, queryset):
-        gdf = self.create_geodataframe(queryset)
-        return self.generate_response(gdf, "ESRI Shapefile", 'application/zip', 'zip')
+        self.queue_export(request, queryset, 'shp')
 
     export_as_shapefile_pandas.short_description = "Export selected data as a shapefile"
 
@@ -173,9 +140,10 @@ class PhotoInline(admin.TabularInline):
     fields = ('picture','comment','compass')
 
     def picture(self, obj):
-        return mark_safe('<img src="{base64str}" height="{height}"/>'.format(
-            base64str = obj.image,
-            height=500
+        return mark_safe('<a href="{url}" target="_blank"><img src="{thumbnail}" height="{height}"/></a>'.format(
+            url = photo_url(obj),
+            thumbnail = photo_url(obj, 'thumbnail'),
+            height=200
             )
     )
     """
@@ -193,14 +161,14 @@ class PhotoInline(admin.TabularInline):
 #    extra=0
 
 # @admin.register(SurveyData)
-class SurveyDataAdmin(admin.ModelAdmin, ExportMixinPandas):
+class SurveyDataAdmin(admin.ModelAdmin, ExportStreamMixin, ExportMixinPandas):
     list_display = ('owner','name', 'aoi', 'canopy_status',  'longitude', 'latitude')
     fields = (('owner', 'creation_date','update_date'), 'aoi', ('name', 'comment'), ('canopy_status','tree_species','crown_diameter'), ('longitude', 'latitude'))
     search_fields = ('name', 'aoi__name', 'canopy_status__name', 'tree_species__name')
     readonly_fields = ('owner','creation_date', 'update_date','aoi',)
     list_filter = ('canopy_status','aoi')
     list_per_page = 50
-    actions = ["export_as_geojson_pandas", "export_as_geopackage_pandas", "export_as_csv_pandas"]
+    actions = ["export_as_geojson", "export_as_geopackage_pandas", "export_as_shapefile_pandas", "export_as_csv"]
     inlines = [PhotoInline,]
     save_on_top = True
 
@@ -215,18 +183,84 @@ class SurveyDataAdmin(admin.ModelAdmin, ExportMixinPandas):
             return qs
 
         # Otherwise, filter the queryset based on the user's accessible geographical zones
-        user_gzs = GGZ.objects.filter(group__user=request.user).values_list('geographical_zone', flat=True)
-        return qs.filter(aoi__geographical_zone__in=user_gzs)
+        return qs.filter(aoi__geographical_zone__in=get_user_zone_ids(request.user))
 
 
 class AOIAdmin(admin.ModelAdmin):
-    list_display = ('name', 'geographical_zone')
+    list_display = ('name', 'geographical_zone', 'is_deleted')
+    list_filter = ('is_deleted',)
     fields = ('name', ('x_min', 'x_max'), ('y_max', 'y_min'), 'geographical_zone', 'owner')
     search_fields = ('name', 'geographical_zone__name')
     readonly_fields = ('x_min', 'x_max', 'y_min', 'y_max', 'geographical_zone', 'owner')
     list_per_page = 50
 #    inlines = [SurveyDataInline,]
 
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('creation_date', 'owner', 'format', 'status', 'progress', 'expires_at', 'download')
+    fields = (('owner', 'creation_date', 'expires_at'), ('model', 'format'), ('status', 'progress'), 'error', 'download')
+    readonly_fields = fields[0] + fields[1] + fields[2] + ('error', 'download')
+    list_filter = ('status', 'format')
+    list_per_page = 50
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request).select_related('owner').defer('selection')
+        if request.user.is_superuser:
+            return qs
+        return qs.filter(owner=request.user)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_view_permission(self, request, obj=None):
+        # the staff members see the exports they queued, see get_queryset
+        return request.user.is_active and request.user.is_staff
+
+    def has_module_permission(self, request):
+        return self.has_view_permission(request)
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<uuid:object_id>/download/', self.admin_site.admin_view(self.download_view), name='api_exportjob_download'),
+        ] + super().get_urls()
+
+    def download(self, obj):
+        if obj.status != ExportJob.DONE:
+            return '-'
+        return format_html('<a href="{}">Download</a>', reverse('admin:api_exportjob_download', args=(obj.pk,)))
+
+    def download_view(self, request, object_id):
+        job = self.get_queryset(request).filter(pk=object_id, status=ExportJob.DONE).first()
+        if job is None or not self.has_view_permission(request, job) or not os.path.exists(job.path):
+            raise Http404
+        # FileResponse closes the file once sent, the file itself is kept until purge_exports removes it
+        return FileResponse(open(job.path, 'rb'), as_attachment=True, filename='surveydata.{}'.format(os.path.splitext(job.file)[1][1:]))
+
+class ObservationStatsAdmin(admin.ModelAdmin):
+    list_display = ('geographical_zone', 'aoi', 'canopy_status', 'crown_diameter', 'count')
+    list_filter = ('geographical_zone', 'canopy_status', 'crown_diameter')
+    search_fields = ('aoi__name', 'geographical_zone__name')
+    list_select_related = ('geographical_zone', 'aoi', 'canopy_status', 'crown_diameter')
+    list_per_page = 50
+
+    # maintained from the observations, see api/stats.py
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request).filter(aoi__is_deleted=False)
+        if request.user.is_superuser:
+            return qs
+        return qs.filter(geographical_zone__in=get_user_zone_ids(request.user))
+
 class CrownDiameterAdmin(admin.ModelAdmin):
     list_display = ('name',)
     fields = ('name',)
@@ -253,6 +287,8 @@ admin.site.register(CanopyStatus)
 admin.site.register(CrownDiameter,CrownDiameterAdmin)
 #admin.site.register(Metadata)
 admin.site.register(GGZ)
+admin.site.register(ExportJob, ExportJobAdmin)
+admin.site.register(ObservationStats, ObservationStatsAdmin)
 #admin.site.register(Photo, PhotoAdmin)
 
 
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     name = 'api'
     verbose_name = "Data and configuration"
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,419 @@
+from collections import Counter
+import base64
+import copy
+import io
+import json
+import os
+import random
+import re
+import statistics
+import time
+import types
+import urllib.error
+import urllib.request
+import uuid
+
+from django.conf import settings
+from django.contrib.admin import site
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.db import connection
+from django.http import JsonResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_jwt.settings import api_settings
+
+from . import urls, views
+from .models import User, GeographicalZone, GGZ, AOI, TreeSpecies, CrownDiameter, CanopyStatus, SurveyData, Photo, UploadSession
+from .readers import read_aois, read_observations
+from .serializers import AOIReadSerializer, SurveyDataSerializer
+from .stats import rebuild_stats
+from .storage import store_photo
+from .tiles import tile_at
+
+# Benchmark dataset
+# ------------------------------------------------------------------------------
+# seed_dataset fills the database with synthetic zones, users, AOIs, observations and
+# photos, all named after a prefix so they can be told apart from real data. The rows
+# are inserted with bulk_create, a dataset of a million observations takes minutes.
+
+SEED_BATCH_SIZE = 2000
+
+
+def percentile(values, percent):
+	"""The value below which percent % of the values fall (nearest rank)."""
+	ordered = sorted(values)
+	if not ordered:
+		return None
+	rank = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered))) - 1))
+	return ordered[rank]
+
+
+def _lookups(model, prefix, count):
+	rows = list(model.objects.all()[:count])
+	if not rows:
+		model.objects.bulk_create([model(name='{} {}'.format(prefix, i)) for i in range(count)])
+		rows = list(model.objects.filter(name__startswith=prefix))
+	return rows
+
+
+def seed_dataset(zones=2, users=10, aois_per_user=5, observations_per_aoi=100, photos_per_observation=0,
+		prefix='bench', seed=0, log=None):
+	"""
+		Insert a synthetic dataset: zones shared by one group holding all the users, AOIs spread
+		over the zones and observations spread inside their AOI. Returns the number of rows per model.
+	"""
+	rng = random.Random(seed)
+	log = log or (lambda message: None)
+
+	species = _lookups(TreeSpecies, prefix, 10)
+	crowns = _lookups(CrownDiameter, prefix, 5)
+	canopies = _lookups(CanopyStatus, prefix, 5)
+
+	GeographicalZone.objects.bulk_create([GeographicalZone(name='{} zone {}'.format(prefix, i), wms_url='{}',
+		x_min=-10 + i, x_max=-9 + i, y_min=40, y_max=41) for i in range(zones)])
+	gzs = list(GeographicalZone.objects.filter(name__startswith='{} zone '.format(prefix)))
+	group = Group.objects.create(name='{} group {}'.format(prefix, rng.getrandbits(32)))
+	GGZ.objects.bulk_create([GGZ(group=group, geographical_zone=gz) for gz in gzs])
+	log('{} zones'.format(len(gzs)))
+
+	# the hash is computed once, every synthetic user has the same unusable password
+	password = make_password(None)
+	User.objects.bulk_create([User(username='{}{}'.format(prefix, i), email='{}{}@{}.invalid'.format(prefix, i, group.id),
+		name='{} user {}'.format(prefix, i), password=password) for i in range(users)], batch_size=SEED_BATCH_SIZE)
+	owners = list(User.objects.filter(email__endswith='@{}.invalid'.format(group.id)))
+	User.groups.through.objects.bulk_create([User.groups.through(user_id=user.id, group_id=group.id) for user in owners],
+		batch_size=SEED_BATCH_SIZE)
+	log('{} users'.format(len(owners)))
+
+	aois = []
+	for user in owners:
+		for i in range(aois_per_user):
+			gz = rng.choice(gzs)
+			x, y = rng.uniform(gz.x_min, gz.x_max - 0.01), rng.uniform(gz.y_min, gz.y_max - 0.01)
+			aois.append(AOI(name='{} aoi {}'.format(prefix, i), x_min=x, x_max=x + 0.01, y_min=y, y_max=y + 0.01,
+				owner=user, geographical_zone=gz))
+	AOI.objects.bulk_create(aois, batch_size=SEED_BATCH_SIZE)
+	aois = list(AOI.objects.filter(owner__in=owners))
+	log('{} AOIs'.format(len(aois)))
+
+	count = 0
+	batch = []
+	for aoi in aois:
+		for i in range(observations_per_aoi):
+			batch.append(SurveyData(name='{} obs {}'.format(prefix, i), tree_species=rng.choice(species),
+				crown_diameter=rng.choice(crowns + [None]), canopy_status=rng.choice(canopies), comment='',
+				owner_id=aoi.owner_id, aoi=aoi, longitude=rng.uniform(aoi.x_min, aoi.x_max),
+				latitude=rng.uniform(aoi.y_min, aoi.y_max)))
+			if len(batch) == SEED_BATCH_SIZE:
+				SurveyData.objects.bulk_create(batch)
+				count += len(batch)
+				batch = []
+				log('{} observations'.format(count))
+	SurveyData.objects.bulk_create(batch)
+	count += len(batch)
+	log('{} observations'.format(count))
+
+	photos = 0
+	if photos_per_observation:
+		batch = []
+		observations = SurveyData.objects.filter(owner__in=owners).values_list('id', flat=True)
+		for obsId in observations.iterator(chunk_size=SEED_BATCH_SIZE):
+			for i in range(photos_per_observation):
+				batch.append(Photo(survey_data_id=obsId, compass=rng.uniform(0, 360), comment=''))
+			if len(batch) >= SEED_BATCH_SIZE:
+				Photo.objects.bulk_create(batch)
+				photos += len(batch)
+				batch = []
+		Photo.objects.bulk_create(batch)
+		photos += len(batch)
+		log('{} photos'.format(photos))
+
+	# bulk_create skips the signals maintaining the statistics
+	rebuild_stats()
+	return {'zones': len(gzs), 'users': len(owners), 'aois': len(aois), 'observations': count, 'photos': photos}
+
+
+def hot_requests(user):
+	"""
+		The requests behind the busiest endpoints and admin pages, for the given user, by name.
+		Each one is a function sending the request and returning the response.
+	"""
+	gz = GGZ.objects.filter(group__user=user).values_list('geographical_zone_id', flat=True).first()
+	aoi = AOI.objects.filter(owner_id=user.id).values_list('id', flat=True).first()
+	obs = SurveyData.objects.filter(owner_id=user.id).values_list('id', flat=True).first()
+	client = APIClient()
+	client.force_authenticate(user)
+
+	def admin_search():
+		# an unsaved superuser copy of the user, the changelist reads every observation
+		admin = copy.copy(user)
+		admin.is_staff = admin.is_superuser = True
+		request = RequestFactory().get('/admin/api/surveydata/', {'q': 'obs 1'})
+		request.user = admin
+		return site._registry[SurveyData].changelist_view(request).render()
+
+	return {
+		'zones of the user (gzs/)': lambda: client.get('/api/gzs/'),
+		'AOIs of a zone (gzs/<id>/aois/)': lambda: client.get('/api/gzs/{}/aois/'.format(gz)),
+		'observations of an AOI (aois/<id>/observations/)': lambda: client.get('/api/aois/{}/observations/'.format(aoi)),
+		'observation (observations/<id>/)': lambda: client.get('/api/observations/{}/'.format(obs)),
+		'observations of the user (sync/)': lambda: client.get('/api/sync/'),
+		'admin observation search': admin_search,
+	}
+
+
+def explain(sql):
+	"""EXPLAIN plan of the SQL of a query captured while running a request."""
+	prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+	with connection.cursor() as cursor:
+		cursor.execute(prefix + sql)
+		return '\n'.join(' '.join(str(value) for value in row) for row in cursor.fetchall())
+
+
+def benchmark_queries(user, runs=20):
+	"""
+		Latency percentiles of each of the hot_requests of user, with the SQL the view ran,
+		the time of each statement and its EXPLAIN plan.
+	"""
+	results = []
+	for name, send in hot_requests(user).items():
+		# the first request fills the caches the next ones read, its queries are not the usual ones
+		send()
+		timings = []
+		for i in range(runs):
+			with CaptureQueriesContext(connection) as captured:
+				started = time.perf_counter()
+				response = send()
+				timings.append((time.perf_counter() - started) * 1000)
+		if response.status_code != 200:
+			raise ValueError('{} answered {}'.format(name, response.status_code))
+		statements = [query for query in captured.captured_queries if query['sql'].lstrip().upper().startswith('SELECT')]
+		results.append({
+			'name': name,
+			'queries': len(captured.captured_queries),
+			'p50_ms': round(statistics.median(timings), 3),
+			'p95_ms': round(percentile(timings, 95), 3),
+			'max_ms': round(max(timings), 3),
+			'statements': [{'sql': query['sql'], 'ms': round(float(query['time']) * 1000, 3), 'plan': explain(query['sql'])}
+				for query in statements],
+		})
+	return results
+
+
+def benchmark_serializers(user, runs=5):
+	"""
+		Median time in milliseconds of building the JSON body of the observation listings of user
+		with the DRF serializers and with api/readers.py, queries included, and whether both
+		bodies are identical.
+	"""
+	request = types.SimpleNamespace(user=user)
+	observations = SurveyData.objects.filter(owner_id=user.id).order_by('id')
+	aois = AOI.objects.filter(owner_id=user.id).order_by('id')
+	cases = (
+		('observations', observations.count(),
+			lambda: SurveyDataSerializer(observations.for_read(), context={'request': request}, many=True).data,
+			lambda: read_observations(observations)),
+		('aois', aois.count(),
+			lambda: AOIReadSerializer(aois.with_observations(user), context={'request': request}, many=True).data,
+			lambda: read_aois(aois, user)),
+	)
+
+	results = []
+	for name, rows, serializer, reader in cases:
+		timings, bodies = {}, {}
+		for label, build in (('serializer', serializer), ('reader', reader)):
+			timings[label] = []
+			for i in range(runs):
+				started = time.perf_counter()
+				bodies[label] = JsonResponse(build(), safe=False).content
+				timings[label].append((time.perf_counter() - started) * 1000)
+		serializerMs, readerMs = statistics.median(timings['serializer']), statistics.median(timings['reader'])
+		results.append({
+			'name': name,
+			'rows': rows,
+			'serializer_ms': round(serializerMs, 3),
+			'reader_ms': round(readerMs, 3),
+			'speedup': round(serializerMs / readerMs, 1) if readerMs else None,
+			'bytes': len(bodies['reader']),
+			'identical': bodies['serializer'] == bodies['reader'],
+		})
+	return results
+
+
+# API benchmark
+# ------------------------------------------------------------------------------
+# benchmark_api sends each route of api/urls.py a number of times, either through the
+# Django test client (in the process, with the number of queries of each request) or to
+# a running server, and reports the latency percentiles and the throughput per route.
+# The rows a request consumes (an observation to delete, an upload to complete, ...)
+# are created before each request, outside of the measured time.
+
+def sample_jpeg(size=(64, 48)):
+	"""Bytes of a small JPEG image."""
+	output = io.BytesIO()
+	Image.new('RGB', size, (40, 120, 40)).save(output, 'JPEG')
+	return output.getvalue()
+
+
+def jwt_token(user):
+	"""A JSON web token for user, as returned by /api-token-auth/."""
+	return api_settings.JWT_ENCODE_HANDLER(api_settings.JWT_PAYLOAD_HANDLER(user))
+
+
+class HttpClient:
+	"""Minimal client sending the benchmark requests to a running server, with the test client interface."""
+
+	def __init__(self, base_url, token):
+		self.base_url = base_url.rstrip('/')
+		self.token = token
+
+	def request(self, method, path, data=None, content_type=None, **headers):
+		request = urllib.request.Request(self.base_url + path, data=data, method=method)
+		request.add_header('Authorization', 'JWT ' + self.token)
+		if content_type:
+			request.add_header('Content-Type', content_type)
+		try:
+			with urllib.request.urlopen(request) as response:
+				return types.SimpleNamespace(status_code=response.status, content=response.read())
+		except urllib.error.HTTPError as e:
+			return types.SimpleNamespace(status_code=e.code, content=e.read())
+
+	def get(self, path, **kwargs):
+		return self.request('GET', path, **kwargs)
+
+
+def api_routes(user, gz, aoi, obs):
+	"""
+		The requests of the benchmark, one or more per route of api/urls.py, for the given user
+		and one of its zones, AOIs and observations.
+	"""
+	jpeg = sample_jpeg()
+	dataUri = 'data:image/jpeg;base64,' + base64.b64encode(jpeg).decode('ascii')
+	canopy = obs.canopy_status_id
+	x, y = tile_at(12, obs.longitude, obs.latitude)
+	photos = []
+
+	def photo():
+		if not photos:
+			photos.append(Photo(survey_data=obs))
+			store_photo(photos[0], jpeg, 'jpeg')
+			photos[0].save()
+		return photos[0].id
+
+	def observation(**fields):
+		data = {'name': 'bench', 'canopy_status': canopy, 'longitude': obs.longitude, 'latitude': obs.latitude, 'comment': ''}
+		data.update(fields)
+		return data
+
+	def new_aoi():
+		return AOI.objects.create(name='bench', x_min=aoi.x_min, x_max=aoi.x_max, y_min=aoi.y_min, y_max=aoi.y_max,
+			owner=user, geographical_zone_id=gz).id
+
+	def new_observation():
+		return SurveyData.objects.create(owner=user, aoi=aoi, canopy_status_id=canopy, name='bench',
+			longitude=obs.longitude, latitude=obs.latitude).id
+
+	def new_upload():
+		return UploadSession.objects.create(owner=user, survey_data=obs, ext='jpeg', size=len(jpeg))
+
+	def new_upload_file():
+		session = new_upload()
+		os.makedirs(settings.UPLOAD_TEMP_DIR, exist_ok=True)
+		open(session.path, 'wb').close()
+		return session.id
+
+	def body(data):
+		return {'data': json.dumps(data), 'content_type': 'application/json'}
+
+	return [
+		# method, view, whether the request or its preparation writes, request builder returning the path and the client arguments
+		('GET', views.getGZ, False, lambda: ('/api/gzs/', {})),
+		('GET', views.aoiView, False, lambda: ('/api/gzs/{}/aois/'.format(gz), {})),
+		('GET', views.aoiView, False, lambda: ('/api/gzs/{}/aois/?obs=0'.format(gz), {})),
+		('POST', views.aoiView, True, lambda: ('/api/gzs/{}/aois/'.format(gz), body({'name': 'bench', 'x_min': aoi.x_min,
+			'x_max': aoi.x_max, 'y_min': aoi.y_min, 'y_max': aoi.y_max}))),
+		('GET', views.tileView, False, lambda: ('/api/gzs/{}/tiles/12/{}/{}/'.format(gz, x, y), {})),
+		('GET', views.statsView, False, lambda: ('/api/gzs/{}/stats/'.format(gz), {})),
+		('DELETE', views.deleteAOI, True, lambda: ('/api/aois/{}/'.format(new_aoi()), {})),
+		('GET', views.userView, False, lambda: ('/api/users/', {})),
+		('GET', views.aoiObservationsView, False, lambda: ('/api/aois/{}/observations/'.format(aoi.id), {})),
+		('POST', views.aoiObservationsView, True, lambda: ('/api/aois/{}/observations/'.format(aoi.id), body(observation()))),
+		('GET', views.observationView, False, lambda: ('/api/observations/{}/'.format(obs.id), {})),
+		('PUT', views.observationView, True, lambda: ('/api/observations/{}/'.format(new_observation()), body(observation(name='changed')))),
+		('DELETE', views.observationView, True, lambda: ('/api/observations/{}/'.format(new_observation()), {})),
+		('POST', views.bulkObservationView, True, lambda: ('/api/observations/bulk/', body([observation(aoi=aoi.id,
+			client_id=uuid.uuid4().hex) for i in range(50)]))),
+		('POST', views.addImage, True, lambda: ('/api/images/', body({'survey_data': obs.id, 'image': dataUri}))),
+		('GET', views.photoView, True, lambda: ('/api/images/{}/thumbnail/'.format(photo()), {})),
+		('GET', views.getSpecies, False, lambda: ('/api/species/', {})),
+		('GET', views.getCrowns, False, lambda: ('/api/crowns/', {})),
+		('GET', views.getCanopies, False, lambda: ('/api/canopies/', {})),
+		('GET', views.getReference, False, lambda: ('/api/reference/', {})),
+		('POST', views.fileUploadView, True, lambda: ('/api/upload/', body({'image': dataUri}))),
+		('GET', views.syncView, False, lambda: ('/api/sync/', {})),
+		('POST', views.photoUploadView, True, lambda: ('/api/observations/{}/images/'.format(obs.id), {'data': jpeg, 'content_type': 'image/jpeg'})),
+		('POST', views.uploadSessionView, True, lambda: ('/api/uploads/', body({'survey_data': obs.id, 'size': len(jpeg), 'content_type': 'image/jpeg'}))),
+		('GET', views.uploadChunkView, True, lambda: ('/api/uploads/{}/'.format(new_upload().id), {})),
+		('PUT', views.uploadChunkView, True, lambda: ('/api/uploads/{}/'.format(new_upload_file()), {'data': jpeg,
+			'content_type': 'application/octet-stream', 'HTTP_CONTENT_RANGE': 'bytes 0-{0}/{1}'.format(len(jpeg) - 1, len(jpeg))})),
+	]
+
+
+def route_label(path):
+	"""The path of a request without its ids, /api/aois/12/observations/ gives /api/aois/<id>/observations/."""
+	return re.sub(r'/([0-9]+|[0-9a-f]{32}|[0-9a-f-]{36})(?=/)', '/<id>', path)
+
+
+def missing_routes(routes):
+	"""The patterns of api/urls.py no request of routes goes to."""
+	covered = {view for method, view, writes, request in routes}
+	patterns = {}
+	for pattern in urls.urlpatterns:
+		if pattern.callback not in covered:
+			patterns.setdefault(pattern.callback, str(pattern.pattern))
+	return sorted(patterns.values())
+
+
+def benchmark_api(client, routes, runs, warmup=1, count_queries=True, log=None):
+	"""Latency percentiles, throughput, response statuses and sizes, and queries per request of each route."""
+	log = log or (lambda message: None)
+	results = []
+	for method, view, writes, request in routes:
+		timings, queries, statuses, sizes = [], [], Counter(), []
+		for i in range(warmup + runs):
+			path, kwargs = request()
+			with CaptureQueriesContext(connection) as captured:
+				started = time.perf_counter()
+				response = getattr(client, method.lower())(path, **kwargs)
+				if getattr(response, 'streaming', False):
+					size = len(b''.join(response.streaming_content))
+					response.close()
+				else:
+					size = len(response.content)
+				elapsed = (time.perf_counter() - started) * 1000
+			if i < warmup:
+				continue
+			timings.append(elapsed)
+			queries.append(len(captured))
+			statuses[response.status_code] += 1
+			sizes.append(size)
+
+		result = {
+			'route': '{} {}'.format(method, route_label(path)),
+			'view': view.__name__,
+			'runs': runs,
+			'status': {str(code): count for code, count in statuses.items()},
+			'p50_ms': round(percentile(timings, 50), 3),
+			'p95_ms': round(percentile(timings, 95), 3),
+			'p99_ms': round(percentile(timings, 99), 3),
+			'mean_ms': round(statistics.mean(timings), 3),
+			'throughput_rps': round(len(timings) / sum(timings) * 1000, 1),
+			'queries': max(queries) if count_queries else None,
+			'bytes': round(statistics.mean(sizes)),
+		}
+		log('{route}: p50 {p50_ms} ms, p95 {p95_ms} ms, p99 {p99_ms} ms, {throughput_rps} req/s, {queries} queries, status {status}'.format(**result))
+		results.append(result)
+	return results
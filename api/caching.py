@@ -0,0 +1,112 @@
+import hashlib
+import json
+import uuid
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .models import GGZ, TreeSpecies, CrownDiameter, CanopyStatus
+
+
+def get_version(key, timeout=None):
+	"""Current version stamp stored in the shared cache under key, created on first use."""
+	version = cache.get(key)
+	if version is None:
+		cache.add(key, uuid.uuid4().hex, timeout)
+		version = cache.get(key)
+	return version
+
+
+def bump_version(key, timeout=None):
+	"""Invalidate every cache entry built with the version stored under key."""
+	cache.set(key, uuid.uuid4().hex, timeout)
+
+# Reference data (tree species, crown diameters and canopy statuses)
+# ------------------------------------------------------------------------------
+# The lists change only when edited in the admin. They are serialized once per version
+# and kept both in the process and in the shared cache. Saving or deleting any of those
+# models bumps the version stored in the shared cache, which invalidates every process.
+# The version is bumped once the change is committed: bumped before, a request could
+# cache the list it still reads without the change under the new version, for good.
+
+REFERENCE_LISTS = {
+	'species': (TreeSpecies, 'TreeSpeciesSerializer'),
+	'crowns': (CrownDiameter, 'CrownDiameterSerializer'),
+	'canopies': (CanopyStatus, 'CanopyStatusSerializer'),
+}
+REFERENCE_BUNDLE = 'reference'
+REFERENCE_VERSION_KEY = 'reference:version'
+
+# (version, entries by list name) of this process, replaced when the version changes so
+# the lists of the previous versions don't pile up in the processes that didn't bump it
+_reference_local = (None, {})
+
+
+def _bump_reference_version():
+	global _reference_local
+	bump_version(REFERENCE_VERSION_KEY)
+	_reference_local = (None, {})
+
+
+def invalidate_reference_data():
+	transaction.on_commit(_bump_reference_version)
+
+
+def _reference_payload(name):
+	if name == REFERENCE_BUNDLE:
+		return {kind: _reference_payload(kind) for kind in REFERENCE_LISTS}
+	from . import serializers
+	model, serializer = REFERENCE_LISTS[name]
+	return getattr(serializers, serializer)(model.objects.order_by('id'), many=True).data
+
+
+def get_reference_data(name):
+	"""
+		Return the JSON body and the strong ETag of a reference list
+		('species', 'crowns', 'canopies', or 'reference' for the three of them).
+	"""
+	global _reference_local
+	version = get_version(REFERENCE_VERSION_KEY)
+	localVersion, entries = _reference_local
+	if localVersion != version:
+		entries = {}
+		_reference_local = (version, entries)
+
+	entry = entries.get(name)
+	if entry is None:
+		key = 'reference:{0}:{1}'.format(name, version)
+		entry = cache.get(key)
+		if entry is None:
+			body = json.dumps(_reference_payload(name), cls=DjangoJSONEncoder).encode('utf-8')
+			entry = (body, '"{}"'.format(hashlib.sha1(body).hexdigest()))
+			cache.set(key, entry, None)
+		entries[name] = entry
+	return entry
+
+
+# Geographical zone access
+# ------------------------------------------------------------------------------
+# The zones a user can access come from GGZ through the user groups. The ids are
+# resolved once per request (memoized on the user object) and kept in the shared
+# cache until GGZ rows or group memberships change, once the change is committed.
+
+ZONES_VERSION_KEY = 'zones:version'
+ZONES_TIMEOUT = 3600
+
+
+def invalidate_zone_access():
+	transaction.on_commit(lambda: bump_version(ZONES_VERSION_KEY))
+
+
+def get_user_zone_ids(user):
+	"""Ids of the geographical zones available to the user."""
+	zone_ids = getattr(user, '_zone_ids', None)
+	if zone_ids is None:
+		key = 'zones:{0}:{1}'.format(user.id, get_version(ZONES_VERSION_KEY))
+		zone_ids = cache.get(key)
+		if zone_ids is None:
+			zone_ids = frozenset(GGZ.objects.filter(group__user=user).values_list('geographical_zone_id', flat=True))
+			cache.set(key, zone_ids, ZONES_TIMEOUT)
+		user._zone_ids = zone_ids
+	return zone_ids
@@ -0,0 +1,96 @@
+from django.db.models import QuerySet
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import patch_vary_headers
+
+from .metrics import timed_serialization
+from .models import SurveyData
+from .readers import photo_ids
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+# Compact responses
+# ------------------------------------------------------------------------------
+# The field devices ask for the compact form of the observation listings with
+# ?compact=1 or by accepting application/msgpack. The lookups (species, crown
+# diameter, canopy status) are sent as ids, to be resolved with /api/reference/,
+# and the observations as columns: one array per field, the n-th observation being
+# made of the n-th value of each array. They are read with values() rather than
+# through the serializers. The body is MessagePack when the client accepts it and
+# msgpack is installed, JSON otherwise.
+
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+
+OBSERVATION_COLUMNS = ('key', 'name', 'tree_species', 'crown_diameter', 'canopy_status', 'comment',
+	'longitude', 'latitude', 'version', 'images')
+_OBSERVATION_FIELDS = ('id', 'name', 'tree_species_id', 'crown_diameter_id', 'canopy_status_id', 'comment',
+	'longitude', 'latitude', 'version')
+# the fields to load with only() for compact_observations
+COMPACT_FIELDS = ('id', 'name', 'tree_species', 'crown_diameter', 'canopy_status', 'comment', 'longitude', 'latitude',
+	'version')
+
+
+def accepts_msgpack(request):
+	return msgpack is not None and MSGPACK_CONTENT_TYPE in request.META.get('HTTP_ACCEPT', '')
+
+
+def is_compact(request):
+	"""Whether the request asks for the compact form, with ?compact=1 or Accept: application/msgpack."""
+	return request.GET.get('compact') in ('1', 'true') or accepts_msgpack(request)
+
+
+def compact_response(request, data, status=200):
+	"""data as MessagePack when the client accepts it, as JSON otherwise."""
+	if accepts_msgpack(request):
+		response = HttpResponse(msgpack.packb(data, use_bin_type=True), content_type=MSGPACK_CONTENT_TYPE, status=status)
+	else:
+		response = JsonResponse(data, safe=False, status=status)
+	patch_vary_headers(response, ('Accept',))
+	return response
+
+
+def observation_columns(rows, photos):
+	"""The columns of the observations given as values_list rows of _OBSERVATION_FIELDS."""
+	columns = {name: [] for name in OBSERVATION_COLUMNS}
+	for row in rows:
+		for name, value in zip(OBSERVATION_COLUMNS, row):
+			columns[name].append(value)
+		columns['images'].append(photos.get(row[0], []))
+	return columns
+
+
+@timed_serialization
+def compact_observations(observations):
+	"""
+		The observations in columns, given as a queryset or as SurveyData instances loaded with
+		only(*COMPACT_FIELDS). One query for the photos, plus one for the rows of a queryset.
+	"""
+	if isinstance(observations, QuerySet):
+		rows = list(observations.values_list(*_OBSERVATION_FIELDS))
+	else:
+		rows = [tuple(getattr(obs, field) for field in _OBSERVATION_FIELDS) for obs in observations]
+	return observation_columns(rows, photo_ids([row[0] for row in rows]))
+
+
+@timed_serialization
+def compact_aois(aois, user):
+	"""
+		The AOIs of the queryset aois as AOIReadSerializer, with the observations of user
+		in each one as columns. Three queries whatever the number of AOIs.
+	"""
+	aois = list(aois.order_by('id').values_list('id', 'name', 'x_min', 'x_max', 'y_min', 'y_max'))
+	rows = list(SurveyData.objects.filter(aoi_id__in=[aoi[0] for aoi in aois], owner_id=user.id)
+		.order_by('id').values_list('aoi_id', *_OBSERVATION_FIELDS))
+	photos = photo_ids([row[1] for row in rows])
+
+	byAOI = {}
+	for row in rows:
+		byAOI.setdefault(row[0], []).append(row[1:])
+	return [{
+		'key': aoiId,
+		'name': name,
+		'obs': observation_columns(byAOI.get(aoiId, []), photos),
+		'bbox': [x_min, x_max, y_min, y_max],
+	} for aoiId, name, x_min, x_max, y_min, y_max in aois]
@@ -0,0 +1,58 @@
+import io
+import logging
+import os
+
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from .models import Photo
+from .storage import decode_data_uri
+
+logger = logging.getLogger(__name__)
+
+# longest side, in pixels, of the reduced copies of each photo
+DERIVATIVE_SIZES = {
+	'thumbnail': 200,
+	'medium': 1024,
+}
+DERIVATIVE_QUALITY = 80
+# seconds before a photo served without its copies queues their generation again
+DERIVATIVE_RETRY = 600
+
+
+def open_original(photo):
+	"""File-like object with the original image, from the storage or from the legacy base64 column."""
+	if photo.img:
+		return photo.img.open('rb')
+	content, ext = decode_data_uri(photo.image)
+	return io.BytesIO(content)
+
+
+def generate_derivatives(photo_id):
+	"""
+		Write the JPEG thumbnail and medium copies of a photo next to its original and record them.
+		Returns the updated photo, or None when it does not exist or is not a readable image.
+	"""
+	photo = Photo.objects.filter(id=photo_id).first()
+	if photo is None:
+		return None
+
+	try:
+		with open_original(photo) as original:
+			image = Image.open(original)
+			image = ImageOps.exif_transpose(image).convert('RGB')
+	except (OSError, ValueError):
+		logger.warning('Photo %s is not a readable image, no derivatives generated', photo.id)
+		return None
+
+	base = os.path.splitext(os.path.basename(photo.img.name))[0] if photo.img else 'photo{}'.format(photo.id)
+	for size, pixels in DERIVATIVE_SIZES.items():
+		derivative = image.copy()
+		derivative.thumbnail((pixels, pixels))
+		content = io.BytesIO()
+		derivative.save(content, 'JPEG', quality=DERIVATIVE_QUALITY, optimize=True)
+		getattr(photo, size).save('{0}_{1}.jpg'.format(base, size), ContentFile(content.getvalue()), save=False)
+
+	# only the derivative columns, a concurrent edit of the comment or compass is kept
+	Photo.objects.filter(id=photo.id).update(**{size: getattr(photo, size).name for size in DERIVATIVE_SIZES})
+	return photo
@@ -0,0 +1,188 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib import admin
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import ForeignKey
+from django.test import RequestFactory
+from django.utils import timezone
+import geopandas as gpd
+import pandas as pd
+
+from .models import ExportJob
+from .tasks import setup_process
+
+logger = logging.getLogger(__name__)
+
+EPSG_CODE = 4326
+
+# rows read from the database at once while building an export
+EXPORT_CHUNK_SIZE = 5000
+
+# settings the export processes take from the web worker rather than from the settings
+# module, as they may be changed at run time (the test databases, override_settings)
+WORKER_SETTINGS = ('DATABASES', 'EXPORT_ROOT', 'EXPORT_TTL')
+
+# GDAL driver, file extension and content type of each export format
+FORMATS = {
+	'csv': ('', 'csv', 'text/csv'),
+	'geojson': ('GeoJSON', 'geojson', 'application/json'),
+	'gpkg': ('GPKG', 'gpkg', 'application/geopackage'),
+	'shp': ('ESRI Shapefile', 'zip', 'application/zip'),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def build_geodataframe(model, queryset):
+	"""A GeoDataFrame with a column per field of model, the foreign keys as labels, and a point per row."""
+	exclude_fields = ['creation_date', 'update_date']
+	columns = [field for field in model._meta.fields if isinstance(field, ForeignKey) or field.name not in exclude_fields]
+
+	# one query for the columns, foreign keys as ids
+	rows = queryset.order_by().values_list(*[field.attname for field in columns])
+	df = pd.DataFrame.from_records(list(rows), columns=[field.name for field in columns])
+
+	# then one query per foreign key for the labels of the referenced rows, as str(related_obj)
+	for field in columns:
+		if isinstance(field, ForeignKey):
+			ids = df[field.name].dropna().unique().tolist()
+			labels = {obj.pk: str(obj) for obj in field.related_model.objects.filter(pk__in=ids)}
+			df[field.name] = df[field.name].map(labels).fillna(str(None))
+
+	geometry = gpd.points_from_xy(df['longitude'], df['latitude'])
+	return gpd.GeoDataFrame(df, geometry=geometry, crs='EPSG:{}'.format(EPSG_CODE))
+
+
+def write_geodataframe(gdf, format, path):
+	"""Write gdf to path in the given format, a shapefile is written as a zip of its files."""
+	driver, extension, content_type = FORMATS[format]
+	if format == 'csv':
+		gdf.to_csv(path, index=False)
+	elif format == 'shp':
+		with tempfile.TemporaryDirectory() as directory:
+			gdf.to_file(os.path.join(directory, 'surveydata.shp'), driver=driver)
+			archive = shutil.make_archive(os.path.join(directory, 'surveydata'), 'zip', directory, '.')
+			shutil.move(archive, path)
+	else:
+		gdf.to_file(path, driver=driver)
+
+
+def export_queryset(job):
+	"""
+		The rows to export of job, rebuilt from its selection: the selected keys, or every row
+		of the admin changelist with its filters and search, as its owner sees it.
+	"""
+	model = apps.get_model(job.model)
+	selection = json.loads(job.selection)
+	if 'pks' in selection:
+		return model.objects.filter(pk__in=selection['pks'])
+	request = RequestFactory().get('/?' + selection['changelist'])
+	request.user = job.owner
+	modelAdmin = admin.site._registry[model]
+	return modelAdmin.get_changelist_instance(request).get_queryset(request)
+
+
+def run_export(job_id):
+	"""Build the export of a job and keep it in EXPORT_ROOT, recording its progress on the job."""
+	job = ExportJob.objects.select_related('owner').get(pk=job_id)
+	jobs = ExportJob.objects.filter(pk=job_id)
+	jobs.update(status=ExportJob.RUNNING, progress=0, update_date=timezone.now())
+	try:
+		model = apps.get_model(job.model)
+		queryset = export_queryset(job)
+		frames = []
+		read, lastPk = 0, None
+		while True:
+			# keyset on pk, the rows added or deleted meanwhile don't shift the chunks
+			rows = queryset if lastPk is None else queryset.filter(pk__gt=lastPk)
+			chunk = list(rows.order_by('pk').values_list('pk', flat=True)[:EXPORT_CHUNK_SIZE])
+			if not chunk:
+				break
+			lastPk = chunk[-1]
+			frames.append(build_geodataframe(model, model.objects.filter(pk__in=chunk)))
+			read += len(chunk)
+			# reading the rows is most of the work, writing the file is the last 10%
+			jobs.update(progress=min(90, 90 * read // max(job.rows, 1)), update_date=timezone.now())
+		if frames:
+			gdf = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=frames[0].crs)
+		else:
+			gdf = build_geodataframe(model, model.objects.none())
+
+		os.makedirs(settings.EXPORT_ROOT, exist_ok=True)
+		filename = '{}.{}'.format(job.id.hex, FORMATS[job.format][1])
+		write_geodataframe(gdf, job.format, os.path.join(settings.EXPORT_ROOT, filename))
+	except Exception as e:
+		logger.exception('Export %s failed', job_id)
+		jobs.update(status=ExportJob.FAILED, error=str(e), update_date=timezone.now())
+		return
+
+	now = timezone.now()
+	jobs.update(status=ExportJob.DONE, progress=100, file=filename, update_date=now, expires_at=now + settings.EXPORT_TTL)
+
+
+def get_executor():
+	"""The pool of processes building the exports, created on first use."""
+	global _executor
+	with _executor_lock:
+		if _executor is None:
+			# spawned rather than forked, so the workers don't share the database connections of the web worker
+			_executor = ProcessPoolExecutor(max_workers=settings.EXPORT_WORKERS,
+				mp_context=multiprocessing.get_context('spawn'), initializer=setup_process,
+				initargs=({name: getattr(settings, name) for name in WORKER_SETTINGS},))
+		return _executor
+
+
+def shutdown_executor():
+	"""Stop the export processes, after the exports they are building."""
+	global _executor
+	with _executor_lock:
+		if _executor is not None:
+			_executor.shutdown()
+			_executor = None
+
+
+def submit_export(job):
+	"""Build the export of job in the pool once the current transaction is committed."""
+	if settings.EXPORT_WORKERS:
+		transaction.on_commit(lambda: get_executor().submit(run_export, job.pk))
+	else:
+		transaction.on_commit(lambda: run_export(job.pk))
+
+
+def queue_export(owner, queryset, format, changelist=None):
+	"""
+		Create the job exporting the rows of queryset and queue it. changelist is the query string
+		of the admin changelist when all its rows are exported: its filters are kept rather than
+		the keys of the rows, whatever their number.
+	"""
+	if changelist is None:
+		selection = {'pks': list(queryset.order_by('pk').values_list('pk', flat=True))}
+	else:
+		selection = {'changelist': changelist}
+	job = ExportJob.objects.create(owner=owner, model=queryset.model._meta.label, format=format,
+		selection=json.dumps(selection, cls=DjangoJSONEncoder), rows=queryset.count(),
+		expires_at=timezone.now() + settings.EXPORT_TTL)
+	submit_export(job)
+	return job
+
+
+def fail_stale_exports():
+	"""
+		Mark as failed the jobs pending or running without progress for EXPORT_STALE_AFTER, lost
+		with the export processes of a web worker that was restarted. Returns their number.
+	"""
+	now = timezone.now()
+	return ExportJob.objects.filter(status__in=(ExportJob.PENDING, ExportJob.RUNNING),
+		update_date__lt=now - settings.EXPORT_STALE_AFTER) \
+		.update(status=ExportJob.FAILED, error='Interrupted, export the rows again', update_date=now)
@@ -0,0 +1,28 @@
+import math
+
+
+class InvalidFilter(ValueError):
+	"""Raised when a query parameter filtering a listing cannot be parsed."""
+
+
+def parse_bbox(value):
+	"""Parse `minx,miny,maxx,maxy` (longitudes and latitudes in decimal degrees) into a tuple of floats."""
+	try:
+		bbox = tuple(float(v) for v in value.split(','))
+	except ValueError:
+		raise InvalidFilter(value)
+	if len(bbox) != 4 or not all(math.isfinite(v) for v in bbox):
+		raise InvalidFilter(value)
+	minx, miny, maxx, maxy = bbox
+	# a viewport crossing the antimeridian has to be sent as two boxes
+	if minx > maxx or miny > maxy:
+		raise InvalidFilter(value)
+	return bbox
+
+
+def get_bbox(request):
+	"""Read the `bbox` query parameter, None when it is not given."""
+	value = request.query_params.get('bbox')
+	if value is None:
+		return None
+	return parse_bbox(value)
@@ -0,0 +1,87 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import time
+
+# Structured request logging
+# ------------------------------------------------------------------------------
+# The views log one record per request on the 'api.requests' logger with the key
+# fields passed in `extra={'fields': {...}}`. Records go through QueueHandler, so
+# the request thread only appends to an in-memory queue and a background thread
+# does the formatting and the I/O. See LOGGING in canhemon/settings.py.
+
+request_logger = logging.getLogger('api.requests')
+
+
+class StructuredFormatter(logging.Formatter):
+	"""Formats a record as one JSON object per line, with the `fields` given in extra."""
+
+	def format(self, record):
+		entry = {
+			'time': self.formatTime(record),
+			'level': record.levelname,
+			'logger': record.name,
+			'event': record.getMessage(),
+		}
+		entry.update(getattr(record, 'fields', {}))
+		if record.exc_info:
+			entry['exception'] = self.formatException(record.exc_info)
+		return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+	"""Keeps a `rate` fraction (0 to 1) of the records below WARNING, and every other record."""
+
+	def __init__(self, rate=1.0):
+		super().__init__()
+		self.rate = float(rate)
+
+	def filter(self, record):
+		return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+	"""
+		Hands the records to a background thread writing them with a `target` handler
+		(a logging handler class path, built with `target_kwargs`). When the queue is full
+		records are dropped instead of blocking the request.
+	"""
+
+	def __init__(self, target='logging.StreamHandler', target_kwargs=None, maxsize=10000):
+		super().__init__(queue.Queue(maxsize))
+		module, name = target.rsplit('.', 1)
+		self.target = getattr(__import__(module, fromlist=[name]), name)(**(target_kwargs or {}))
+		self.listener = logging.handlers.QueueListener(self.queue, self.target)
+		self.listener.start()
+		atexit.register(self.listener.stop)
+
+	def setFormatter(self, fmt):
+		# formatting is left to the listener thread
+		self.target.setFormatter(fmt)
+
+	def prepare(self, record):
+		return record
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			pass
+
+
+def log_request(request, event, status, started, **fields):
+	"""Log a request of the api views with its user, status and latency plus the given fields."""
+	level = logging.WARNING if status >= 400 else logging.INFO
+	if not request_logger.isEnabledFor(level):
+		return
+	fields.update({
+		'user_id': request.user.id,
+		'method': request.method,
+		'path': request.path,
+		'status': status,
+		'latency_ms': round((time.monotonic() - started) * 1000, 1),
+	})
+	request_logger.log(level, event, extra={'fields': fields})
@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from api.benchmark import HttpClient, api_routes, benchmark_api, jwt_token, missing_routes, seed_dataset
+from api.models import User, SurveyData
+import json
+import shutil
+import tempfile
+
+# measures the latency, throughput and queries of every API route, to compare releases
+
+class Command(BaseCommand):
+    help = 'Benchmark every route of the API, in the process on a seeded dataset rolled back afterwards, or against a running server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of a running server (e.g. http://localhost:8000), only the read-only routes are sent')
+        parser.add_argument('--user', help='Email of an existing user to benchmark with, nothing is seeded')
+        parser.add_argument('--zones', type=int, default=2)
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--aois-per-user', type=int, default=5)
+        parser.add_argument('--observations-per-aoi', type=int, default=200)
+        parser.add_argument('--runs', type=int, default=50, help='Measured requests per route')
+        parser.add_argument('--warmup', type=int, default=1, help='Requests per route sent before measuring')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['url'] and not kwargs['user']:
+            raise CommandError('--url needs --user, the dataset of a running server is not seeded.')
+
+        log = lambda message: self.stdout.write(message)
+        # the files written by the requests (photos, uploads) go to a temporary directory
+        media_root = tempfile.mkdtemp()
+        try:
+            with override_settings(MEDIA_ROOT=media_root, UPLOAD_TEMP_DIR=media_root + '/tmp'), transaction.atomic():
+                dataset = None
+                if kwargs['user']:
+                    user = User.objects.filter(email=kwargs['user']).first()
+                    if user is None:
+                        raise CommandError(f'No user with email {kwargs["user"]}.')
+                else:
+                    dataset = seed_dataset(zones=kwargs['zones'], users=kwargs['users'], aois_per_user=kwargs['aois_per_user'],
+                        observations_per_aoi=kwargs['observations_per_aoi'], log=lambda message: log(f'Seeded {message}'))
+                    user = User.objects.filter(email__endswith='.invalid').order_by('-id').first()
+
+                obs = SurveyData.objects.filter(owner=user).select_related('aoi').order_by('id').first()
+                if obs is None:
+                    raise CommandError(f'{user.email} has no observation to benchmark with.')
+                routes = api_routes(user, obs.aoi.geographical_zone_id, obs.aoi, obs)
+                token = jwt_token(user)
+
+                if kwargs['url']:
+                    client = HttpClient(kwargs['url'], token)
+                    skipped = [f'{method} {view.__name__}' for method, view, writes, request in routes if writes]
+                    routes = [route for route in routes if not route[2]]
+                else:
+                    client = APIClient()
+                    client.credentials(HTTP_AUTHORIZATION='JWT ' + token)
+                    skipped = []
+
+                results = benchmark_api(client, routes, kwargs['runs'], kwargs['warmup'], count_queries=not kwargs['url'], log=log)
+                # nothing the benchmark wrote is kept
+                transaction.set_rollback(True)
+        finally:
+            shutil.rmtree(media_root)
+
+        missing = missing_routes(routes)
+        for pattern in missing:
+            self.stdout.write(self.style.WARNING(f'Not benchmarked: {pattern}'))
+
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as output:
+                json.dump({
+                    'date': timezone.now().isoformat(),
+                    'target': kwargs['url'] or 'in-process',
+                    'vendor': connection.vendor,
+                    'debug': settings.DEBUG,
+                    'dataset': dataset,
+                    'runs': kwargs['runs'],
+                    'routes': results,
+                    'skipped': skipped,
+                    'not_benchmarked': missing,
+                }, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {kwargs["output"]}.'))
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from api.benchmark import benchmark_queries, seed_dataset
+from api.models import User
+import json
+
+# sends the busiest requests and records their latencies, with the plan of every query the views ran,
+# on a seeded dataset rolled back afterwards
+
+class Command(BaseCommand):
+    help = 'Print the latencies of the busiest endpoints and the EXPLAIN plan of the queries they run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Email of an existing user to benchmark with, nothing is seeded')
+        parser.add_argument('--zones', type=int, default=5)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--aois-per-user', type=int, default=10)
+        parser.add_argument('--observations-per-aoi', type=int, default=200)
+        parser.add_argument('--runs', type=int, default=20, help='Requests sent to each endpoint')
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded dataset instead of rolling it back')
+        parser.add_argument('--output', help='Also write the results as JSON to this file')
+
+    def handle(self, *args, **kwargs):
+        with transaction.atomic():
+            if kwargs['user']:
+                user = User.objects.filter(email=kwargs['user']).first()
+                if user is None:
+                    raise CommandError(f'No user with email {kwargs["user"]}.')
+            else:
+                seed_dataset(zones=kwargs['zones'], users=kwargs['users'], aois_per_user=kwargs['aois_per_user'],
+                    observations_per_aoi=kwargs['observations_per_aoi'], log=lambda message: self.stdout.write(f'Seeded {message}'))
+                user = User.objects.filter(email__endswith='.invalid').order_by('-id').first()
+                if connection.vendor == 'postgresql':
+                    # the planner statistics don't know about the rows just inserted
+                    with connection.cursor() as cursor:
+                        cursor.execute('ANALYZE api_user, api_geographicalzone, api_ggz, api_aoi, api_surveydata, api_photo')
+
+            results = benchmark_queries(user, kwargs['runs'])
+
+            if kwargs['user'] is None and not kwargs['keep']:
+                transaction.set_rollback(True)
+
+        for result in results:
+            self.stdout.write(self.style.SUCCESS(f'{result["name"]}: p50 {result["p50_ms"]} ms, p95 {result["p95_ms"]} ms, max {result["max_ms"]} ms, {result["queries"]} queries'))
+            for statement in result['statements']:
+                self.stdout.write(f'{statement["ms"]} ms: {statement["sql"]}')
+                self.stdout.write(statement['plan'])
+            self.stdout.write('')
+
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as output:
+                json.dump({'vendor': connection.vendor, 'runs': kwargs['runs'], 'queries': results}, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {kwargs["output"]}.'))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from api.benchmark import benchmark_serializers, seed_dataset
+from api.models import User
+import json
+
+# compares the DRF serializers of the observation listings with api/readers.py, on a seeded dataset rolled back afterwards
+
+AOIS = 10
+
+class Command(BaseCommand):
+    help = 'Time the observation listings built by the serializers and by the readers, and check they are identical'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Email of an existing user to benchmark with, nothing is seeded')
+        parser.add_argument('--observations', type=int, default=10000, help='Observations seeded for the benchmark user')
+        parser.add_argument('--runs', type=int, default=5, help='Builds of each listing')
+        parser.add_argument('--output', help='Also write the results as JSON to this file')
+
+    def handle(self, *args, **kwargs):
+        with transaction.atomic():
+            if kwargs['user']:
+                user = User.objects.filter(email=kwargs['user']).first()
+                if user is None:
+                    raise CommandError(f'No user with email {kwargs["user"]}.')
+            else:
+                seed_dataset(zones=1, users=1, aois_per_user=AOIS, observations_per_aoi=max(1, kwargs['observations'] // AOIS),
+                    photos_per_observation=1, log=lambda message: self.stdout.write(f'Seeded {message}'))
+                user = User.objects.filter(email__endswith='.invalid').order_by('-id').first()
+
+            results = benchmark_serializers(user, kwargs['runs'])
+
+            if kwargs['user'] is None:
+                transaction.set_rollback(True)
+
+        for result in results:
+            style = self.style.SUCCESS if result['identical'] else self.style.ERROR
+            self.stdout.write(style(f'{result["name"]} ({result["rows"]} rows, {result["bytes"]} bytes): serializers {result["serializer_ms"]} ms, '
+                f'readers {result["reader_ms"]} ms, x{result["speedup"]}, {"identical" if result["identical"] else "DIFFERENT"} JSON'))
+
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as output:
+                json.dump({'runs': kwargs['runs'], 'listings': results}, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {kwargs["output"]}.'))
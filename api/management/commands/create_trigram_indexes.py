@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+# trigram indexes for the icontains searches of the admin (observation and AOI names), PostgreSQL only
+
+INDEXES = [
+    ('api_surveydata_name_trgm', 'api_surveydata', 'name'),
+    ('api_aoi_name_trgm', 'api_aoi', 'name'),
+    ('api_treespecies_name_trgm', 'api_treespecies', 'name'),
+    ('api_canopystatus_name_trgm', 'api_canopystatus', 'name'),
+]
+
+class Command(BaseCommand):
+    help = 'Create (or drop with --drop) the pg_trgm GIN indexes used by the admin searches, PostgreSQL only'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drop', action='store_true', help='Drop the indexes instead of creating them')
+
+    def handle(self, *args, **kwargs):
+        if connection.vendor != 'postgresql':
+            raise CommandError(f'Trigram indexes need PostgreSQL, the database is {connection.vendor}.')
+
+        # CONCURRENTLY does not lock the tables for writes, it can't run inside a transaction
+        with connection.cursor() as cursor:
+            if not kwargs['drop']:
+                cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for name, table, column in INDEXES:
+                if kwargs['drop']:
+                    cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+                else:
+                    cursor.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING gin ({column} gin_trgm_ops)')
+                self.stdout.write(f'{name} on {table}({column})')
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully {"dropped" if kwargs["drop"] else "created"} {len(INDEXES)} trigram indexes.'))
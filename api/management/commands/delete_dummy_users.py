@@ -1,12 +1,17 @@
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
 from django.db.models import Q
+from api.provisioning import DELETE_BATCH_SIZE, delete_users
 
 User = get_user_model()
 
 class Command(BaseCommand):
     help = 'Delete dummy users created for BTSF training'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive', help='Do not ask for confirmation')
+        parser.add_argument('--batch-size', type=int, default=DELETE_BATCH_SIZE, help='Users deleted per transaction')
+
     def handle(self, *args, **kwargs):
         # Filter users by email domain or username pattern
         users_to_delete = User.objects.filter(
@@ -19,12 +24,14 @@ class Command(BaseCommand):
         if count > 0:
             # Confirm before deletion
             self.stdout.write(f'{count} users found that match the criteria and will be deleted.')
-            confirm = input('Are you sure you want to delete these users? [y/N]: ')
-            
-            if confirm.lower() == 'y':
-                users_to_delete.delete()
-                self.stdout.write(self.style.SUCCESS(f'Successfully deleted {count} users.'))
-            else:
-                self.stdout.write(self.style.WARNING('Deletion cancelled.'))
+            if kwargs['interactive']:
+                confirm = input('Are you sure you want to delete these users? [y/N]: ')
+                if confirm.lower() != 'y':
+                    self.stdout.write(self.style.WARNING('Deletion cancelled.'))
+                    return
+
+            # in batches, each in its own transaction, so the tables are never locked for long
+            deleted = delete_users(users_to_delete, kwargs['batch_size'], log=lambda message: self.stdout.write(message))
+            self.stdout.write(self.style.SUCCESS(f'Successfully deleted {deleted} users.'))
         else:
             self.stdout.write(self.style.WARNING('No matching users found to delete.'))
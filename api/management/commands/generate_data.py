@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api.benchmark import seed_dataset
+
+# fills the database with synthetic data to try the application or benchmark it at scale
+
+class Command(BaseCommand):
+    help = 'Generate synthetic zones, a group, users, AOIs, observations and photos with bulk inserts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--zones', type=int, default=5)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--aois-per-user', type=int, default=10)
+        parser.add_argument('--observations-per-aoi', type=int, default=100)
+        parser.add_argument('--photos-per-observation', type=int, default=0, help='Photo rows, without image file')
+        parser.add_argument('--prefix', default='synthetic', help='Prefix of the names of the generated rows')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random positions and lookups')
+
+    def handle(self, *args, **kwargs):
+        with transaction.atomic():
+            counts = seed_dataset(zones=kwargs['zones'], users=kwargs['users'], aois_per_user=kwargs['aois_per_user'],
+                observations_per_aoi=kwargs['observations_per_aoi'], photos_per_observation=kwargs['photos_per_observation'],
+                prefix=kwargs['prefix'], seed=kwargs['seed'], log=lambda message: self.stdout.write(f'Generated {message}'))
+
+        self.stdout.write(self.style.SUCCESS('Successfully generated ' + ', '.join(f'{count} {name}' for name, count in counts.items()) + '.'))
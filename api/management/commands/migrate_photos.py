@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from api.models import Photo
+from api.storage import decode_data_uri, store_photo
+
+# moves the base64 photos stored in Photo.image to the file storage (Photo.img)
+
+class Command(BaseCommand):
+    help = 'Move the base64 photos stored in the database to the file storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of photos loaded and updated at once')
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs['batch_size']
+        pending = Photo.objects.filter(Q(img='') | Q(img__isnull=True)).exclude(image='')
+
+        self.stdout.write(f'{pending.count()} photos to migrate.')
+        last_id = 0
+        migrated = 0
+        failed = 0
+        while True:
+            # keyset on id, so each batch is an index range scan and only holds batch_size payloads in memory
+            batch = list(pending.filter(id__gt=last_id).order_by('id').only('id', 'image', 'img')[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            updated = []
+            for photo in batch:
+                try:
+                    content, ext = decode_data_uri(photo.image)
+                except ValueError:
+                    failed += 1
+                    self.stdout.write(self.style.WARNING(f'Photo {photo.id} could not be decoded, skipped.'))
+                    continue
+                store_photo(photo, content, ext)
+                updated.append(photo)
+
+            Photo.objects.bulk_update(updated, ['img', 'content_hash', 'image'])
+            migrated += len(updated)
+            self.stdout.write(f'{migrated} photos migrated.')
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully migrated {migrated} photos ({failed} skipped).'))
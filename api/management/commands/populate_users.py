@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from api.models import Country  # Ensure this matches the location of your Country model
+from api.provisioning import provision_users
 
 # file used to create a list of users and passwords (for training purposes)
 
@@ -12,6 +13,7 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('num_users', type=int, help='Number of dummy users to create')
+        parser.add_argument('--workers', type=int, default=None, help='Processes hashing the passwords (default: one per CPU, 0: none)')
 
     def handle(self, *args, **kwargs):
         num_users = kwargs['num_users']
@@ -30,31 +32,22 @@ class Command(BaseCommand):
         else:
             self.stdout.write(self.style.SUCCESS(f'Group "Team" already exists.'))
 
+        rows = []
         for i in range(1, num_users + 1):
-            username = f'user{i}'
-            email = f'user{i}@btsf.eu'
-            name = f'User {i}'
-            occupation = 'Developer'  # Example occupation, adjust as needed
-            language = 'English'  # Example language, adjust as needed
-
-            user, created = User.objects.get_or_create(
-                username=username,
-                defaults={
-                    'email': email,
-                    'name': name,
-                    'password': password,
-                    'occupation': occupation,
-                    'country': default_country,
-                    'language': language,
-                    'is_staff': True,  # Set is_staff within defaults
-                }
-            )
-
-            if created:
-                user.set_password(password)
-                user.save()
-                user.groups.add(team_group)  # Add the user to the 'Team' group
-                self.stdout.write(self.style.SUCCESS(f'Successfully created user {username} with staff access and added to "Team" group.'))
-            else:
-                self.stdout.write(self.style.WARNING(f'User {username} already exists'))
-
+            rows.append({
+                'username': f'user{i}',
+                'email': f'user{i}@btsf.eu',
+                'name': f'User {i}',
+                'password': password,
+                'occupation': 'Developer',  # Example occupation, adjust as needed
+                'language': 'English',  # Example language, adjust as needed
+                'country': default_country.code,
+                'is_staff': True,
+            })
+
+        # passwords hashed in parallel, users and memberships of the 'Team' group inserted in bulk
+        created, skipped = provision_users(rows, [team_group.name], kwargs['workers'], log=lambda message: self.stdout.write(message))
+
+        for email in skipped:
+            self.stdout.write(self.style.WARNING(f'User {email} already exists'))
+        self.stdout.write(self.style.SUCCESS(f'Successfully created {len(created)} users with staff access and added them to "Team" group.'))
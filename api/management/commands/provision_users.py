@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from api.provisioning import CSV_FIELDS, InvalidUserRow, provision_users, read_users_csv
+
+# creates user accounts from a CSV file, e.g. for a training session
+
+class Command(BaseCommand):
+    help = 'Create the users of a CSV file (columns: ' + ', '.join(CSV_FIELDS) + '), skipping the existing emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='CSV file with a header line, email and password are required')
+        parser.add_argument('--group', action='append', default=[], help='Group added to every user, can be repeated')
+        parser.add_argument('--workers', type=int, default=None, help='Processes hashing the passwords (default: one per CPU, 0: none)')
+
+    def handle(self, *args, **kwargs):
+        try:
+            rows = read_users_csv(kwargs['csv_file'])
+        except (OSError, InvalidUserRow) as e:
+            raise CommandError(str(e))
+
+        created, skipped = provision_users(rows, kwargs['group'], kwargs['workers'], log=lambda message: self.stdout.write(message))
+
+        for email in skipped:
+            self.stdout.write(self.style.WARNING(f'User {email} already exists'))
+        self.stdout.write(self.style.SUCCESS(f'Successfully created {len(created)} users, {len(skipped)} already existed.'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from api.purge import purge_deleted_aois, PURGE_BATCH_SIZE, PURGE_PAUSE
+
+# purges the deleted AOIs whose background purge did not run to the end
+
+class Command(BaseCommand):
+    help = 'Delete the soft-deleted AOIs with their observations and photos, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PURGE_BATCH_SIZE, help='Observations deleted per transaction')
+        parser.add_argument('--pause', type=float, default=PURGE_PAUSE, help='Seconds to wait between two batches')
+
+    def handle(self, *args, **kwargs):
+        count = purge_deleted_aois(kwargs['batch_size'], kwargs['pause'], log=self.stdout.write)
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully purged {count} deleted AOIs.'))
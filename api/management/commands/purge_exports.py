@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api.exports import fail_stale_exports
+from api.models import ExportJob
+import os
+
+# removes the admin exports once they have expired, and fails the ones lost by a restart
+
+class Command(BaseCommand):
+    help = 'Delete the admin export jobs and their files once past their expires_at (EXPORT_TTL), fail the stale ones (EXPORT_STALE_AFTER)'
+
+    def handle(self, *args, **kwargs):
+        stale = fail_stale_exports()
+
+        expired = ExportJob.objects.filter(expires_at__lt=timezone.now()).only('id', 'file')
+
+        count = 0
+        for job in expired.iterator():
+            if job.file and os.path.exists(job.path):
+                os.remove(job.path)
+            job.delete()
+            count += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully deleted {count} expired exports, {stale} stale exports failed.'))
@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api.models import Tombstone
+
+# removes the deletion records no client needs anymore, the sync of an older token is a full one
+
+class Command(BaseCommand):
+    help = 'Delete the tombstones older than TOMBSTONE_TTL'
+
+    def handle(self, *args, **kwargs):
+        count, _ = Tombstone.objects.filter(deleted_at__lt=timezone.now() - settings.TOMBSTONE_TTL).delete()
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully deleted {count} tombstones.'))
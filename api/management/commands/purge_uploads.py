@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api.models import UploadSession
+import os
+
+# removes the resumable photo uploads that were never completed
+
+class Command(BaseCommand):
+    help = 'Delete the unfinished resumable photo uploads older than UPLOAD_SESSION_TTL'
+
+    def handle(self, *args, **kwargs):
+        expired = UploadSession.objects.filter(update_date__lt=timezone.now() - settings.UPLOAD_SESSION_TTL)
+
+        count = 0
+        for session in expired.iterator():
+            if os.path.exists(session.path):
+                os.remove(session.path)
+            session.delete()
+            count += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully deleted {count} unfinished uploads.'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from api.stats import rebuild_stats
+
+# recomputes the observation statistics from the observations, they are then kept up to date on save/delete
+
+class Command(BaseCommand):
+    help = 'Rebuild the observation statistics per AOI, canopy status and crown diameter'
+
+    def handle(self, *args, **kwargs):
+        count = rebuild_stats()
+        self.stdout.write(self.style.SUCCESS(f'Successfully rebuilt {count} statistics rows.'))
@@ -0,0 +1,169 @@
+import bisect
+import functools
+import threading
+import time
+
+# Request metrics
+# ------------------------------------------------------------------------------
+# MetricsMiddleware records, for each request of a view of api.views, its wall time,
+# the number and the time of its database queries, the time spent serializing and
+# the size of the response. They are aggregated per view in the process and served
+# in the Prometheus text format by metricsView; each web worker process keeps its
+# own, Prometheus sums them. Requests also get a Server-Timing header with their own
+# figures, shown by the browser developer tools.
+
+# upper bounds of the buckets of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+
+class RequestMetrics:
+	"""The figures of the request being handled by the current thread."""
+
+	def __init__(self):
+		self.started = time.perf_counter()
+		self.queries = 0
+		self.query_time = 0.0
+		self.serializer_time = 0.0
+
+	def record_query(self, execute, sql, params, many, context):
+		"""connection.execute_wrapper counting the queries and their time."""
+		started = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			self.queries += 1
+			self.query_time += time.perf_counter() - started
+
+	@property
+	def elapsed(self):
+		return time.perf_counter() - self.started
+
+	def server_timing(self):
+		"""Value of the Server-Timing header, durations in milliseconds."""
+		return 'app;dur={:.1f}, db;dur={:.1f};desc="{} queries", serializer;dur={:.1f}'.format(
+			self.elapsed * 1000, self.query_time * 1000, self.queries, self.serializer_time * 1000)
+
+
+def current_metrics():
+	"""The RequestMetrics of the request handled by the current thread, None outside of a request."""
+	return getattr(_local, 'metrics', None)
+
+
+def start_request():
+	_local.metrics = RequestMetrics()
+	_local.depth = 0
+	return _local.metrics
+
+
+def end_request():
+	_local.metrics = None
+
+
+def timed_serialization(fn):
+	"""Decorator adding the time spent in fn, less its queries, to the serializer time of the current request."""
+	@functools.wraps(fn)
+	def wrapper(*args, **kwargs):
+		metrics = current_metrics()
+		if metrics is None:
+			return fn(*args, **kwargs)
+		# the serializers nested in this one are part of its time
+		_local.depth += 1
+		started, queryTime = time.perf_counter(), metrics.query_time
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			_local.depth -= 1
+			if _local.depth == 0:
+				metrics.serializer_time += time.perf_counter() - started - (metrics.query_time - queryTime)
+	return wrapper
+
+
+class TimedSerializerMixin:
+	"""Adds the time spent in to_representation to the serializer time of the current request."""
+
+	@timed_serialization
+	def to_representation(self, instance):
+		return super().to_representation(instance)
+
+
+class ViewMetrics:
+	"""The figures of all the requests of a view since the process started."""
+
+	def __init__(self):
+		self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+		self.statuses = {}
+		self.count = 0
+		self.duration = 0.0
+		self.queries = 0
+		self.query_time = 0.0
+		self.serializer_time = 0.0
+		self.response_bytes = 0
+
+
+class Registry:
+	"""The ViewMetrics of each view, keyed by (view, method)."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.views = {}
+
+	def observe(self, view, method, status, metrics, size):
+		duration = metrics.elapsed
+		with self.lock:
+			stats = self.views.get((view, method))
+			if stats is None:
+				stats = self.views[(view, method)] = ViewMetrics()
+			stats.buckets[bisect.bisect_left(DURATION_BUCKETS, duration)] += 1
+			stats.statuses[status] = stats.statuses.get(status, 0) + 1
+			stats.count += 1
+			stats.duration += duration
+			stats.queries += metrics.queries
+			stats.query_time += metrics.query_time
+			stats.serializer_time += metrics.serializer_time
+			stats.response_bytes += size
+
+	def clear(self):
+		with self.lock:
+			self.views = {}
+
+	def render(self):
+		"""The metrics in the Prometheus text exposition format."""
+		with self.lock:
+			views = sorted(self.views.items())
+			lines = [
+				'# HELP api_requests_total Requests handled by the API views.',
+				'# TYPE api_requests_total counter',
+			]
+			for (view, method), stats in views:
+				for status, count in sorted(stats.statuses.items()):
+					lines.append('api_requests_total{{view="{}",method="{}",status="{}"}} {}'.format(view, method, status, count))
+
+			lines += [
+				'# HELP api_request_duration_seconds Wall time of the requests of the API views.',
+				'# TYPE api_request_duration_seconds histogram',
+			]
+			for (view, method), stats in views:
+				labels = 'view="{}",method="{}"'.format(view, method)
+				cumulative = 0
+				for bound, count in zip(DURATION_BUCKETS + ('+Inf',), stats.buckets):
+					cumulative += count
+					lines.append('api_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulative))
+				lines.append('api_request_duration_seconds_sum{{{}}} {:.6f}'.format(labels, stats.duration))
+				lines.append('api_request_duration_seconds_count{{{}}} {}'.format(labels, stats.count))
+
+			for name, attribute, help in (
+					('api_db_queries_total', 'queries', 'Database queries run by the requests of the API views.'),
+					('api_db_query_seconds_total', 'query_time', 'Time spent in the database queries of the API views.'),
+					('api_serializer_seconds_total', 'serializer_time', 'Time spent serializing the responses of the API views.'),
+					('api_response_bytes_total', 'response_bytes', 'Size of the response bodies of the API views.')):
+				lines += ['# HELP {} {}'.format(name, help), '# TYPE {} counter'.format(name)]
+				for (view, method), stats in views:
+					value = getattr(stats, attribute)
+					value = '{:.6f}'.format(value) if isinstance(value, float) else value
+					lines.append('{}{{view="{}",method="{}"}} {}'.format(name, view, method, value))
+		return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
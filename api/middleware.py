@@ -0,0 +1,87 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+from .metrics import end_request, registry, start_request
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# modules whose views are measured by MetricsMiddleware
+MEASURED_MODULES = ('api.views',)
+
+# bodies that are compressed already
+INCOMPRESSIBLE_TYPES = re.compile(r'^(image/|video/|application/(zip|gzip|geopackage))')
+# brotli quality of the responses, fast enough for dynamic content
+BROTLI_QUALITY = 4
+
+
+class MetricsMiddleware:
+	"""
+		Measures the requests of the views of api.views (see api/metrics.py) and adds the
+		Server-Timing header to their responses. Place it first in MIDDLEWARE so the time
+		of the other middlewares and their queries are included.
+	"""
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+
+	def __call__(self, request):
+		request.metrics_view = None
+		metrics = start_request()
+		try:
+			with connection.execute_wrapper(metrics.record_query):
+				response = self.get_response(request)
+		finally:
+			end_request()
+
+		if request.metrics_view is not None:
+			registry.observe(request.metrics_view, request.method, response.status_code, metrics, self.response_size(response))
+			response['Server-Timing'] = metrics.server_timing()
+		return response
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		if view_func.__module__ in MEASURED_MODULES:
+			request.metrics_view = view_func.__name__
+
+	@staticmethod
+	def response_size(response):
+		if response.streaming:
+			# files and photos, their size when known
+			return int(response.get('Content-Length', 0))
+		return len(response.content)
+
+
+class CompressionMiddleware(GZipMiddleware):
+	"""
+		Compresses the response bodies of at least COMPRESSION_MIN_SIZE bytes, with brotli
+		when the client accepts it and the brotli package is installed, with gzip otherwise.
+		Photos and archives are sent as they are.
+	"""
+
+	def process_response(self, request, response):
+		if INCOMPRESSIBLE_TYPES.match(response.get('Content-Type', '')):
+			return response
+		if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+			return response
+		if brotli is None or response.streaming or response.has_header('Content-Encoding') \
+				or 'br' not in re.split(r'\s*[,;]\s*', request.META.get('HTTP_ACCEPT_ENCODING', '')):
+			return super().process_response(request, response)
+
+		patch_vary_headers(response, ('Accept-Encoding',))
+		compressed = brotli.compress(response.content, quality=BROTLI_QUALITY)
+		if len(compressed) >= len(response.content):
+			return response
+		response.content = compressed
+		response['Content-Length'] = str(len(response.content))
+		# as GZipMiddleware, the body is no longer byte for byte the one the ETag was computed on
+		etag = response.get('ETag')
+		if etag and etag.startswith('"'):
+			response['ETag'] = 'W/' + etag
+		response['Content-Encoding'] = 'br'
+		return response
@@ -1,5 +1,9 @@
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser, Group
 from django.db import models
+from django.utils import timezone
+import os
+import uuid
 
 class Country(models.Model):
 	"""This class represents the country model."""
@@ -44,7 +48,8 @@ class User(AbstractUser):
 
 	@property
 	def gz(self):
-		return GeographicalZone.objects.filter(ggz__group__user=self).all()
+		from .caching import get_user_zone_ids
+		return GeographicalZone.objects.filter(id__in=get_user_zone_ids(self))
 
 	USERNAME_FIELD = 'email'
 	EMAIL_FIELD = 'email'
@@ -98,11 +103,39 @@ class GGZ(models.Model):
 	class Meta:
 		verbose_name = "Geographical Zone / User Group"
 		verbose_name_plural = "Geographical Zones / User Groups"
+		indexes = [
+			# zones of the groups of a user, answered from the index alone
+			models.Index(fields=['group', 'geographical_zone']),
+		]
 
 	def __str__(self):
 		"""Return a human readable representation of the model instance."""
 		return "{0}, {1}".format(self.group, self.geographical_zone)
 
+class OwnedQuerySet(models.QuerySet):
+	"""Helpers for the models with an owner."""
+
+	def owned_by(self, user):
+		"""The rows of user. Lookups, updates and deletes through it check the ownership in the same statement."""
+		return self.filter(owner_id=user.id)
+
+class AOIQuerySet(OwnedQuerySet):
+	"""Read helpers for the AOI model."""
+
+	def alive(self):
+		"""The AOIs not deleted. A deleted AOI is left out of every read until api.purge removes it."""
+		return self.filter(is_deleted=False)
+
+	def with_observations(self, user):
+		"""Prefetch the observations of the given user into `user_obs`, ready for AOIReadSerializer."""
+		observations = SurveyData.objects.filter(owner_id=user.id).for_read()
+		return self.prefetch_related(models.Prefetch('surveydata_set', queryset=observations, to_attr='user_obs'))
+
+	def intersecting(self, bbox):
+		"""The AOIs whose extent intersects bbox, a (minx, miny, maxx, maxy) tuple."""
+		minx, miny, maxx, maxy = bbox
+		return self.filter(x_min__lte=maxx, x_max__gte=minx, y_min__lte=maxy, y_max__gte=miny)
+
 class AOI(models.Model):
 	"""This class represents the AOI model."""
 	name = models.CharField(max_length=100, blank=False, unique=False)
@@ -113,11 +146,21 @@ class AOI(models.Model):
 	owner = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
 	geographical_zone = models.ForeignKey(GeographicalZone, on_delete=models.CASCADE)
 	creation_date = models.DateTimeField(auto_now_add=True)
+	update_date = models.DateTimeField(auto_now=True)
 	is_deleted = models.BooleanField(default=False)
 
+	objects = AOIQuerySet.as_manager()
+
 	class Meta:
 		verbose_name = "Area Of Interest (AOI)"
 		verbose_name_plural = "Areas Of Interest (AOI)"
+		indexes = [
+			models.Index(fields=['owner', 'update_date']),
+			models.Index(fields=['geographical_zone', 'owner']),
+			# bounding box intersections, see AOIQuerySet.intersecting
+			models.Index(fields=['x_min', 'y_min']),
+			models.Index(fields=['x_max', 'y_max']),
+		]
 
 	@property
 	def bbox(self):
@@ -170,6 +213,28 @@ class CanopyStatus(models.Model):
 		"""Return a human readable representation of the model instance."""
 		return "{}".format(self.name)
 
+class SurveyDataQuerySet(OwnedQuerySet):
+	"""Read helpers for the survey data model."""
+
+	def alive(self):
+		"""The observations of the AOIs not deleted."""
+		return self.filter(aoi__is_deleted=False)
+
+	def for_read(self):
+		"""Load the lookups and the photo ids needed by SurveyDataSerializer in a fixed number of queries."""
+		photos = Photo.objects.only('id', 'survey_data_id')
+		return self.select_related('tree_species', 'crown_diameter', 'canopy_status') \
+			.prefetch_related(models.Prefetch('photo_set', queryset=photos))
+
+	def bump_version(self):
+		"""Increment the version of the observations, whose photos changed, so the updates from an older version are refused."""
+		return self.update(version=models.F('version') + 1, update_date=timezone.now())
+
+	def in_bbox(self, bbox):
+		"""The observations located inside bbox, a (minx, miny, maxx, maxy) tuple."""
+		minx, miny, maxx, maxy = bbox
+		return self.filter(longitude__range=(minx, maxx), latitude__range=(miny, maxy))
+
 class SurveyData(models.Model):
 	"""This class represents the survey data model."""
 
@@ -184,10 +249,26 @@ class SurveyData(models.Model):
 	latitude = models.FloatField(null=False)
 	creation_date = models.DateTimeField(auto_now_add=True)
 	update_date = models.DateTimeField(auto_now=True)
+	# idempotency key generated by the app, a retried upload never creates the observation twice
+	client_id = models.CharField(max_length=64, blank=True, null=True, unique=False)
+	# incremented by each update through the API, which only applies to the version the client read
+	version = models.PositiveIntegerField(default=1)
+
+	objects = SurveyDataQuerySet.as_manager()
 
 	class Meta:
 		verbose_name = "Observation"
 		verbose_name_plural = "Observations"
+		indexes = [
+			models.Index(fields=['owner', 'update_date']),
+			models.Index(fields=['owner', 'aoi']),
+			# viewport queries, see SurveyDataQuerySet.in_bbox
+			models.Index(fields=['aoi', 'longitude', 'latitude']),
+			models.Index(fields=['longitude', 'latitude']),
+		]
+		constraints = [
+			models.UniqueConstraint(fields=['owner', 'client_id'], name='unique_observation_client_id'),
+		]
 
 	@property
 	def position(self):
@@ -203,8 +284,14 @@ class Photo(models.Model):
 	survey_data =  models.ForeignKey(SurveyData, null=False, on_delete=models.CASCADE)
 	compass = models.FloatField(blank=True, null=True)
 	comment = models.TextField(blank=True, null=True, unique=False)
-	image = models.TextField(blank=False, null=False, unique=False)
+	# base64 data URI of the photos uploaded before they were moved to the file storage (see migrate_photos)
+	image = models.TextField(blank=True, null=False, unique=False)
 	img = models.ImageField("Image file", upload_to='uploads/%Y/%m/%d/',blank=True, null=True, unique=False)	
+	content_hash = models.CharField("SHA-256 of the image file", max_length=64, blank=True, null=False, unique=False)
+	thumbnail = models.ImageField("Thumbnail", upload_to='uploads/%Y/%m/%d/', blank=True, null=True, unique=False)
+	medium = models.ImageField("Medium size copy", upload_to='uploads/%Y/%m/%d/', blank=True, null=True, unique=False)
+	creation_date = models.DateTimeField(auto_now_add=True)
+	update_date = models.DateTimeField(auto_now=True)
 
 	class Meta:
 		verbose_name = "Photo"
@@ -213,3 +300,139 @@ class Photo(models.Model):
 	def __str__(self):
 		"""Return a human readable representation of the model instance."""
 		return "{}".format(self.id)
+
+class UploadSession(models.Model):
+	"""This class represents a resumable photo upload, sent in chunks before it becomes a Photo."""
+
+	id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+	owner = models.ForeignKey(User, on_delete=models.CASCADE)
+	survey_data = models.ForeignKey(SurveyData, on_delete=models.CASCADE)
+	ext = models.CharField(max_length=20, blank=False)
+	size = models.BigIntegerField()
+	received = models.BigIntegerField(default=0)
+	compass = models.FloatField(blank=True, null=True)
+	comment = models.TextField(blank=True, null=True, unique=False)
+	creation_date = models.DateTimeField(auto_now_add=True)
+	update_date = models.DateTimeField(auto_now=True)
+
+	class Meta:
+		verbose_name = "Upload session"
+		verbose_name_plural = "Upload sessions"
+
+	@property
+	def path(self):
+		"""Local file holding the chunks received so far."""
+		return os.path.join(settings.UPLOAD_TEMP_DIR, self.id.hex)
+
+	def __str__(self):
+		"""Return a human readable representation of the model instance."""
+		return "{}".format(self.id)
+
+class Tombstone(models.Model):
+	"""This class records the deletion of a synced row, so clients can drop their copy."""
+
+	AOI = 'aoi'
+	OBSERVATION = 'observation'
+	PHOTO = 'photo'
+	KINDS = (
+		(AOI, 'Area of interest'),
+		(OBSERVATION, 'Observation'),
+		(PHOTO, 'Photo'),
+	)
+
+	kind = models.CharField(max_length=20, choices=KINDS)
+	object_id = models.IntegerField()
+	owner = models.ForeignKey(User, null=True, on_delete=models.CASCADE)
+	deleted_at = models.DateTimeField(auto_now_add=True)
+
+	class Meta:
+		verbose_name = "Tombstone"
+		verbose_name_plural = "Tombstones"
+		indexes = [
+			models.Index(fields=['owner', 'deleted_at']),
+			# for purge_tombstones
+			models.Index(fields=['deleted_at']),
+		]
+
+	def __str__(self):
+		"""Return a human readable representation of the model instance."""
+		return "{0}, {1}".format(self.kind, self.object_id)
+
+class ExportJob(models.Model):
+	"""This class represents an export of observations built in the background, kept on disk until it expires."""
+
+	PENDING = 'pending'
+	RUNNING = 'running'
+	DONE = 'done'
+	FAILED = 'failed'
+	STATUSES = (
+		(PENDING, 'Pending'),
+		(RUNNING, 'Running'),
+		(DONE, 'Done'),
+		(FAILED, 'Failed'),
+	)
+
+	FORMATS = (
+		('csv', 'CSV'),
+		('geojson', 'GeoJSON'),
+		('gpkg', 'GeoPackage'),
+		('shp', 'Shapefile'),
+	)
+
+	id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+	owner = models.ForeignKey(User, on_delete=models.CASCADE)
+	model = models.CharField(max_length=100)
+	format = models.CharField(max_length=20, choices=FORMATS)
+	# the rows to export as JSON, {"pks": [...]} or {"changelist": "<query string of the admin changelist>"},
+	# and their number when queued
+	selection = models.TextField()
+	rows = models.IntegerField(default=0)
+	status = models.CharField(max_length=20, choices=STATUSES, default=PENDING)
+	progress = models.IntegerField(default=0)
+	file = models.CharField(max_length=255, blank=True)
+	error = models.TextField(blank=True)
+	creation_date = models.DateTimeField(auto_now_add=True)
+	update_date = models.DateTimeField(auto_now=True)
+	expires_at = models.DateTimeField()
+
+	class Meta:
+		verbose_name = "Export job"
+		verbose_name_plural = "Export jobs"
+		indexes = [
+			models.Index(fields=['expires_at']),
+			models.Index(fields=['status', 'update_date']),
+		]
+
+	@property
+	def path(self):
+		"""Local file holding the finished export."""
+		return os.path.join(settings.EXPORT_ROOT, self.file)
+
+	def __str__(self):
+		"""Return a human readable representation of the model instance."""
+		return "{}".format(self.id)
+
+class ObservationStats(models.Model):
+	"""This class represents the number of observations of an AOI with a given canopy status and crown diameter."""
+
+	aoi = models.ForeignKey(AOI, on_delete=models.CASCADE)
+	geographical_zone = models.ForeignKey(GeographicalZone, on_delete=models.CASCADE)
+	canopy_status = models.ForeignKey(CanopyStatus, on_delete=models.CASCADE)
+	crown_diameter = models.ForeignKey(CrownDiameter, null=True, on_delete=models.CASCADE)
+	# crown_diameter_id, 0 without crown diameter: NULLs are never equal in a unique index
+	crown_key = models.IntegerField(default=0)
+	count = models.IntegerField(default=0)
+
+	class Meta:
+		verbose_name = "Observation statistics"
+		verbose_name_plural = "Observation statistics"
+		indexes = [
+			models.Index(fields=['geographical_zone', 'aoi']),
+		]
+		# one row per combination, adjust_stats relies on it. A plain unique index, MySQL
+		# has no conditional ones
+		unique_together = (('aoi', 'canopy_status', 'crown_key'),)
+
+	def __str__(self):
+		"""Return a human readable representation of the model instance."""
+		return "{0}, {1}, {2}: {3}".format(self.aoi_id, self.canopy_status_id, self.crown_diameter_id, self.count)
@@ -0,0 +1,64 @@
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+class InvalidCursor(ValueError):
+	"""Raised when a pagination cursor or sync token cannot be decoded."""
+
+
+def encode_cursor(*values):
+	"""Pack the given values into an opaque, url safe string."""
+	raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+	return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+	"""Unpack a string built by encode_cursor into a list of values."""
+	try:
+		raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+		values = json.loads(raw.decode('utf-8'))
+	except (ValueError, TypeError):
+		raise InvalidCursor(cursor)
+	if not isinstance(values, list):
+		raise InvalidCursor(cursor)
+	return values
+
+
+def get_page_size(request):
+	"""Read the `limit` query parameter, bounded by MAX_PAGE_SIZE."""
+	try:
+		limit = int(request.query_params.get('limit', DEFAULT_PAGE_SIZE))
+	except ValueError:
+		raise InvalidCursor('limit')
+	return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def paginate_keyset(queryset, request):
+	"""
+		Return a page of the queryset ordered by (update_date, id) and the cursor of the next page.
+		The cursor holds the position of the last returned row, so pages stay stable
+		while rows are added and the database never has to skip over an offset.
+	"""
+	limit = get_page_size(request)
+	cursor = request.query_params.get('cursor')
+	if cursor:
+		values = decode_cursor(cursor)
+		if len(values) != 2:
+			raise InvalidCursor(cursor)
+		update_date = parse_datetime(values[0] or '')
+		if update_date is None or not isinstance(values[1], int):
+			raise InvalidCursor(cursor)
+		queryset = queryset.filter(Q(update_date__gt=update_date) | Q(update_date=update_date, id__gt=values[1]))
+
+	page = list(queryset.order_by('update_date', 'id')[:limit + 1])
+	if len(page) > limit:
+		page = page[:limit]
+		last = page[-1]
+		return page, encode_cursor(last.update_date.isoformat(), last.id)
+	return page, None
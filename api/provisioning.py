@@ -0,0 +1,125 @@
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import multiprocessing
+import os
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.db import transaction
+
+from .models import User, Country
+from .tasks import setup_process
+
+# User provisioning
+# ------------------------------------------------------------------------------
+# Creating thousands of accounts (training sessions) is dominated by the password
+# hashing, PBKDF2 is CPU bound by design. The passwords are hashed in a pool of
+# processes, then the users and their group memberships are inserted with a few
+# bulk INSERTs in one transaction.
+
+PROVISION_BATCH_SIZE = 1000
+DELETE_BATCH_SIZE = 500
+
+CSV_FIELDS = ('username', 'email', 'name', 'password', 'occupation', 'language', 'country', 'groups', 'is_staff')
+
+
+class InvalidUserRow(ValueError):
+	"""Raised when a row of a provisioning file misses a required value."""
+
+
+def read_users_csv(path):
+	"""
+		The users of a CSV file with a header line. email and password are required, the other
+		columns of CSV_FIELDS are optional. groups holds group names separated by semicolons.
+	"""
+	rows = []
+	with open(path, newline='', encoding='utf-8-sig') as users:
+		for line, row in enumerate(csv.DictReader(users), start=2):
+			row = {key.strip(): (value or '').strip() for key, value in row.items() if key}
+			if not row.get('email') or not row.get('password'):
+				raise InvalidUserRow('Line {}: email and password are required'.format(line))
+			row['groups'] = [name.strip() for name in row.get('groups', '').split(';') if name.strip()]
+			row['is_staff'] = row.get('is_staff', '').lower() in ('1', 'true', 'yes', 'y')
+			rows.append(row)
+	return rows
+
+
+def hash_passwords(passwords, workers=None):
+	"""make_password of each password, computed by a pool of workers processes (all the CPUs when None, in the process when 0)."""
+	if workers == 0 or len(passwords) < 2:
+		return [make_password(password) for password in passwords]
+
+	workers = workers or os.cpu_count()
+	# spawned rather than forked, so the workers don't share the database connections of the command,
+	# with the hashers of this process, which may differ from the settings module (override_settings)
+	with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+			initializer=setup_process, initargs=({'PASSWORD_HASHERS': settings.PASSWORD_HASHERS},)) as executor:
+		return list(executor.map(make_password, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def provision_users(rows, groups=(), workers=None, log=None):
+	"""
+		Create the users of rows (dicts with the CSV_FIELDS keys) that don't exist yet, identified
+		by their email, and add them to their groups and to groups. Returns the created and the
+		skipped emails.
+	"""
+	log = log or (lambda message: None)
+	existing = set(User.objects.filter(email__in=[row['email'] for row in rows]).values_list('email', flat=True))
+	new, skipped = [], []
+	for row in rows:
+		if row['email'] in existing:
+			skipped.append(row['email'])
+		else:
+			existing.add(row['email'])
+			new.append(row)
+
+	log('Hashing {} passwords'.format(len(new)))
+	hashes = hash_passwords([row['password'] for row in new], workers)
+
+	countries = dict(Country.objects.filter(code__in={row.get('country') for row in new if row.get('country')}).values_list('code', 'id'))
+	with transaction.atomic():
+		users = [User(username=row.get('username') or row['email'].split('@')[0], email=row['email'],
+			name=row.get('name') or row.get('username') or row['email'].split('@')[0], password=password,
+			occupation=row.get('occupation', ''), language=row.get('language', ''), country_id=countries.get(row.get('country')),
+			is_staff=row.get('is_staff', False)) for row, password in zip(new, hashes)]
+		# the emails created meanwhile by another session are skipped rather than failing the whole batch
+		User.objects.bulk_create(users, batch_size=PROVISION_BATCH_SIZE, ignore_conflicts=True)
+
+		# bulk_create does not return the ids on every database backend, nor which rows it skipped:
+		# the users created here are the ones with the password hash computed here, salted for each
+		passwords = {user.email: user.password for user in users}
+		ids = {email: userId for email, userId, password in
+			User.objects.filter(email__in=list(passwords)).values_list('email', 'id', 'password') if passwords[email] == password}
+		skipped += [row['email'] for row in new if row['email'] not in ids]
+		new = [row for row in new if row['email'] in ids]
+		log('Created {} users'.format(len(new)))
+
+		names = set(groups) | {name for row in new for name in row.get('groups', [])}
+		groupIds = {name: Group.objects.get_or_create(name=name)[0].id for name in names}
+		memberships = [User.groups.through(user_id=ids[row['email']], group_id=groupIds[name])
+			for row in new for name in set(groups) | set(row.get('groups', []))]
+		User.groups.through.objects.bulk_create(memberships, batch_size=PROVISION_BATCH_SIZE, ignore_conflicts=True)
+		log('Added {} group memberships'.format(len(memberships)))
+
+	return [row['email'] for row in new], skipped
+
+
+def delete_users(queryset, batch_size=DELETE_BATCH_SIZE, log=None):
+	"""
+		Delete the users of queryset batch_size at a time, each batch in its own transaction so
+		the tables are never locked for long. Returns the number of users deleted.
+	"""
+	log = log or (lambda message: None)
+	total = queryset.count()
+	deleted = 0
+	while True:
+		ids = list(queryset.order_by('id').values_list('id', flat=True)[:batch_size])
+		if not ids:
+			break
+		with transaction.atomic():
+			# also deletes their observations, photos and group memberships
+			User.objects.filter(id__in=ids).delete()
+		deleted += len(ids)
+		log('Deleted {} of {} users'.format(deleted, total))
+	return deleted
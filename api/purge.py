@@ -0,0 +1,62 @@
+import logging
+import time
+
+from django.db import transaction
+
+from .models import AOI, SurveyData
+from .signals import purging_aois
+from .tiles import invalidate_tiles
+
+logger = logging.getLogger(__name__)
+
+# Purge of the deleted AOIs
+# ------------------------------------------------------------------------------
+# Deleting an AOI only flags it is_deleted, every read path leaves it out from then
+# on. purge_aoi, run in the background once the flag is committed, then deletes its
+# observations (and their photos, files included) PURGE_BATCH_SIZE at a time, each
+# batch in its own short transaction followed by a PURGE_PAUSE, and the AOI last.
+# An interrupted purge is resumed by `python manage.py purge_deleted_aois`.
+
+PURGE_BATCH_SIZE = 500
+# seconds between two batches, so the purge never holds the database for long
+PURGE_PAUSE = 0.1
+
+
+def purge_aoi(aoiId, batch_size=PURGE_BATCH_SIZE, pause=PURGE_PAUSE):
+	"""Delete the soft-deleted AOI aoiId and what it holds. Returns the number of observations deleted."""
+	if not AOI.objects.filter(id=aoiId, is_deleted=True).exists():
+		return 0
+
+	# the cached tiles still hold its observations, the batches below leave the tiles alone
+	invalidate_tiles(SurveyData.objects.filter(aoi_id=aoiId).values_list('aoi_id', 'longitude', 'latitude').distinct())
+
+	deleted = 0
+	purging_aois().add(aoiId)
+	try:
+		while True:
+			ids = list(SurveyData.objects.filter(aoi_id=aoiId).order_by('id').values_list('id', flat=True)[:batch_size])
+			if not ids:
+				break
+			with transaction.atomic():
+				SurveyData.objects.filter(id__in=ids).delete()
+			deleted += len(ids)
+			if pause:
+				time.sleep(pause)
+
+		# also deletes its statistics
+		with transaction.atomic():
+			AOI.objects.filter(id=aoiId, is_deleted=True).delete()
+	finally:
+		purging_aois().discard(aoiId)
+
+	logger.info('Purged AOI %s and its %s observations', aoiId, deleted)
+	return deleted
+
+
+def purge_deleted_aois(batch_size=PURGE_BATCH_SIZE, pause=PURGE_PAUSE, log=None):
+	"""Purge every soft-deleted AOI. Returns the number of AOIs purged."""
+	log = log or (lambda message: None)
+	aoiIds = list(AOI.objects.filter(is_deleted=True).order_by('id').values_list('id', flat=True))
+	for aoiId in aoiIds:
+		log('AOI {}: {} observations deleted'.format(aoiId, purge_aoi(aoiId, batch_size, pause)))
+	return len(aoiIds)
@@ -0,0 +1,105 @@
+from django.db.models import QuerySet
+
+from .metrics import timed_serialization
+from .models import SurveyData, Photo
+
+# Read paths
+# ------------------------------------------------------------------------------
+# The listings of observations are the bulk of the API traffic. SurveyDataSerializer
+# builds four nested serializers per observation, which costs far more than the
+# queries. The functions below build the same dicts (same keys, same order, same
+# values, so the same JSON) straight from values_list rows, or from instances loaded
+# with SurveyDataQuerySet.for_read. Keep them in step with the serializers; the
+# tests compare both outputs.
+
+# values_list of the observation rows, the lookups with their name
+_OBSERVATION_FIELDS = ('id', 'name', 'tree_species_id', 'tree_species__name', 'crown_diameter_id', 'crown_diameter__name',
+	'canopy_status_id', 'canopy_status__name', 'comment', 'longitude', 'latitude', 'version')
+_LOOKUPS = ('tree_species', 'crown_diameter', 'canopy_status')
+
+
+def photo_ids(observationIds):
+	"""The ids of the photos of each observation, keyed by observation id."""
+	photos = {}
+	rows = Photo.objects.filter(survey_data_id__in=observationIds).order_by('id').values_list('survey_data_id', 'id')
+	for observationId, photoId in rows:
+		photos.setdefault(observationId, []).append(photoId)
+	return photos
+
+
+def _instance_row(obs):
+	row = [obs.id, obs.name]
+	for name in _LOOKUPS:
+		lookup = getattr(obs, name)
+		row += [lookup.id, lookup.name] if lookup is not None else [None, None]
+	return row + [obs.comment, obs.longitude, obs.latitude, obs.version]
+
+
+def _lookup(key, name):
+	# a missing lookup is serialized as the initial data of its serializer
+	return {'key': key, 'name': name} if key is not None else {'key': None, 'name': ''}
+
+
+def _observation(row, images):
+	key, name, ts, tsName, cd, cdName, cs, csName, comment, longitude, latitude, version = row
+	return {
+		'key': key,
+		'name': name,
+		'tree_species': _lookup(ts, tsName),
+		'crown_diameter': _lookup(cd, cdName),
+		'canopy_status': _lookup(cs, csName),
+		'comment': comment,
+		'position': {'latitude': latitude, 'longitude': longitude},
+		'images': [{'key': photoId} for photoId in images],
+		'version': version,
+	}
+
+
+@timed_serialization
+def read_observations(observations, with_aoi=False):
+	"""
+		The observations as SurveyDataSerializer (SyncSurveyDataSerializer with_aoi), given as a
+		queryset, read in two queries, or as instances loaded with for_read.
+	"""
+	if isinstance(observations, QuerySet):
+		fields = _OBSERVATION_FIELDS + ('aoi_id',) if with_aoi else _OBSERVATION_FIELDS
+		rows = list(observations.values_list(*fields))
+		photos = photo_ids([row[0] for row in rows])
+		images = [photos.get(row[0], []) for row in rows]
+	else:
+		rows = [_instance_row(obs) + ([obs.aoi_id] if with_aoi else []) for obs in observations]
+		images = [[photo.id for photo in obs.photo_set.all()] for obs in observations]
+
+	results = []
+	for row, photos in zip(rows, images):
+		obs = _observation(row[:len(_OBSERVATION_FIELDS)], photos)
+		if with_aoi:
+			obs['aoi'] = row[-1]
+		results.append(obs)
+	return results
+
+
+@timed_serialization
+def read_aois(aois, user):
+	"""The AOIs of the queryset aois with the observations of user, as AOIReadSerializer, in three queries."""
+	aois = list(aois.values_list('id', 'name', 'x_min', 'x_max', 'y_min', 'y_max'))
+	rows = list(SurveyData.objects.filter(owner_id=user.id).filter(aoi_id__in=[aoi[0] for aoi in aois])
+		.values_list('aoi_id', *_OBSERVATION_FIELDS))
+	photos = photo_ids([row[1] for row in rows])
+
+	byAOI = {}
+	for row in rows:
+		byAOI.setdefault(row[0], []).append(_observation(row[1:], photos.get(row[1], [])))
+	return [{
+		'key': aoiId,
+		'name': name,
+		'obs': byAOI.get(aoiId, []),
+		'bbox': [x_min, x_max, y_min, y_max],
+	} for aoiId, name, x_min, x_max, y_min, y_max in aois]
+
+
+def read_country(country):
+	"""The country as CountrySerializer."""
+	if country is None:
+		return {'key': None, 'code': '', 'name': ''}
+	return {'key': country.id, 'code': country.code, 'name': country.name}
@@ -1,9 +1,22 @@
 from rest_framework import serializers
 from rest_framework.fields import CurrentUserDefault
 from django.contrib.auth import get_user, get_user_model
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 from .models import *
+from .caching import get_user_zone_ids
+from .storage import decode_data_uri, image_extension, store_photo
+from .metrics import TimedSerializerMixin
+from .readers import read_country
+from .signals import observation_changed, observation_state
 
-class CountrySerializer(serializers.ModelSerializer):
+
+class ModelSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+	"""ModelSerializer whose serialization time is counted in the request metrics."""
+
+
+class CountrySerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 
 	key = serializers.IntegerField(source='id')
@@ -14,7 +27,7 @@ class CountrySerializer(serializers.ModelSerializer):
 		fields = ('key', 'code', 'name')
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 
 	key = serializers.IntegerField(source='id')
@@ -23,8 +36,7 @@ class UserSerializer(serializers.ModelSerializer):
 	def get_country(self, instance):
 		request = self.context.get('request')
 		user = request.user
-		serialized = CountrySerializer(user.country, context={'request': request})
-		return serialized.data
+		return read_country(user.country)
 
 	class Meta:
 		"""Meta class to map serializer's fields with the model fields."""
@@ -32,7 +44,7 @@ class UserSerializer(serializers.ModelSerializer):
 		fields = ('key' ,'name', 'username', 'email', 'occupation', 'country',
 			'language')
 
-class GeographicalZoneSerializer(serializers.ModelSerializer):
+class GeographicalZoneSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 
 	key = serializers.IntegerField(source='id')
@@ -41,14 +53,14 @@ class GeographicalZoneSerializer(serializers.ModelSerializer):
 	def get_is_enabled(self, instance):
 		request = self.context.get('request')
 		user = request.user
-		return instance in user.gz
+		return instance.id in get_user_zone_ids(user)
 
 	class Meta:
 		"""Meta class to map serializer's fields with the model fields."""
 		model = GeographicalZone
 		fields = ('key', 'name', 'wms_url', 'features', 'bbox', 'is_enabled')
 
-class GGZSerializer(serializers.ModelSerializer):
+class GGZSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 
 	class Meta:
@@ -56,7 +68,7 @@ class GGZSerializer(serializers.ModelSerializer):
 		model = GGZ
 		fields = ('group_id', 'geographical_zone_id')
 
-class AOIReadSerializer(serializers.ModelSerializer):
+class AOIReadSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 	key = serializers.IntegerField(source='id')
 	obs = serializers.SerializerMethodField()
@@ -65,7 +77,11 @@ class AOIReadSerializer(serializers.ModelSerializer):
 	def get_obs(self, instance):
 		request = self.context.get('request')
 		ruser = request.user
-		objs = SurveyData.objects.filter(owner_id=ruser.id).filter(aoi=instance)
+		if hasattr(instance, 'user_obs'):
+			# prefetched by AOIQuerySet.with_observations
+			objs = instance.user_obs
+		else:
+			objs = SurveyData.objects.filter(owner_id=ruser.id).filter(aoi=instance).for_read()
 		serialized = SurveyDataSerializer(objs, context={'request': request}, many=True)
 		return serialized.data
 
@@ -77,7 +93,20 @@ class AOIReadSerializer(serializers.ModelSerializer):
 		model = AOI
 		fields = ('key', 'name', 'obs', 'bbox')
 
-class AOIWriteSerializer(serializers.ModelSerializer):
+class AOISummarySerializer(ModelSerializer):
+	"""Serializer to map the Model instance into JSON format, without the embedded observations."""
+	key = serializers.IntegerField(source='id')
+	bbox = serializers.SerializerMethodField()
+
+	def get_bbox(self, instance):
+		return instance.bbox
+
+	class Meta:
+		"""Meta class to map serializer's fields with the model fields."""
+		model = AOI
+		fields = ('key', 'name', 'bbox')
+
+class AOIWriteSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 
 	def create(self, validated_data):
@@ -89,7 +118,7 @@ class AOIWriteSerializer(serializers.ModelSerializer):
 		model = AOI
 		fields = ('name', 'x_min', 'x_max', 'y_min', 'y_max', 'geographical_zone', 'owner')
 
-class TreeSpeciesSerializer(serializers.ModelSerializer):
+class TreeSpeciesSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 	key = serializers.IntegerField(source='id')
 
@@ -99,7 +128,7 @@ class TreeSpeciesSerializer(serializers.ModelSerializer):
 		fields = ('key' ,'name', )
 
 
-class TreeSpeciesWriteSerializer(serializers.ModelSerializer):
+class TreeSpeciesWriteSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 
 	def create(self, validated_data):
@@ -111,7 +140,7 @@ class TreeSpeciesWriteSerializer(serializers.ModelSerializer):
 		fields = ('name', )
 
 
-class CrownDiameterSerializer(serializers.ModelSerializer):
+class CrownDiameterSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 	key = serializers.IntegerField(source='id')
 
@@ -121,7 +150,7 @@ class CrownDiameterSerializer(serializers.ModelSerializer):
 		fields = ('key', 'name', )
 
 
-class CanopyStatusSerializer(serializers.ModelSerializer):
+class CanopyStatusSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 	key = serializers.IntegerField(source='id')
 
@@ -131,7 +160,7 @@ class CanopyStatusSerializer(serializers.ModelSerializer):
 		fields = ('key', 'name', )
 
 
-class SurveyDataSerializer(serializers.ModelSerializer):
+class SurveyDataSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 	key = serializers.IntegerField(source='id')
 	tree_species = serializers.SerializerMethodField()
@@ -163,10 +192,17 @@ class SurveyDataSerializer(serializers.ModelSerializer):
 		"""Meta class to map serializer's fields with the model fields."""
 		model = SurveyData
 		fields = ('key', 'name', 'tree_species', 'crown_diameter', 'canopy_status',
-			'comment', 'position', 'images')
+			'comment', 'position', 'images', 'version')
 		read_only_fields = ('creation_date', 'update_date')
 
-class SurveyDataWriteSerializer(serializers.ModelSerializer):
+class VersionConflict(Exception):
+	"""Raised when an observation is updated from another version than its current one."""
+
+
+# fields of an observation set by SurveyDataWriteSerializer.update
+UPDATE_FIELDS = ('name', 'tree_species', 'crown_diameter', 'canopy_status', 'comment', 'longitude', 'latitude')
+
+class SurveyDataWriteSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 
 	def create(self, validated_data):
@@ -174,33 +210,89 @@ class SurveyDataWriteSerializer(serializers.ModelSerializer):
 		return SurveyData.objects.create(**validated_data)
 
 	def update(self, instance, validated_data):
-		instance.name = validated_data.get('name', instance.name)
-		instance.tree_species = validated_data.get('tree_species', instance.tree_species)
-		instance.crown_diameter = validated_data.get('crown_diameter', instance.crown_diameter)
-		instance.canopy_status = validated_data.get('canopy_status', instance.canopy_status)
-		instance.comment = validated_data.get('comment', instance.comment)
-		instance.longitude = validated_data.get('longitude', instance.longitude)
-		instance.latitude = validated_data.get('latitude', instance.latitude)
-
-		inputImages = self.context.get('imagesToKeep')
-		if inputImages:
-
-			currentImages = Photo.objects.filter(survey_data_id=instance.id).values_list('id', flat=True)
-
-			imagesToDelete = set(currentImages) - set(inputImages)
-			Photo.objects.filter(id__in=imagesToDelete).filter(survey_data_id=instance.id).delete()
-
-		instance.save()
+		"""
+			Apply the changes in one UPDATE conditioned on the version the client read (the
+			`version` of the context, the one of instance when None) and prune the photos in the
+			same transaction. Raises VersionConflict when the observation has changed meanwhile.
+		"""
+		version = self.context.get('version')
+		if version is not None and version != instance.version:
+			raise VersionConflict(instance.id)
+
+		old = observation_state(instance)
+		for field in UPDATE_FIELDS:
+			setattr(instance, field, validated_data.get(field, getattr(instance, field)))
+		instance.update_date = timezone.now()
+
+		with transaction.atomic():
+			# .update() sends no signal, the tiles and statistics are maintained below
+			updated = SurveyData.objects.filter(id=instance.id, version=instance.version) \
+				.update(version=F('version') + 1, update_date=instance.update_date,
+					**{field: getattr(instance, field) for field in UPDATE_FIELDS})
+			if not updated:
+				raise VersionConflict(instance.id)
+			instance.version += 1
+
+			inputImages = self.context.get('imagesToKeep')
+			if inputImages:
+				Photo.objects.filter(survey_data_id=instance.id).exclude(id__in=inputImages).delete()
+
+			instance._loaded_state = observation_state(instance)
+			observation_changed(old, instance._loaded_state)
 		return instance
 
 	class Meta:
 		"""Meta class to map serializer's fields with the model fields."""
 		model = SurveyData
 		fields = ('name', 'tree_species', 'crown_diameter', 'canopy_status',
-			'comment', 'aoi', 'longitude', 'latitude')
+			'comment', 'aoi', 'longitude', 'latitude', 'version')
+		read_only_fields = ('version', )
+
+
+class BulkPhotoSerializer(serializers.Serializer):
+	"""Serializer to validate the photos sent along with an observation to the bulk endpoint."""
+	image = serializers.CharField()
+	compass = serializers.FloatField(required=False, allow_null=True)
+	comment = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+
+	def validate_image(self, value):
+		try:
+			return decode_data_uri(value)
+		except ValueError as e:
+			raise serializers.ValidationError(str(e))
+
+class SurveyDataBulkSerializer(ModelSerializer):
+	"""
+		Serializer to validate an observation sent to the bulk endpoint.
+		The lookups are checked against the id sets given in the `lookups` context
+		instead of one query per related field and observation.
+	"""
+	client_id = serializers.CharField(max_length=64)
+	aoi = serializers.IntegerField(source='aoi_id')
+	tree_species = serializers.IntegerField(source='tree_species_id', required=False, allow_null=True)
+	crown_diameter = serializers.IntegerField(source='crown_diameter_id', required=False, allow_null=True)
+	canopy_status = serializers.IntegerField(source='canopy_status_id')
+	images = BulkPhotoSerializer(many=True, required=False)
+
+	def validate(self, data):
+		lookups = self.context.get('lookups')
+		errors = {}
+		for field in ('tree_species', 'crown_diameter', 'canopy_status'):
+			value = data.get(field + '_id')
+			if value is not None and value not in lookups[field]:
+				errors[field] = ['Invalid pk "{}" - object does not exist.'.format(value)]
+		if errors:
+			raise serializers.ValidationError(errors)
+		return data
 
+	class Meta:
+		"""Meta class to map serializer's fields with the model fields."""
+		model = SurveyData
+		fields = ('client_id', 'aoi', 'name', 'tree_species', 'crown_diameter', 'canopy_status',
+			'comment', 'longitude', 'latitude', 'images')
+		validators = []
 
-class PhotoSerializer(serializers.ModelSerializer):
+class PhotoSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
 	key = serializers.IntegerField(source='id')
 
@@ -209,10 +301,85 @@ class PhotoSerializer(serializers.ModelSerializer):
 		model = Photo
 		fields = ('key',)
 
-class PhotoWriteSerializer(serializers.ModelSerializer):
+class SyncAOISerializer(AOISummarySerializer):
+	"""Serializer to map the Model instance into JSON format for the delta sync."""
+	gz = serializers.IntegerField(source='geographical_zone_id')
+
+	class Meta(AOISummarySerializer.Meta):
+		"""Meta class to map serializer's fields with the model fields."""
+		fields = ('key', 'name', 'bbox', 'gz')
+
+# not used to answer requests: the delta sync reads its observations with readers.read_observations(with_aoi=True),
+# this serializer is kept as the reference its output is tested against
+class SyncSurveyDataSerializer(SurveyDataSerializer):
+	"""Serializer to map the Model instance into JSON format for the delta sync."""
+	aoi = serializers.IntegerField(source='aoi_id')
+
+	class Meta(SurveyDataSerializer.Meta):
+		"""Meta class to map serializer's fields with the model fields."""
+		fields = SurveyDataSerializer.Meta.fields + ('aoi',)
+
+class SyncPhotoSerializer(ModelSerializer):
+	"""Serializer to map the Model instance into JSON format for the delta sync."""
+	key = serializers.IntegerField(source='id')
+	observation = serializers.IntegerField(source='survey_data_id')
+
+	class Meta:
+		"""Meta class to map serializer's fields with the model fields."""
+		model = Photo
+		fields = ('key', 'observation', 'compass', 'comment')
+
+class PhotoWriteSerializer(ModelSerializer):
 	"""Serializer to map the Model instance into JSON format."""
+	# no photo is added to the observations of a deleted AOI
+	survey_data = serializers.PrimaryKeyRelatedField(queryset=SurveyData.objects.alive())
+	image = serializers.CharField(write_only=True)
+
+	def validate_image(self, value):
+		try:
+			return decode_data_uri(value)
+		except ValueError as e:
+			raise serializers.ValidationError(str(e))
+
+	def create(self, validated_data):
+		content, ext = validated_data.pop('image')
+		photo = Photo(**validated_data)
+		store_photo(photo, content, ext)
+		with transaction.atomic():
+			photo.save()
+			SurveyData.objects.filter(id=photo.survey_data_id).bump_version()
+		return photo
 
 	class Meta:
 		"""Meta class to map serializer's fields with the model fields."""
 		model = Photo
 		fields = ('survey_data', 'compass', 'image', 'comment')
+
+class UploadSessionSerializer(ModelSerializer):
+	"""Serializer to map the Model instance into JSON format."""
+	key = serializers.UUIDField(source='id', read_only=True)
+	offset = serializers.IntegerField(source='received', read_only=True)
+	content_type = serializers.CharField(write_only=True)
+	survey_data = serializers.PrimaryKeyRelatedField(queryset=SurveyData.objects.alive(), write_only=True)
+
+	def validate_content_type(self, value):
+		ext = image_extension(value)
+		if ext is None:
+			raise serializers.ValidationError('Unsupported content type.')
+		return ext
+
+	def validate_size(self, value):
+		if value <= 0:
+			raise serializers.ValidationError('The file is empty.')
+		return value
+
+	def create(self, validated_data):
+		validated_data['ext'] = validated_data.pop('content_type')
+		validated_data['owner'] = self.context.get('request').user
+		return UploadSession.objects.create(**validated_data)
+
+	class Meta:
+		"""Meta class to map serializer's fields with the model fields."""
+		model = UploadSession
+		fields = ('key', 'offset', 'survey_data', 'size', 'content_type', 'compass', 'comment')
+		extra_kwargs = {'compass': {'write_only': True}, 'comment': {'write_only': True}}
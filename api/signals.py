@@ -0,0 +1,173 @@
+from collections import Counter
+import threading
+
+from django.contrib.auth.models import Group
+from django.db import transaction
+from django.db.models.base import DEFERRED
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+
+from .caching import invalidate_reference_data, invalidate_zone_access
+from .derivatives import generate_derivatives
+from .models import AOI, GGZ, SurveyData, Photo, Tombstone, TreeSpecies, CrownDiameter, CanopyStatus, User
+from .stats import adjust_stats, stats_key
+from .tasks import submit_on_commit
+from .tiles import invalidate_tiles
+
+
+# ids of the users being deleted in this thread: the rows deleted with them get no tombstone,
+# there is nobody left to sync them and the tombstone would reference a deleted user
+_deleting = threading.local()
+
+
+def deleting_users():
+	if not hasattr(_deleting, 'users'):
+		_deleting.users = set()
+	return _deleting.users
+
+
+def purging_aois():
+	"""
+		Ids of the soft-deleted AOIs purged by this thread (see api/purge.py). Their observations
+		get no tombstone and leave the statistics alone: the AOI is already reported as deleted,
+		its statistics are ignored and go with it, its tiles were dropped before the purge.
+	"""
+	if not hasattr(_deleting, 'aois'):
+		_deleting.aois = set()
+	return _deleting.aois
+
+
+def deleted_observations():
+	"""
+		Owner and AOI ids of the observations being deleted by this thread, by observation id,
+		recorded before the delete: the photos deleted with them in the cascade read them
+		from here rather than each looking its observation up.
+	"""
+	if not hasattr(_deleting, 'observations'):
+		_deleting.observations = {}
+	return _deleting.observations
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+	userId = instance.id
+	deleting_users().add(userId)
+	transaction.on_commit(lambda: deleting_users().discard(userId))
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+	# the cascade may delete the rows of the user after the user itself, or before
+	Tombstone.objects.filter(owner_id=instance.id).delete()
+
+
+def add_tombstone(kind, object_id, owner_id):
+	# a user still in the set after a rollback still exists and gets its tombstones
+	if owner_id in deleting_users() and not User.objects.filter(id=owner_id).exists():
+		return
+	Tombstone.objects.create(kind=kind, object_id=object_id, owner_id=owner_id)
+
+
+@receiver(post_delete, sender=AOI)
+def aoi_deleted(sender, instance, **kwargs):
+	add_tombstone(Tombstone.AOI, instance.id, instance.owner_id)
+
+
+# fields of an observation the map tiles and the statistics depend on
+OBSERVATION_STATE = ('aoi_id', 'longitude', 'latitude', 'canopy_status_id', 'crown_diameter_id')
+
+
+def observation_state(instance):
+	"""Values of OBSERVATION_STATE, DEFERRED for the fields not loaded."""
+	# read from __dict__, accessing a deferred field would query the database
+	return tuple(instance.__dict__.get(field, DEFERRED) for field in OBSERVATION_STATE)
+
+
+def observation_changed(old, new):
+	"""Invalidate the tiles and adjust the statistics of an observation going from state old to new (None for none)."""
+	states = [state for state in (old, new) if state is not None]
+	loaded = [state for state in states if DEFERRED not in state]
+	invalidate_tiles([state[:3] for state in loaded])
+	# the statistics can only be moved when the previous values are known
+	if len(loaded) == len(states):
+		changes = Counter()
+		if old is not None:
+			changes[stats_key(old[0], old[3], old[4])] -= 1
+		if new is not None:
+			changes[stats_key(new[0], new[3], new[4])] += 1
+		adjust_stats(changes)
+
+
+@receiver(pre_delete, sender=SurveyData)
+def observation_deleting(sender, instance, **kwargs):
+	deleted_observations()[instance.id] = (instance.owner_id, instance.aoi_id)
+
+
+@receiver(post_delete, sender=SurveyData)
+def observation_deleted(sender, instance, **kwargs):
+	# its photos, deleted first, are gone
+	deleted_observations().pop(instance.id, None)
+	if instance.aoi_id in purging_aois():
+		return
+	add_tombstone(Tombstone.OBSERVATION, instance.id, instance.owner_id)
+	observation_changed(observation_state(instance), None)
+
+
+@receiver(post_init, sender=SurveyData)
+def observation_loaded(sender, instance, **kwargs):
+	# state of the observation when loaded, to find its previous tiles and statistics when saved
+	instance._loaded_state = observation_state(instance)
+
+
+@receiver(post_save, sender=SurveyData)
+def observation_saved(sender, instance, created, **kwargs):
+	state = observation_state(instance)
+	if created:
+		observation_changed(None, state)
+	elif state != instance._loaded_state:
+		observation_changed(instance._loaded_state, state)
+	instance._loaded_state = state
+
+
+@receiver(post_delete, sender=Photo)
+def photo_deleted(sender, instance, **kwargs):
+	observation = deleted_observations().get(instance.survey_data_id)
+	if observation is None:
+		# the photo alone is deleted
+		observation = SurveyData.objects.filter(id=instance.survey_data_id).values_list('owner_id', 'aoi_id').first() or (None, None)
+	owner_id, aoi_id = observation
+	if aoi_id not in purging_aois():
+		add_tombstone(Tombstone.PHOTO, instance.id, owner_id)
+	# the files go once the delete is committed, a rolled back delete keeps its photo
+	files = [(field.storage, field.name) for field in (instance.img, instance.thumbnail, instance.medium) if field]
+	if files:
+		transaction.on_commit(lambda: delete_files(files))
+
+
+def delete_files(files):
+	for storage, name in files:
+		storage.delete(name)
+
+
+@receiver(post_save, sender=Photo)
+def photo_saved(sender, instance, created, **kwargs):
+	if created and (instance.img or instance.image):
+		submit_on_commit(generate_derivatives, instance.id)
+
+
+@receiver(post_save, sender=TreeSpecies)
+@receiver(post_save, sender=CrownDiameter)
+@receiver(post_save, sender=CanopyStatus)
+@receiver(post_delete, sender=TreeSpecies)
+@receiver(post_delete, sender=CrownDiameter)
+@receiver(post_delete, sender=CanopyStatus)
+def reference_data_changed(sender, **kwargs):
+	invalidate_reference_data()
+
+
+@receiver(post_save, sender=GGZ)
+@receiver(post_delete, sender=GGZ)
+@receiver(post_delete, sender=Group)
+@receiver(m2m_changed, sender=User.groups.through)
+def zone_access_changed(sender, **kwargs):
+	invalidate_zone_access()
@@ -0,0 +1,93 @@
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from .models import AOI, ObservationStats, SurveyData
+
+# Observation statistics
+# ------------------------------------------------------------------------------
+# ObservationStats holds the number of observations per AOI, canopy status and crown
+# diameter. Saving or deleting an observation adjusts its rows in the same transaction,
+# so the statistics of a zone are read from a few rows whatever its number of
+# observations. There is a single row per combination (unique on the AOI, the canopy
+# status and crown_key, the crown diameter or 0): the first observation of a combination
+# inserts it, a concurrent insert of the same row fails and is retried as an update, so
+# each delta is added to a single row. rebuild_stats recomputes the table.
+
+STATS_BATCH_SIZE = 1000
+
+
+def stats_key(aoi_id, canopy_status_id, crown_diameter_id):
+	return (aoi_id, canopy_status_id, crown_diameter_id)
+
+
+def adjust_stats(changes):
+	"""Add the deltas of changes, a mapping from stats_key() to a number of observations."""
+	changes = {key: delta for key, delta in changes.items() if delta}
+	if not changes:
+		return
+	zones = None
+	for (aoi_id, canopy_status_id, crown_diameter_id), delta in changes.items():
+		rows = ObservationStats.objects.filter(aoi_id=aoi_id, canopy_status_id=canopy_status_id, crown_key=crown_diameter_id or 0)
+		# an observation removed from a combination without row was never counted, rebuild_stats fixes it
+		if rows.update(count=F('count') + delta) or delta < 0:
+			continue
+		if zones is None:
+			aoiIds = {key[0] for key in changes}
+			zones = dict(AOI.objects.filter(id__in=aoiIds).values_list('id', 'geographical_zone_id'))
+		try:
+			# in a savepoint, the transaction of the caller goes on after a failed insert
+			with transaction.atomic():
+				ObservationStats.objects.create(aoi_id=aoi_id, geographical_zone_id=zones[aoi_id],
+					canopy_status_id=canopy_status_id, crown_diameter_id=crown_diameter_id, crown_key=crown_diameter_id or 0, count=delta)
+		except IntegrityError:
+			# inserted meanwhile by a concurrent transaction, now committed
+			rows.update(count=F('count') + delta)
+
+
+def count_observations(observations):
+	"""The stats_key() counts of the given observations, to be passed to adjust_stats."""
+	return Counter(stats_key(obs.aoi_id, obs.canopy_status_id, obs.crown_diameter_id) for obs in observations)
+
+
+def rebuild_stats():
+	"""Recompute the whole statistics table from the observations, returns the number of rows."""
+	rows = SurveyData.objects.values('aoi_id', 'aoi__geographical_zone_id', 'canopy_status_id', 'crown_diameter_id') \
+		.annotate(count=Count('id')).order_by()
+	with transaction.atomic():
+		ObservationStats.objects.all().delete()
+		stats = [ObservationStats(aoi_id=row['aoi_id'], geographical_zone_id=row['aoi__geographical_zone_id'],
+			canopy_status_id=row['canopy_status_id'], crown_diameter_id=row['crown_diameter_id'],
+			crown_key=row['crown_diameter_id'] or 0, count=row['count'])
+			for row in rows.iterator()]
+		ObservationStats.objects.bulk_create(stats, batch_size=STATS_BATCH_SIZE)
+	return len(stats)
+
+
+def _breakdown(rows):
+	result = {'total': 0, 'canopy_status': {}, 'crown_diameter': {}}
+	for row in rows:
+		result['total'] += row['count']
+		for field in ('canopy_status', 'crown_diameter'):
+			key = str(row[field + '_id'])
+			result[field][key] = result[field].get(key, 0) + row['count']
+	return result
+
+
+def zone_stats(gz, aois=None):
+	"""
+		Number of observations in the AOIs of the queryset aois (all the AOIs of the zone when
+		None) of the zone, per canopy status and crown diameter, in total and per AOI.
+	"""
+	stats = ObservationStats.objects.filter(geographical_zone_id=gz, aoi__is_deleted=False)
+	# the zone figures and the AOI ones come from the same AOIs
+	if aois is not None:
+		stats = stats.filter(aoi__in=aois)
+	result = _breakdown(stats.values('canopy_status_id', 'crown_diameter_id').annotate(count=Sum('count')).order_by())
+
+	perAOI = {}
+	for row in stats.values('aoi_id', 'aoi__name', 'canopy_status_id', 'crown_diameter_id').annotate(count=Sum('count')).order_by('aoi_id'):
+		perAOI.setdefault((row['aoi_id'], row['aoi__name']), []).append(row)
+	result['aois'] = [dict(key=aoiId, name=name, **_breakdown(rows)) for (aoiId, name), rows in perAOI.items()]
+	return result
@@ -0,0 +1,100 @@
+import base64
+import binascii
+import hashlib
+import io
+
+from django.core.files.base import File
+from django.utils.crypto import get_random_string
+
+
+# the image types accepted from the clients, with the extension they are stored under.
+# The stored files are served back by photoView, nothing else (html, svg) may get through.
+IMAGE_EXTENSIONS = {
+	'jpeg': 'jpg',
+	'jpg': 'jpg',
+	'pjpeg': 'jpg',
+	'png': 'png',
+	'webp': 'webp',
+}
+# content type of the stored files, per extension
+IMAGE_CONTENT_TYPES = {
+	'jpg': 'image/jpeg',
+	'png': 'image/png',
+	'webp': 'image/webp',
+}
+
+
+def decode_data_uri(data):
+	"""
+		Decode a base64 image sent by the app, with or without its `data:image/<ext>;base64,` prefix.
+		Returns the binary content and the file extension, raises ValueError on malformed input
+		or on an image type not in IMAGE_EXTENSIONS.
+	"""
+	ext = 'jpg'
+	if ';base64,' in data:
+		header, data = data.split(';base64,', 1)
+		if header:
+			ext = image_extension(header[len('data:'):] if header.startswith('data:') else header)
+			if ext is None:
+				raise ValueError('Unsupported image type')
+	try:
+		content = base64.b64decode(data, validate=True)
+	except (binascii.Error, ValueError):
+		raise ValueError('Invalid base64 image')
+	if not content:
+		raise ValueError('Empty image')
+	return content, ext
+
+
+class HashingReader:
+	"""File-like wrapper computing the SHA-256 and the size of what is read through it."""
+
+	def __init__(self, stream):
+		self.stream = stream
+		self.hash = hashlib.sha256()
+		self.size = 0
+
+	def read(self, size=-1):
+		chunk = self.stream.read(size)
+		self.hash.update(chunk)
+		self.size += len(chunk)
+		return chunk
+
+
+def store_photo_stream(photo, stream, ext):
+	"""
+		Copy a file-like object to the default storage, under Photo.img upload_to, chunk by chunk.
+		The content is hashed on the way, so it is never held in memory as a whole.
+	"""
+	reader = HashingReader(stream)
+	photo.img.save(get_random_string(length=32) + '.' + ext, File(reader), save=False)
+	photo.content_hash = reader.hash.hexdigest()
+	photo.image = ''
+	return reader.size
+
+
+def store_photo(photo, content, ext):
+	"""Write the binary content of a photo to the default storage, under Photo.img upload_to, and hash it."""
+	return store_photo_stream(photo, io.BytesIO(content), ext)
+
+
+def image_extension(content_type):
+	"""File extension for an image content type, None if it is not one of IMAGE_EXTENSIONS."""
+	content_type = (content_type or '').split(';')[0].strip().lower()
+	if not content_type.startswith('image/'):
+		return None
+	return IMAGE_EXTENSIONS.get(content_type[len('image/'):])
+
+
+def photo_url(photo, size='original'):
+	"""
+		URL of the given size of the photo (thumbnail, medium or original).
+		Falls back to the original when the copy is not generated yet,
+		and to the inline base64 data URI for rows not migrated yet.
+	"""
+	derivative = getattr(photo, size, None) if size != 'original' else None
+	if derivative:
+		return derivative.url
+	if photo.img:
+		return photo.img.url
+	return photo.image
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+import django
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+	"""The process wide pool running the background tasks, created on first use."""
+	global _executor
+	with _executor_lock:
+		if _executor is None:
+			_executor = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix='treechecker-task')
+		return _executor
+
+
+def _run(fn, args):
+	try:
+		fn(*args)
+	except Exception:
+		logger.exception('Background task %s failed', fn.__name__)
+	finally:
+		# each worker thread has its own connection, don't leave it open between tasks
+		connection.close()
+
+
+def submit(fn, *args):
+	"""Run fn(*args) in the background pool."""
+	return get_executor().submit(_run, fn, args)
+
+
+def submit_on_commit(fn, *args):
+	"""Run fn(*args) in the background pool once the current transaction is committed, so the task sees its rows."""
+	transaction.on_commit(lambda: submit(fn, *args))
+
+
+def setup_process(values):
+	"""
+		Initializer of the spawned worker processes: set the given settings, as the parent
+		process has them, then set Django up. Imports no model, it runs before the setup.
+	"""
+	for name, value in values.items():
+		setattr(settings, name, value)
+	django.setup()
@@ -1,8 +1,46 @@
-from django.test import TestCase
+from django.test import Client, TestCase, TransactionTestCase, override_settings
 from rest_framework.test import APIClient
 from rest_framework import status
-from django.core.urlresolvers import reverse
-from .models import User
+import base64
+import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock, skipIf
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import JsonResponse
+from django.db import IntegrityError, connection, transaction
+from django.db.models import QuerySet
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.conf import settings
+from django.utils import timezone
+from PIL import Image
+import geopandas as gpd
+from .admin import SurveyDataAdmin
+from .derivatives import generate_derivatives
+from .readers import read_aois, read_country, read_observations
+from .serializers import AOIReadSerializer, CountrySerializer, SurveyDataSerializer, SyncSurveyDataSerializer
+from .log import SamplingFilter, StructuredFormatter
+from . import caching, compact, exports, metrics, provisioning, tiles, views
+from .exports import queue_export
+from .provisioning import hash_passwords
+from .purge import purge_aoi
+from .stats import adjust_stats, stats_key
+from .storage import decode_data_uri, store_photo
+from django.contrib import admin
+from django.contrib.auth.hashers import check_password
+from django.contrib.auth.models import Group
+from .models import User, Country, GeographicalZone, GGZ, AOI, TreeSpecies, CrownDiameter, CanopyStatus, SurveyData, Photo, ExportJob, ObservationStats, Tombstone
 
 class ModelTestCase(TestCase):
 	"""This class defines the test suite for the user model."""
@@ -31,4 +69,1266 @@ class ViewTestCase(TestCase):
 
 	def test_api_can_create_an_user(self):
 		"""Test the api has user creation capability."""
-		self.assertEqual(self.response.status_code, status.HTTP_201_CREATED)
\ No newline at end of file
+		self.assertEqual(self.response.status_code, status.HTTP_201_CREATED)
+
+class TemporaryDirectoryMixin:
+	"""Temporary directories removed after each test."""
+
+	def temporary_directory(self, **paths):
+		"""
+			Create a temporary directory removed after the test and point the given settings to
+			paths inside it, by setting name ('' for the directory itself). Returns its path.
+		"""
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		if paths:
+			override = override_settings(**{name: os.path.join(directory, path) if path else directory
+				for name, path in paths.items()})
+			override.enable()
+			self.addCleanup(override.disable)
+		return directory
+
+
+class UserDataMixin(TemporaryDirectoryMixin):
+	"""
+		Data shared by the test suites of the api views: a user in a group with access to a
+		geographical zone, an AOI of the user in the zone, a canopy status and an API client
+		authenticated as the user.
+	"""
+
+	# x_min, x_max, y_min, y_max of the AOI of the user
+	aoi_bbox = (0, 10, 0, 10)
+
+	def setUp(self):
+		super().setUp()
+		# the versions cached by the previous tests, whose changes are never committed
+		cache.clear()
+		self.group = Group.objects.create(name="team")
+		self.user = User.objects.create(name="owner", username="owner", email="owner@test.com")
+		self.user.groups.add(self.group)
+		self.gz = GeographicalZone.objects.create(name="zone", wms_url="{}", x_min=0, x_max=10, y_min=0, y_max=10)
+		GGZ.objects.create(group=self.group, geographical_zone=self.gz)
+		self.canopy = CanopyStatus.objects.create(name="healthy")
+		x_min, x_max, y_min, y_max = self.aoi_bbox
+		self.aoi = AOI.objects.create(name="aoi", x_min=x_min, x_max=x_max, y_min=y_min, y_max=y_max, owner=self.user,
+			geographical_zone=self.gz)
+		self.client = APIClient()
+		self.client.force_authenticate(user=self.user)
+
+	def create_observation(self, **fields):
+		"""An observation of the user in its AOI, with the given fields."""
+		values = {'name': 'obs', 'canopy_status': self.canopy, 'owner': self.user, 'aoi': self.aoi, 'longitude': 0.5, 'latitude': 0.5}
+		values.update(fields)
+		return SurveyData.objects.create(**values)
+
+
+class UserDataTestCase(UserDataMixin, TestCase):
+	"""Base of the test suites working on the data of UserDataMixin."""
+
+
+class AOIReadQueryCountTestCase(UserDataTestCase):
+	"""Test suite for the number of queries run by the AOI listing."""
+
+	def setUp(self):
+		super().setUp()
+		self.species = TreeSpecies.objects.create(name="species")
+		self.crown = CrownDiameter.objects.create(name="0.1")
+
+	def add_aois(self, num_aois, num_obs):
+		for i in range(num_aois):
+			aoi = AOI.objects.create(name="aoi", x_min=0, x_max=1, y_min=0, y_max=1, owner=self.user, geographical_zone=self.gz)
+			for j in range(num_obs):
+				obs = self.create_observation(tree_species=self.species, crown_diameter=self.crown, aoi=aoi)
+				Photo.objects.create(survey_data=obs, image="data:image/jpeg;base64,AAAA")
+
+	def count_queries(self):
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get('/api/gzs/{}/aois/'.format(self.gz.id))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		return len(queries), response.json()
+
+	def test_query_count_does_not_grow_with_data(self):
+		"""Test the AOI listing runs a constant number of queries."""
+		self.add_aois(1, 1)
+		small_count, small_data = self.count_queries()
+		self.add_aois(5, 4)
+		large_count, large_data = self.count_queries()
+
+		self.assertEqual(small_count, large_count)
+		# with the AOI of the user, without observations
+		self.assertEqual(len(large_data), 7)
+		self.assertEqual(sum(len(aoi['obs']) for aoi in large_data), 21)
+		self.assertEqual(large_data[1]['obs'][0]['tree_species'], {'key': self.species.id, 'name': 'species'})
+		self.assertEqual(len(large_data[1]['obs'][0]['images']), 1)
+
+class ObservationPaginationTestCase(UserDataTestCase):
+	"""Test suite for the paginated observation listing of an AOI."""
+
+	aoi_bbox = (0, 1, 0, 1)
+
+	def setUp(self):
+		super().setUp()
+		self.obs = [self.create_observation(name="obs{}".format(i)) for i in range(5)]
+
+	def test_pages_cover_all_observations(self):
+		"""Test the cursor walks through every observation exactly once."""
+		url = '/api/aois/{}/observations/'.format(self.aoi.id)
+		keys = []
+		response = self.client.get(url, {'limit': 2}).json()
+		while True:
+			self.assertLessEqual(len(response['results']), 2)
+			keys += [obs['key'] for obs in response['results']]
+			if response['next'] is None:
+				break
+			response = self.client.get(url, {'limit': 2, 'cursor': response['next']}).json()
+
+		self.assertEqual(keys, [obs.id for obs in self.obs])
+
+	def test_invalid_cursor(self):
+		"""Test a malformed cursor is rejected."""
+		response = self.client.get('/api/aois/{}/observations/'.format(self.aoi.id), {'cursor': 'nope'})
+		self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+	def test_other_user_aoi(self):
+		"""Test the observations of another user's AOI are not listed."""
+		other = User.objects.create(name="other", username="other", email="other@test.com")
+		self.client.force_authenticate(user=other)
+		response = self.client.get('/api/aois/{}/observations/'.format(self.aoi.id))
+		self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+	def test_aois_without_observations(self):
+		"""Test the AOI listing can leave the observations out."""
+		response = self.client.get('/api/gzs/{}/aois/'.format(self.aoi.geographical_zone_id), {'obs': 0}).json()
+		self.assertEqual(response, [{'key': self.aoi.id, 'name': 'aoi', 'bbox': [0.0, 1.0, 0.0, 1.0]}])
+
+	def test_bbox_filter(self):
+		"""Test the listings only return the observations and AOIs inside the bbox."""
+		SurveyData.objects.filter(id=self.obs[0].id).update(longitude=0.9, latitude=0.9)
+		url = '/api/aois/{}/observations/'.format(self.aoi.id)
+		response = self.client.get(url, {'bbox': '0.8,0.8,1,1'}).json()
+		self.assertEqual([obs['key'] for obs in response['results']], [self.obs[0].id])
+
+		url = '/api/gzs/{}/aois/'.format(self.aoi.geographical_zone_id)
+		self.assertEqual(len(self.client.get(url, {'bbox': '0.5,0.5,2,2', 'obs': 0}).json()), 1)
+		self.assertEqual(len(self.client.get(url, {'bbox': '2,2,3,3', 'obs': 0}).json()), 0)
+
+	def test_invalid_bbox(self):
+		"""Test a malformed bbox is rejected."""
+		for bbox in ('1,2,3', '1,2,0,4', 'a,b,c,d', 'nan,0,1,1'):
+			response = self.client.get('/api/aois/{}/observations/'.format(self.aoi.id), {'bbox': bbox})
+			self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class SyncTestCase(UserDataTestCase):
+	"""Test suite for the delta sync endpoint."""
+
+	def setUp(self):
+		super().setUp()
+		self.obs = self.create_observation()
+
+	def test_full_then_delta_sync(self):
+		"""Test a sync with the previous token only returns the changes and deletions."""
+		first = self.client.get('/api/sync/').json()
+		self.assertEqual([aoi['key'] for aoi in first['aois']], [self.aoi.id])
+		self.assertEqual([obs['key'] for obs in first['observations']], [self.obs.id])
+		self.assertEqual(first['observations'][0]['aoi'], self.aoi.id)
+
+		added = self.create_observation(name="new")
+		removed = self.obs.id
+		self.obs.delete()
+
+		second = self.client.get('/api/sync/', {'token': first['token']}).json()
+		self.assertEqual(second['aois'], [])
+		self.assertEqual([obs['key'] for obs in second['observations']], [added.id])
+		self.assertEqual(second['deleted']['observations'], [removed])
+
+	def test_invalid_token(self):
+		"""Test a malformed token is rejected."""
+		response = self.client.get('/api/sync/', {'token': 'nope'})
+		self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+	def test_expired_token(self):
+		"""Test a sync older than the tombstone retention returns the whole user data."""
+		since = (timezone.now() - settings.TOMBSTONE_TTL - timezone.timedelta(days=1)).isoformat()
+		response = self.client.get('/api/sync/', {'since': since}).json()
+		self.assertTrue(response['full'])
+		self.assertEqual([obs['key'] for obs in response['observations']], [self.obs.id])
+		self.assertFalse(self.client.get('/api/sync/', {'token': response['token']}).json()['full'])
+
+	def test_purge_tombstones(self):
+		"""Test the tombstones are removed once older than the retention."""
+		kept = self.obs.id
+		self.obs.delete()
+		Tombstone.objects.create(kind=Tombstone.AOI, object_id=self.aoi.id, owner=self.user)
+		Tombstone.objects.filter(kind=Tombstone.AOI).update(deleted_at=timezone.now() - settings.TOMBSTONE_TTL - timezone.timedelta(days=1))
+		call_command('purge_tombstones', stdout=io.StringIO())
+		self.assertEqual(list(Tombstone.objects.values_list('object_id', flat=True)), [kept])
+
+class PhotoStorageTestCase(UserDataTestCase):
+	"""Test suite for the storage of the photos outside of the database."""
+
+	content = b'not really a jpeg'
+
+	def setUp(self):
+		super().setUp()
+		self.temporary_directory(MEDIA_ROOT='', UPLOAD_TEMP_DIR='tmp')
+		self.obs = self.create_observation()
+
+	def data_uri(self):
+		return 'data:image/jpeg;base64,' + base64.b64encode(self.content).decode('ascii')
+
+	def assertStored(self, photo):
+		self.assertEqual(photo.image, '')
+		self.assertTrue(photo.img.name.startswith('uploads/'))
+		self.assertEqual(photo.img.read(), self.content)
+		self.assertEqual(photo.content_hash, hashlib.sha256(self.content).hexdigest())
+
+	def test_delete_photo_files_on_commit(self):
+		"""Test the files of a deleted photo are only removed once the delete is committed."""
+		photo = Photo(survey_data=self.obs)
+		store_photo(photo, self.content, 'jpeg')
+		photo.save()
+		path = photo.img.path
+
+		with transaction.atomic():
+			Photo.objects.get(id=photo.id).delete()
+			transaction.set_rollback(True)
+		self.assertTrue(os.path.exists(path))
+
+		with self.captureOnCommitCallbacks(execute=True):
+			Photo.objects.get(id=photo.id).delete()
+		self.assertFalse(os.path.exists(path))
+
+	def test_delete_observation_photos(self):
+		"""Test the photos deleted with their observation don't each look the observation up."""
+		photos = [Photo.objects.create(survey_data=self.obs) for i in range(3)]
+		with CaptureQueriesContext(connection) as queries:
+			self.obs.delete()
+		self.assertFalse([query for query in queries if query['sql'].startswith('SELECT') and 'FROM "api_surveydata"' in query['sql']])
+		self.assertEqual(set(Tombstone.objects.filter(kind=Tombstone.PHOTO).values_list('object_id', 'owner_id')),
+			{(photo.id, self.user.id) for photo in photos})
+
+	def test_add_image_writes_file(self):
+		"""Test an uploaded photo is stored as a file and not in the database."""
+		response = self.client.post('/api/images/', {'survey_data': self.obs.id, 'image': self.data_uri()}, format='json')
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertStored(Photo.objects.get(id=response.json()['key']))
+
+	def test_add_image_invalid_base64(self):
+		"""Test a malformed image is rejected."""
+		response = self.client.post('/api/images/', {'survey_data': self.obs.id, 'image': 'data:image/jpeg;base64,%%'}, format='json')
+		self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+	def test_add_image_unsupported_type(self):
+		"""Test an image type outside of the accepted ones is rejected and nothing is stored."""
+		for header in ('data:image/html', 'data:image/svg+xml', 'data:text/html'):
+			response = self.client.post('/api/images/', {'survey_data': self.obs.id, 'image': header + ';base64,PHNjcmlwdD4='},
+				format='json')
+			self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, header)
+		self.assertFalse(Photo.objects.exists())
+		self.assertEqual(decode_data_uri('data:image/jpeg;base64,AAAA')[1], 'jpg')
+
+	def test_raw_upload(self):
+		"""Test a photo can be sent as the raw request body."""
+		response = self.client.post('/api/observations/{}/images/?compass=12.5'.format(self.obs.id), self.content,
+			content_type='image/jpeg')
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		photo = Photo.objects.get(id=response.json()['key'])
+		self.assertStored(photo)
+		self.assertEqual(photo.compass, 12.5)
+
+	def test_multipart_upload(self):
+		"""Test a photo can be sent as a multipart form."""
+		upload = SimpleUploadedFile('photo.jpg', self.content, content_type='image/jpeg')
+		response = self.client.post('/api/observations/{}/images/'.format(self.obs.id), {'image': upload, 'comment': 'c'},
+			format='multipart')
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertStored(Photo.objects.get(id=response.json()['key']))
+
+	def test_upload_other_user_observation(self):
+		"""Test a photo cannot be added to the observation of another user."""
+		other = User.objects.create(name="other", username="other", email="other@test.com")
+		self.client.force_authenticate(user=other)
+		response = self.client.post('/api/observations/{}/images/'.format(self.obs.id), self.content, content_type='image/jpeg')
+		self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+	def test_resumable_upload(self):
+		"""Test a photo sent in chunks is stored once the last chunk is received."""
+		response = self.client.post('/api/uploads/', {'survey_data': self.obs.id, 'size': len(self.content),
+			'content_type': 'image/jpeg'}, format='json')
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		url = '/api/uploads/{}/'.format(response.json()['key'])
+
+		response = self.client.put(url, self.content[:5], content_type='application/octet-stream',
+			HTTP_CONTENT_RANGE='bytes 0-4/{}'.format(len(self.content)))
+		self.assertEqual(response.json()['offset'], 5)
+		# a chunk sent twice after a dropped connection
+		response = self.client.put(url, self.content[:5], content_type='application/octet-stream',
+			HTTP_CONTENT_RANGE='bytes 0-4/{}'.format(len(self.content)))
+		self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+		self.assertEqual(self.client.get(url).json()['offset'], 5)
+
+		response = self.client.put(url, self.content[5:], content_type='application/octet-stream',
+			HTTP_CONTENT_RANGE='bytes 5-{0}/{1}'.format(len(self.content) - 1, len(self.content)))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertStored(Photo.objects.get(id=response.json()['photo']['key']))
+		self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+	def test_upload_unsupported_type(self):
+		"""Test the uploads of a type outside of the accepted images are rejected, and unknown upload ids give a 404."""
+		response = self.client.post('/api/observations/{}/images/'.format(self.obs.id), b'<svg/>', content_type='image/svg+xml')
+		self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+		response = self.client.post('/api/uploads/', {'survey_data': self.obs.id, 'size': 6, 'content_type': 'image/svg+xml'},
+			format='json')
+		self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+		self.assertFalse(Photo.objects.exists())
+		for key in ('abc-def', '00000000-0000-0000-0000-000000000000'):
+			self.assertEqual(self.client.get('/api/uploads/{}/'.format(key)).status_code, status.HTTP_404_NOT_FOUND, key)
+
+	def test_photo_sizes(self):
+		"""Test the reduced copies of a photo are generated and served."""
+		content = io.BytesIO()
+		Image.new('RGB', (1600, 1200), 'green').save(content, 'JPEG')
+		photo = Photo(survey_data=self.obs)
+		store_photo(photo, content.getvalue(), 'jpg')
+		photo.save()
+
+		generate_derivatives(photo.id)
+		photo.refresh_from_db()
+		self.assertEqual(Image.open(photo.thumbnail).size, (200, 150))
+		self.assertEqual(Image.open(photo.medium).size, (1024, 768))
+
+		response = self.client.get('/api/images/{}/thumbnail/'.format(photo.id))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertEqual(response['Content-Type'], 'image/jpeg')
+		self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+		self.assertEqual(Image.open(io.BytesIO(b''.join(response.streaming_content))).size, (200, 150))
+		response = self.client.get('/api/images/{}/original/'.format(photo.id))
+		self.assertEqual(b''.join(response.streaming_content), content.getvalue())
+
+	def test_photo_size_not_generated(self):
+		"""Test the original is served while the reduced copies are generated in the background."""
+		photo = Photo(survey_data=self.obs)
+		store_photo(photo, self.content, 'png')
+		photo.save()
+		cache.clear()
+		with mock.patch.object(views, 'submit') as submit:
+			for i in range(2):
+				response = self.client.get('/api/images/{}/thumbnail/'.format(photo.id))
+				self.assertEqual(b''.join(response.streaming_content), self.content)
+		self.assertEqual(response['Content-Type'], 'image/png')
+		submit.assert_called_once_with(generate_derivatives, photo.id)
+
+	def test_photo_size_of_unreadable_image(self):
+		"""Test no reduced copy is made of an unreadable image."""
+		photo = Photo(survey_data=self.obs)
+		store_photo(photo, self.content, 'jpg')
+		photo.save()
+		self.assertIsNone(generate_derivatives(photo.id))
+
+	def test_migrate_photos(self):
+		"""Test the management command moves the existing base64 photos to files."""
+		photos = [Photo.objects.create(survey_data=self.obs, image=self.data_uri()) for i in range(3)]
+		call_command('migrate_photos', batch_size=2, stdout=open(os.devnull, 'w'))
+		for photo in photos:
+			self.assertStored(Photo.objects.get(id=photo.id))
+
+class ReferenceDataTestCase(UserDataTestCase):
+	"""Test suite for the cached reference lists."""
+
+	def setUp(self):
+		super().setUp()
+		self.species = TreeSpecies.objects.create(name="species")
+		CrownDiameter.objects.create(name="0.1")
+
+	def test_etag_and_invalidation(self):
+		"""Test an unchanged list is answered with 304 and an edited one with the new content."""
+		response = self.client.get('/api/species/')
+		self.assertEqual(response.json(), [{'key': self.species.id, 'name': 'species'}])
+		etag = response['ETag']
+
+		with self.assertNumQueries(0):
+			response = self.client.get('/api/species/', HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+		self.species.name = 'renamed'
+		with self.captureOnCommitCallbacks() as callbacks:
+			self.species.save()
+			# not committed yet, a request now must not cache the old list under a new version
+			self.assertEqual(self.client.get('/api/species/', HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+		for callback in callbacks:
+			callback()
+		response = self.client.get('/api/species/', HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertNotEqual(response['ETag'], etag)
+		self.assertEqual(response.json(), [{'key': self.species.id, 'name': 'renamed'}])
+
+	def test_etag_of_compressed_list(self):
+		"""Test the weak ETag of a compressed list, sent back as received, gets a 304."""
+		for i in range(50):
+			TreeSpecies.objects.create(name="species {}".format(i))
+		response = self.client.get('/api/reference/', HTTP_ACCEPT_ENCODING='gzip')
+		self.assertEqual(response['Content-Encoding'], 'gzip')
+		self.assertTrue(response['ETag'].startswith('W/'))
+		response = self.client.get('/api/reference/', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+		self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+	def test_local_lists_of_the_current_version(self):
+		"""Test the process only keeps the lists of the current version, whichever process bumped it."""
+		caching.get_reference_data('species')
+		for i in range(3):
+			# bumped by another web worker process
+			caching.bump_version(caching.REFERENCE_VERSION_KEY)
+			caching.get_reference_data('crowns')
+		version, entries = caching._reference_local
+		self.assertEqual(version, caching.get_version(caching.REFERENCE_VERSION_KEY))
+		self.assertEqual(list(entries), ['crowns'])
+
+	def test_bundle(self):
+		"""Test the bundle holds the three lists."""
+		response = self.client.get('/api/reference/').json()
+		self.assertEqual(response['species'], self.client.get('/api/species/').json())
+		self.assertEqual(response['crowns'], self.client.get('/api/crowns/').json())
+		self.assertEqual(response['canopies'], self.client.get('/api/canopies/').json())
+
+class ZoneAccessTestCase(UserDataTestCase):
+	"""Test suite for the geographical zones available to a user."""
+
+	def add_zones(self, count):
+		with self.captureOnCommitCallbacks(execute=True):
+			for i in range(count):
+				gz = GeographicalZone.objects.create(name="zone", wms_url="{}", x_min=0, x_max=10, y_min=0, y_max=10)
+				GGZ.objects.create(group=self.group, geographical_zone=gz)
+
+	def get_zones(self):
+		# a new user instance per request, as the authentication does
+		self.client.force_authenticate(user=User.objects.get(id=self.user.id))
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get('/api/gzs/')
+		return len(queries), response.json()
+
+	def test_zone_listing_query_count(self):
+		"""Test the zone listing does not run a query per zone and sees access changes."""
+		self.add_zones(1)
+		small_count, small_data = self.get_zones()
+		self.add_zones(5)
+		large_count, large_data = self.get_zones()
+
+		self.assertEqual(small_count, large_count)
+		self.assertEqual(len(large_data), 7)
+		self.assertTrue(all(zone['is_enabled'] for zone in large_data))
+
+		with self.captureOnCommitCallbacks(execute=True):
+			self.user.groups.remove(self.group)
+		self.assertEqual(self.get_zones()[1], [])
+
+class BulkObservationTestCase(UserDataTestCase):
+	"""Test suite for the bulk observation endpoint."""
+
+	def setUp(self):
+		super().setUp()
+		self.temporary_directory(MEDIA_ROOT='')
+		other = User.objects.create(name="other", username="other", email="other@test.com")
+		self.other_aoi = AOI.objects.create(name="aoi", x_min=0, x_max=1, y_min=0, y_max=1, owner=other, geographical_zone=self.gz)
+
+	def observation(self, client_id, aoi=None, **kwargs):
+		data = {'client_id': client_id, 'aoi': (aoi or self.aoi).id, 'name': 'obs', 'canopy_status': self.canopy.id,
+			'longitude': 0.5, 'latitude': 0.5}
+		data.update(kwargs)
+		return data
+
+	def test_bulk_create_and_retry(self):
+		"""Test a batch is created in a constant number of queries and a retry creates nothing."""
+		image = {'image': 'data:image/jpeg;base64,' + base64.b64encode(b'jpeg').decode('ascii'), 'compass': 10}
+		batch = [self.observation('a'), self.observation('b', images=[image]), self.observation('c', canopy_status=0),
+			self.observation('d', aoi=self.other_aoi), self.observation('a')]
+		with CaptureQueriesContext(connection) as small:
+			self.client.post('/api/observations/bulk/', [batch[1], batch[3]], format='json')
+		# both batches start without observations nor statistics rows
+		SurveyData.objects.all().delete()
+		ObservationStats.objects.all().delete()
+		with CaptureQueriesContext(connection) as large:
+			response = self.client.post('/api/observations/bulk/', batch, format='json')
+		self.assertEqual(len(small), len(large))
+
+		results = response.json()['results']
+		self.assertEqual([result['status'] for result in results], ['created', 'created', 'invalid', 'forbidden', 'duplicate'])
+		self.assertEqual(results[0]['key'], results[4]['key'])
+		self.assertEqual(SurveyData.objects.filter(owner=self.user).count(), 2)
+		self.assertEqual(Photo.objects.get(survey_data_id=results[1]['key']).img.read(), b'jpeg')
+
+		response = self.client.post('/api/observations/bulk/', batch[:2], format='json')
+		self.assertEqual([result['status'] for result in response.json()['results']], ['duplicate', 'duplicate'])
+		self.assertEqual([result['key'] for result in response.json()['results']], [results[0]['key'], results[1]['key']])
+		self.assertEqual(SurveyData.objects.filter(owner=self.user).count(), 2)
+
+	def test_concurrent_retry(self):
+		"""Test the rows a concurrent retry committed first are reported as duplicates and counted once."""
+		image = {'image': 'data:image/jpeg;base64,' + base64.b64encode(b'jpeg').decode('ascii')}
+		concurrent = self.create_observation(client_id='b')
+		lookup = views.clientObservations
+		lookups = []
+		def stale_lookup(user, clientIds):
+			# the concurrent row is committed after this request looked for the existing ones
+			lookups.append(clientIds)
+			return {} if len(lookups) == 1 else lookup(user, clientIds)
+		with mock.patch.object(views, 'clientObservations', stale_lookup):
+			response = self.client.post('/api/observations/bulk/', [self.observation('a', images=[image]),
+				self.observation('b', images=[image])], format='json')
+
+		results = response.json()['results']
+		self.assertEqual([result['status'] for result in results], ['created', 'duplicate'])
+		self.assertEqual(results[1]['key'], concurrent.id)
+		# the failed insert was retried without the row of the concurrent request
+		self.assertEqual(len(lookups), 4)
+		self.assertFalse(Photo.objects.filter(survey_data=concurrent).exists())
+		self.assertEqual(Photo.objects.filter(survey_data_id=results[0]['key']).count(), 1)
+		self.assertEqual(sum(ObservationStats.objects.values_list('count', flat=True)), 2)
+
+	def test_not_a_list(self):
+		"""Test the body must be a list of observations."""
+		response = self.client.post('/api/observations/bulk/', self.observation('a'), format='json')
+		self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class RequestLogTestCase(UserDataTestCase):
+	"""Test suite for the structured request log."""
+
+	def test_add_observation_is_logged(self):
+		"""Test adding an observation logs the key fields of the request."""
+		with self.assertLogs('api.requests', level='INFO') as logs:
+			response = self.client.post('/api/aois/{}/observations/'.format(self.aoi.id), {'name': 'obs',
+				'canopy_status': self.canopy.id, 'longitude': 0.5, 'latitude': 0.5}, format='json')
+		fields = logs.records[0].fields
+		self.assertEqual(logs.records[0].getMessage(), 'addObservation')
+		self.assertEqual((fields['user_id'], fields['aoi_id'], fields['status']), (self.user.id, self.aoi.id, 200))
+		self.assertEqual(fields['observation_id'], response.json()['key'])
+		self.assertIn('latency_ms', fields)
+
+	def test_formatter_and_sampling(self):
+		"""Test the records are written as JSON and only sampled below WARNING."""
+		record = logging.LogRecord('api.requests', logging.INFO, __file__, 1, 'event', None, None)
+		record.fields = {'status': 200}
+		self.assertEqual(json.loads(StructuredFormatter().format(record))['status'], 200)
+		self.assertFalse(SamplingFilter(0).filter(record))
+		record.levelno = logging.WARNING
+		self.assertTrue(SamplingFilter(0).filter(record))
+
+class AdminExportTestCase(UserDataTestCase):
+	"""Test suite for the admin exports of the observations."""
+
+	def setUp(self):
+		super().setUp()
+		self.species = TreeSpecies.objects.create(name="species")
+		self.admin = SurveyDataAdmin(SurveyData, admin.site)
+
+	def add_observations(self, count):
+		for i in range(count):
+			self.create_observation(tree_species=self.species, longitude=1.5, latitude=2.5)
+
+	def export(self, action):
+		with CaptureQueriesContext(connection) as queries:
+			content = b''.join(getattr(self.admin, action)(None, SurveyData.objects.all()).streaming_content)
+		return len(queries), content.decode('utf-8')
+
+	def test_geojson_export(self):
+		"""Test the GeoJSON export is valid and runs a constant number of queries."""
+		self.add_observations(1)
+		small_count, small = self.export('export_as_geojson')
+		self.add_observations(4)
+		large_count, large = self.export('export_as_geojson')
+
+		self.assertEqual(small_count, large_count)
+		features = json.loads(large)['features']
+		self.assertEqual(len(features), 5)
+		self.assertEqual(features[0]['geometry']['coordinates'], [1.5, 2.5])
+		self.assertEqual(features[0]['properties']['tree_species'], 'species')
+		self.assertEqual(features[0]['properties']['owner'], 'owner')
+
+	def test_csv_export(self):
+		"""Test the CSV export has a header and a row per observation."""
+		self.add_observations(3)
+		count, content = self.export('export_as_csv')
+		rows = list(csv.reader(io.StringIO(content)))
+		self.assertEqual(len(rows), 4)
+		self.assertEqual(rows[1][rows[0].index('canopy_status')], 'healthy')
+
+	def test_geodataframe(self):
+		"""Test the GeoDataFrame has a label per foreign key and a point per observation."""
+		self.add_observations(3)
+		with CaptureQueriesContext(connection) as queries:
+			gdf = self.admin.create_geodataframe(SurveyData.objects.all())
+		self.assertEqual(len(gdf), 3)
+		self.assertLessEqual(len(queries), 1 + len([f for f in SurveyData._meta.fields if f.is_relation]))
+		self.assertNotIn('creation_date', gdf.columns)
+		self.assertEqual(gdf.iloc[0]['tree_species'], 'species')
+		self.assertEqual(gdf.iloc[0]['crown_diameter'], 'None')
+		self.assertEqual((gdf.iloc[0].geometry.x, gdf.iloc[0].geometry.y), (1.5, 2.5))
+
+
+@override_settings(EXPORT_WORKERS=0)
+class ExportJobTestCase(UserDataTestCase):
+	"""Test suite for the admin exports built in the background."""
+
+	def setUp(self):
+		super().setUp()
+		self.temporary_directory(EXPORT_ROOT='')
+		self.user.is_staff = self.user.is_superuser = True
+		self.user.save()
+		self.ids = [self.create_observation(longitude=1.5, latitude=2.5).id for i in range(3)]
+		self.client = Client()
+		self.client.force_login(self.user)
+
+	def export(self, action):
+		with self.captureOnCommitCallbacks(execute=True):
+			response = self.client.post(reverse('admin:api_surveydata_changelist'),
+				{'action': action, '_selected_action': self.ids[:2]})
+		self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+		return ExportJob.objects.get()
+
+	def test_export_job(self):
+		"""Test an export action queues a job whose file can be downloaded."""
+		job = self.export('export_as_geopackage_pandas')
+		self.assertEqual(job.status, ExportJob.DONE)
+		self.assertEqual(job.progress, 100)
+		self.assertEqual(len(gpd.read_file(job.path)), 2)
+
+		response = self.client.get(reverse('admin:api_exportjob_download', args=(job.pk,)))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertIn('surveydata.gpkg', response['Content-Disposition'])
+		response.close()
+		self.assertTrue(os.path.exists(job.path))
+
+	def test_export_changelist(self):
+		"""Test exporting every row of the filtered changelist keeps its filters, and the worker rebuilds the rows from them."""
+		SurveyData.objects.filter(id=self.ids[2]).update(name="elm")
+		with self.captureOnCommitCallbacks(execute=True):
+			self.client.post(reverse('admin:api_surveydata_changelist') + '?q=elm',
+				{'action': 'export_as_geopackage_pandas', 'select_across': '1', '_selected_action': self.ids[:1]})
+		job = ExportJob.objects.get()
+		self.assertEqual(json.loads(job.selection), {'changelist': 'q=elm'})
+		self.assertEqual((job.status, job.rows), (ExportJob.DONE, 1))
+		self.assertEqual(list(gpd.read_file(job.path)['name']), ["elm"])
+
+	def test_export_selection(self):
+		"""Test exporting the selected rows stores their keys."""
+		job = self.export('export_as_geopackage_pandas')
+		self.assertEqual(json.loads(job.selection), {'pks': self.ids[:2]})
+		self.assertEqual(job.rows, 2)
+
+	def test_shapefile_export(self):
+		"""Test a shapefile is exported as a zip archive."""
+		job = self.export('export_as_shapefile_pandas')
+		self.assertEqual(job.status, ExportJob.DONE)
+		self.assertTrue(job.file.endswith('.zip'))
+
+	def test_purge_exports(self):
+		"""Test the expired exports are deleted with their file."""
+		job = self.export('export_as_shapefile_pandas')
+		ExportJob.objects.update(expires_at=job.creation_date)
+		call_command('purge_exports', stdout=io.StringIO())
+		self.assertFalse(ExportJob.objects.exists())
+		self.assertFalse(os.path.exists(job.path))
+
+	def test_stale_exports(self):
+		"""Test the jobs lost with a restarted web worker are marked as failed."""
+		with self.captureOnCommitCallbacks():
+			job = queue_export(self.user, SurveyData.objects.filter(id__in=self.ids), 'csv')
+		self.assertEqual(job.rows, 3)
+		call_command('purge_exports', stdout=io.StringIO())
+		self.assertEqual(ExportJob.objects.get().status, ExportJob.PENDING)
+
+		ExportJob.objects.update(update_date=timezone.now() - settings.EXPORT_STALE_AFTER * 2)
+		call_command('purge_exports', stdout=io.StringIO())
+		self.assertEqual(ExportJob.objects.get().status, ExportJob.FAILED)
+
+
+@override_settings(EXPORT_WORKERS=1)
+class ExportPoolTestCase(UserDataMixin, TransactionTestCase):
+	"""Test suite for the exports built by the pool of export processes."""
+
+	def setUp(self):
+		if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+			self.skipTest('the export processes cannot open an in-memory test database')
+		super().setUp()
+		self.temporary_directory(EXPORT_ROOT='')
+		self.addCleanup(exports.shutdown_executor)
+
+	def test_export_in_pool(self):
+		"""Test a job queued from the web worker is built by an export process."""
+		for i in range(3):
+			self.create_observation(longitude=1.5, latitude=2.5)
+
+		job = queue_export(self.user, SurveyData.objects.filter(name="obs"), 'csv')
+		for i in range(600):
+			job.refresh_from_db()
+			if job.status in (ExportJob.DONE, ExportJob.FAILED):
+				break
+			time.sleep(0.1)
+		self.assertEqual(job.status, ExportJob.DONE, job.error)
+		with open(job.path) as exported:
+			self.assertEqual(len(list(csv.DictReader(exported))), 3)
+
+
+class TileTestCase(UserDataTestCase):
+	"""Test suite for the observation clusters served as map tiles."""
+
+	def setUp(self):
+		super().setUp()
+		self.healthy = self.canopy
+		self.dead = CanopyStatus.objects.create(name="dead")
+		for canopy, longitude in ((self.healthy, 1.5), (self.healthy, 1.6), (self.dead, 8.5)):
+			self.create_observation(canopy_status=canopy, longitude=longitude, latitude=2.5)
+
+	def get_tile(self, z, x, y):
+		self.client.force_authenticate(user=User.objects.get(id=self.user.id))
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get('/api/gzs/{}/tiles/{}/{}/{}/'.format(self.gz.id, z, x, y))
+		self.queries = len(queries)
+		return response
+
+	def test_tile_clusters(self):
+		"""Test the observations of a tile are aggregated per cell with a count per canopy status."""
+		clusters = self.get_tile(5, 16, 15).json()['clusters']
+		self.assertEqual([cluster['count'] for cluster in clusters], [2, 1])
+		self.assertEqual(clusters[0]['canopy_status'], {str(self.healthy.id): 2})
+		self.assertAlmostEqual(clusters[0]['position']['longitude'], 1.55)
+		self.assertEqual(clusters[1]['canopy_status'], {str(self.dead.id): 1})
+
+	def test_tile_invalidation(self):
+		"""Test the cached tiles are rebuilt when an observation is added or moved."""
+		self.get_tile(5, 16, 15)
+		self.get_tile(5, 16, 15)
+		self.assertEqual(self.queries, 0)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			self.create_observation(canopy_status=self.dead, longitude=8.6, latitude=2.5)
+		self.assertEqual(sum(cluster['count'] for cluster in self.get_tile(5, 16, 15).json()['clusters']), 4)
+
+		obs = SurveyData.objects.get(longitude=8.6)
+		obs.longitude = -8.6
+		with self.captureOnCommitCallbacks(execute=True):
+			obs.save()
+		self.assertEqual(sum(cluster['count'] for cluster in self.get_tile(5, 16, 15).json()['clusters']), 3)
+		self.assertEqual(sum(cluster['count'] for cluster in self.get_tile(5, 15, 15).json()['clusters']), 1)
+
+	def test_tile_built_before_commit(self):
+		"""Test a tile built from the rows read before a change is committed is not served after it."""
+		build = tiles.build_tile
+		def stale_build(*args):
+			tile = build(*args)
+			# the change is committed while the tile is built from the rows read before it
+			with self.captureOnCommitCallbacks(execute=True):
+				self.create_observation(canopy_status=self.dead, longitude=8.6, latitude=2.5)
+			return tile
+		with mock.patch.object(tiles, 'build_tile', stale_build):
+			self.assertEqual(sum(cluster['count'] for cluster in self.get_tile(5, 16, 15).json()['clusters']), 3)
+		self.assertEqual(sum(cluster['count'] for cluster in self.get_tile(5, 16, 15).json()['clusters']), 4)
+
+	def test_tile_owner(self):
+		"""Test the tiles only hold the observations of the AOIs of the user, of every AOI for the staff."""
+		other = User.objects.create(name="other", username="other", email="other@test.com")
+		aoi = AOI.objects.create(name="aoi", x_min=0, x_max=10, y_min=0, y_max=10, owner=other, geographical_zone=self.gz)
+		self.get_tile(5, 16, 15)
+		with self.captureOnCommitCallbacks(execute=True):
+			SurveyData.objects.create(name="obs", canopy_status=self.dead, owner=other, aoi=aoi, longitude=8.6, latitude=2.5)
+		self.assertEqual(sum(cluster['count'] for cluster in self.get_tile(5, 16, 15).json()['clusters']), 3)
+
+		User.objects.filter(id=self.user.id).update(is_staff=True)
+		self.assertEqual(sum(cluster['count'] for cluster in self.get_tile(5, 16, 15).json()['clusters']), 4)
+
+	def test_tile_access(self):
+		"""Test the tiles of a zone are only served to the users with access to it."""
+		other = GeographicalZone.objects.create(name="other", wms_url="{}", x_min=0, x_max=10, y_min=0, y_max=10)
+		self.client.force_authenticate(user=User.objects.get(id=self.user.id))
+		self.assertEqual(self.client.get('/api/gzs/{}/tiles/0/0/0/'.format(other.id)).status_code, status.HTTP_403_FORBIDDEN)
+		self.assertEqual(self.get_tile(1, 2, 0).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ObservationStatsTestCase(UserDataTestCase):
+	"""Test suite for the precomputed observation statistics."""
+
+	def setUp(self):
+		super().setUp()
+		self.healthy = self.canopy
+		self.dead = CanopyStatus.objects.create(name="dead")
+		self.crown = CrownDiameter.objects.create(name="1")
+
+	def add_observation(self, canopy, crown=None):
+		return self.create_observation(canopy_status=canopy, crown_diameter=crown)
+
+	def get_stats(self):
+		self.client.force_authenticate(user=User.objects.get(id=self.user.id))
+		return self.client.get('/api/gzs/{}/stats/'.format(self.gz.id)).json()
+
+	def test_stats_follow_observations(self):
+		"""Test the statistics are adjusted when observations are added, changed and deleted."""
+		self.add_observation(self.healthy, self.crown)
+		self.add_observation(self.healthy)
+		obs = self.add_observation(self.dead)
+		stats = self.get_stats()
+		self.assertEqual(stats['total'], 3)
+		self.assertEqual(stats['canopy_status'], {str(self.healthy.id): 2, str(self.dead.id): 1})
+		self.assertEqual(stats['crown_diameter'], {str(self.crown.id): 1, 'None': 2})
+		self.assertEqual(stats['aois'][0]['total'], 3)
+
+		obs = SurveyData.objects.get(id=obs.id)
+		obs.canopy_status = self.healthy
+		obs.save()
+		self.assertEqual(self.get_stats()['canopy_status'], {str(self.healthy.id): 3, str(self.dead.id): 0})
+
+		obs.delete()
+		self.assertEqual(self.get_stats()['total'], 2)
+
+	def test_stats_of_the_user(self):
+		"""Test the figures of a user are those of its own AOIs, the staff ones those of every AOI of the zone."""
+		other = User.objects.create(name="other", username="other", email="other@test.com")
+		aoi = AOI.objects.create(name="other", x_min=0, x_max=1, y_min=0, y_max=1, owner=other, geographical_zone=self.gz)
+		self.add_observation(self.healthy)
+		for i in range(3):
+			self.create_observation(canopy_status=self.dead, owner=other, aoi=aoi)
+
+		stats = self.get_stats()
+		self.assertEqual((stats['total'], stats['canopy_status'], stats['crown_diameter']), (1, {str(self.healthy.id): 1}, {'None': 1}))
+		self.assertEqual([aoi['key'] for aoi in stats['aois']], [self.aoi.id])
+
+		User.objects.filter(id=self.user.id).update(is_staff=True)
+		stats = self.get_stats()
+		self.assertEqual((stats['total'], len(stats['aois'])), (4, 2))
+
+	def test_rebuild_stats(self):
+		"""Test rebuild_stats recomputes the same statistics from the observations."""
+		self.add_observation(self.healthy, self.crown)
+		self.add_observation(self.dead)
+		before = self.get_stats()
+		ObservationStats.objects.update(count=0)
+		call_command('rebuild_stats', stdout=io.StringIO())
+		self.assertEqual(self.get_stats(), before)
+		self.assertEqual(ObservationStats.objects.count(), 2)
+
+	def test_concurrent_first_observation(self):
+		"""Test a row inserted by a concurrent transaction is updated rather than duplicated."""
+		ObservationStats.objects.create(aoi=self.aoi, geographical_zone=self.gz, canopy_status=self.healthy, count=1)
+		update = QuerySet.update
+		calls = []
+		def stale_update(queryset, **kwargs):
+			# the first update runs before the concurrent insert is visible
+			calls.append(kwargs)
+			return 0 if len(calls) == 1 else update(queryset, **kwargs)
+		with mock.patch.object(QuerySet, 'update', stale_update):
+			adjust_stats({stats_key(self.aoi.id, self.healthy.id, None): 1})
+		self.assertEqual(list(ObservationStats.objects.values_list('count', flat=True)), [2])
+		with self.assertRaises(IntegrityError), transaction.atomic():
+			ObservationStats.objects.create(aoi=self.aoi, geographical_zone=self.gz, canopy_status=self.healthy, count=1)
+
+	def test_single_row_per_combination(self):
+		"""Test the unique key holds with and without crown diameter, so each delta goes to a single row."""
+		for crown in (self.crown, None):
+			adjust_stats({stats_key(self.aoi.id, self.healthy.id, crown and crown.id): 1})
+			adjust_stats({stats_key(self.aoi.id, self.healthy.id, crown and crown.id): 2})
+			with self.assertRaises(IntegrityError), transaction.atomic():
+				ObservationStats.objects.create(aoi=self.aoi, geographical_zone=self.gz, canopy_status=self.healthy,
+					crown_diameter=crown, crown_key=crown.id if crown else 0, count=1)
+		self.assertEqual(sorted(ObservationStats.objects.values_list('crown_diameter_id', 'crown_key', 'count'), key=str),
+			sorted([(self.crown.id, self.crown.id, 3), (None, 0, 3)], key=str))
+
+
+class BenchmarkTestCase(TemporaryDirectoryMixin, TestCase):
+	"""Test suite for the synthetic dataset and the query benchmark."""
+
+	def test_benchmark_queries(self):
+		"""Test the benchmark seeds a dataset, explains the queries of every hot request and rolls the dataset back."""
+		output = os.path.join(self.temporary_directory(), 'queries.json')
+		call_command('benchmark_queries', zones=1, users=2, aois_per_user=2, observations_per_aoi=3, runs=2,
+			output=output, stdout=io.StringIO())
+		with open(output) as results:
+			queries = json.load(results)['queries']
+
+		self.assertEqual(len(queries), 6)
+		for query in queries:
+			self.assertTrue(query['statements'], query['name'])
+			self.assertTrue(all(statement['plan'] for statement in query['statements']), query['name'])
+		observations = next(query for query in queries if query['name'].startswith('observations of an AOI'))
+		self.assertTrue(any('api_surveydata' in statement['sql'] for statement in observations['statements']))
+		self.assertFalse(SurveyData.objects.exists())
+
+	def test_benchmark_api(self):
+		"""Test the API benchmark sends every route and reports its latencies and queries."""
+		output = os.path.join(self.temporary_directory(), 'api.json')
+		call_command('benchmark_api', zones=1, users=1, aois_per_user=1, observations_per_aoi=5, runs=2,
+			output=output, stdout=io.StringIO())
+		with open(output) as results:
+			results = json.load(results)
+
+		self.assertEqual(results['not_benchmarked'], [])
+		for route in results['routes']:
+			self.assertTrue(all(code.startswith('2') for code in route['status']), route)
+			self.assertIsNotNone(route['p99_ms'])
+			self.assertGreater(route['queries'], 0)
+		self.assertFalse(SurveyData.objects.exists())
+
+	def test_generate_data(self):
+		"""Test generate_data inserts the requested number of rows."""
+		call_command('generate_data', zones=2, users=3, aois_per_user=2, observations_per_aoi=4, photos_per_observation=1,
+			stdout=io.StringIO())
+		self.assertEqual(AOI.objects.count(), 6)
+		self.assertEqual(SurveyData.objects.count(), 24)
+		self.assertEqual(Photo.objects.count(), 24)
+		self.assertEqual(sum(ObservationStats.objects.values_list('count', flat=True)), 24)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ProvisioningTestCase(TemporaryDirectoryMixin, TestCase):
+	"""Test suite for the bulk user provisioning commands."""
+
+	def setUp(self):
+		self.csv = os.path.join(self.temporary_directory(), 'users.csv')
+		with open(self.csv, 'w') as users:
+			users.write('email,name,password,groups\n')
+			users.write('a@test.com,A,secret-a,team;admins\n')
+			users.write('b@test.com,B,secret-b,team\n')
+
+	def test_provision_users(self):
+		"""Test the users of the CSV file are created with a usable password and their groups."""
+		User.objects.create(name="B", username="b", email="b@test.com")
+		call_command('provision_users', self.csv, group=['trainees'], workers=0, stdout=io.StringIO())
+
+		user = User.objects.get(email='a@test.com')
+		self.assertTrue(user.check_password('secret-a'))
+		self.assertEqual(sorted(user.groups.values_list('name', flat=True)), ['admins', 'team', 'trainees'])
+		self.assertFalse(User.objects.get(email='b@test.com').groups.exists())
+
+	def test_hash_passwords_in_processes(self):
+		"""Test the passwords hashed by the pool of processes are the ones given, in order."""
+		passwords = ['secret-{}'.format(i) for i in range(6)]
+		hashes = hash_passwords(passwords, workers=2)
+		self.assertEqual([check_password(password, hashed) for password, hashed in zip(passwords, hashes)], [True] * 6)
+		self.assertFalse(check_password(passwords[0], hashes[1]))
+
+	def test_user_created_meanwhile(self):
+		"""Test a user created by another session while the passwords are hashed is skipped."""
+		hash = provisioning.hash_passwords
+		def concurrent_hash(passwords, workers):
+			User.objects.create(name="A", username="a", email="a@test.com")
+			return hash(passwords, workers)
+		with mock.patch.object(provisioning, 'hash_passwords', concurrent_hash):
+			created, skipped = provisioning.provision_users(provisioning.read_users_csv(self.csv), workers=0)
+		self.assertEqual((created, skipped), (['b@test.com'], ['a@test.com']))
+		self.assertFalse(User.objects.get(email='a@test.com').groups.exists())
+		self.assertTrue(User.objects.get(email='b@test.com').check_password('secret-b'))
+
+	def test_delete_dummy_users(self):
+		"""Test the dummy users and their observations are deleted in batches."""
+		Country.objects.create(name="Country", code="CC")
+		call_command('populate_users', 3, workers=0, stdout=io.StringIO())
+		user = User.objects.get(email='user1@btsf.eu')
+		self.assertTrue(user.check_password('PASSWORD'))
+		gz = GeographicalZone.objects.create(name="zone", wms_url="{}", x_min=0, x_max=10, y_min=0, y_max=10)
+		aoi = AOI.objects.create(name="aoi", x_min=0, x_max=1, y_min=0, y_max=1, owner=user, geographical_zone=gz)
+		SurveyData.objects.create(name="obs", canopy_status=CanopyStatus.objects.create(name="status"), owner=user, aoi=aoi,
+			longitude=0.5, latitude=0.5)
+
+		call_command('delete_dummy_users', interactive=False, batch_size=2, stdout=io.StringIO())
+		self.assertFalse(User.objects.exists())
+		self.assertFalse(SurveyData.objects.exists())
+		connection.check_constraints()
+
+
+class MetricsTestCase(UserDataTestCase):
+	"""Test suite for the request metrics of the api views."""
+
+	def setUp(self):
+		super().setUp()
+		metrics.registry.clear()
+
+	def test_server_timing(self):
+		"""Test the responses of the api views carry their wall time, queries and serializer time."""
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get('/api/gzs/{}/aois/'.format(self.gz.id))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		timing = response['Server-Timing']
+		self.assertIn('app;dur=', timing)
+		self.assertIn('db;dur=', timing)
+		self.assertIn('desc="{} queries"'.format(len(queries)), timing)
+		self.assertIn('serializer;dur=', timing)
+		self.assertNotIn('Server-Timing', self.client.get('/settings/login/'))
+
+	def test_metrics_endpoint(self):
+		"""Test the metrics are aggregated per view and served to the allowed addresses only."""
+		self.client.get('/api/gzs/{}/aois/'.format(self.gz.id))
+		self.client.get('/api/gzs/{}/aois/'.format(self.gz.id))
+		self.client.get('/api/aois/0/observations/')
+
+		stats = metrics.registry.views[('aoiView', 'GET')]
+		self.assertEqual(stats.count, 2)
+		self.assertGreater(stats.queries, 0)
+		self.assertGreater(stats.serializer_time, 0)
+		self.assertGreater(stats.response_bytes, 0)
+
+		body = Client().get('/metrics/').content.decode()
+		self.assertIn('api_requests_total{view="aoiView",method="GET",status="200"} 2', body)
+		self.assertIn('api_requests_total{view="aoiObservationsView",method="GET",status="404"} 1', body)
+		self.assertIn('api_request_duration_seconds_count{view="aoiView",method="GET"} 2', body)
+		self.assertIn('api_request_duration_seconds_bucket{view="aoiView",method="GET",le="+Inf"} 2', body)
+
+		response = Client(REMOTE_ADDR='10.0.0.1').get('/metrics/')
+		self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class CompactResponseTestCase(UserDataTestCase):
+	"""Test suite for the compact observation listings and the response compression."""
+
+	def setUp(self):
+		super().setUp()
+		self.species = TreeSpecies.objects.create(name="oak")
+		self.observations = [self.create_observation(name="obs{}".format(i), tree_species=self.species, longitude=i, latitude=2.5)
+			for i in range(3)]
+		self.photo = Photo.objects.create(survey_data=self.observations[0])
+
+	def test_compact_observations(self):
+		"""Test the compact listing sends the observations as columns with the lookups as ids."""
+		results = self.client.get('/api/aois/{}/observations/?compact=1'.format(self.aoi.id)).json()['results']
+		self.assertEqual(results['key'], [obs.id for obs in self.observations])
+		self.assertEqual(results['tree_species'], [self.species.id] * 3)
+		self.assertEqual(results['crown_diameter'], [None] * 3)
+		self.assertEqual(results['longitude'], [0, 1, 2])
+		self.assertEqual(results['images'], [[self.photo.id], [], []])
+
+	def test_compact_aois(self):
+		"""Test the compact AOI listing matches the full one, with the observations as columns."""
+		full = self.client.get('/api/gzs/{}/aois/'.format(self.gz.id)).json()
+		with CaptureQueriesContext(connection) as queries:
+			columns = self.client.get('/api/gzs/{}/aois/?compact=1'.format(self.gz.id)).json()
+		self.assertEqual(columns[0]['bbox'], full[0]['bbox'])
+		self.assertEqual(columns[0]['obs']['name'], [obs['name'] for obs in full[0]['obs']])
+		self.assertEqual(columns[0]['obs']['canopy_status'], [obs['canopy_status']['key'] for obs in full[0]['obs']])
+		self.assertLessEqual(len([query for query in queries if 'api_surveydata' in query['sql']]), 1)
+
+	@skipIf(compact.msgpack is None, 'msgpack is not installed')
+	def test_msgpack(self):
+		"""Test the clients accepting MessagePack get the compact form in MessagePack."""
+		response = self.client.get('/api/observations/{}/'.format(self.observations[0].id), HTTP_ACCEPT='application/msgpack')
+		self.assertEqual(response['Content-Type'], 'application/msgpack')
+		self.assertEqual(compact.msgpack.unpackb(response.content)['images'], [[self.photo.id]])
+
+	def test_compression(self):
+		"""Test the large bodies are compressed, the small ones and the photos are not."""
+		for i in range(30):
+			self.create_observation(name="observation", longitude=i, latitude=i)
+		response = self.client.get('/api/gzs/{}/aois/'.format(self.gz.id), HTTP_ACCEPT_ENCODING='gzip')
+		self.assertEqual(response['Content-Encoding'], 'gzip')
+		self.assertEqual(len(json.loads(gzip.decompress(response.content))[0]['obs']), 33)
+
+		response = self.client.get('/api/users/', HTTP_ACCEPT_ENCODING='gzip')
+		self.assertFalse(response.has_header('Content-Encoding'))
+
+
+class ReadersTestCase(UserDataTestCase):
+	"""Test suite for the read paths building the observation listings without the serializers."""
+
+	def setUp(self):
+		super().setUp()
+		self.country = Country.objects.create(name="Country", code="CC")
+		self.user.country = self.country
+		self.user.save()
+		species = TreeSpecies.objects.create(name="oak")
+		crown = CrownDiameter.objects.create(name="0.1")
+		# an AOI without observations
+		AOI.objects.create(name="empty", x_min=0, x_max=10, y_min=0, y_max=10, owner=self.user, geographical_zone=self.gz)
+		self.create_observation(name="full", tree_species=species, crown_diameter=crown, comment="é \"quoted\"",
+			longitude=1.25, latitude=2.5)
+		obs = self.create_observation(name="bare", longitude=-1, latitude=0)
+		Photo.objects.create(survey_data=obs)
+		Photo.objects.create(survey_data=obs)
+		self.request = type('Request', (), {'user': self.user})()
+
+	def test_identical_observations(self):
+		"""Test read_observations gives the JSON of SurveyDataSerializer and SyncSurveyDataSerializer."""
+		objs = SurveyData.objects.order_by('id')
+		expected = SurveyDataSerializer(objs.for_read(), context={'request': self.request}, many=True).data
+		self.assertEqual(JsonResponse(read_observations(objs), safe=False).content, JsonResponse(expected, safe=False).content)
+		self.assertEqual(JsonResponse(read_observations(list(objs.for_read())), safe=False).content,
+			JsonResponse(expected, safe=False).content)
+
+		expected = SyncSurveyDataSerializer(objs.for_read(), context={'request': self.request}, many=True).data
+		self.assertEqual(JsonResponse(read_observations(objs, with_aoi=True), safe=False).content, JsonResponse(expected, safe=False).content)
+
+	def test_identical_aois(self):
+		"""Test read_aois gives the JSON of AOIReadSerializer, in a fixed number of queries."""
+		aois = AOI.objects.order_by('id')
+		expected = AOIReadSerializer(aois.with_observations(self.user), context={'request': self.request}, many=True).data
+		with CaptureQueriesContext(connection) as queries:
+			body = JsonResponse(read_aois(aois, self.user), safe=False).content
+		self.assertEqual(body, JsonResponse(expected, safe=False).content)
+		self.assertEqual(len(queries), 3)
+
+	def test_identical_country(self):
+		"""Test the country of the user data matches CountrySerializer, with or without a country."""
+		self.assertEqual(read_country(self.country), CountrySerializer(self.country).data)
+		self.assertEqual(read_country(None), CountrySerializer(None).data)
+
+	def test_benchmark_serializers(self):
+		"""Test the serializer benchmark reports identical bodies for both paths."""
+		output = os.path.join(self.temporary_directory(), 'serializers.json')
+		call_command('benchmark_serializers', observations=20, runs=1, output=output, stdout=io.StringIO())
+		with open(output) as results:
+			results = json.load(results)
+		self.assertTrue(all(listing['identical'] for listing in results['listings']), results)
+		self.assertEqual(results['listings'][0]['rows'], 20)
+
+
+class ObservationUpdateTestCase(UserDataTestCase):
+	"""Test suite for the versioned updates of the observations."""
+
+	def setUp(self):
+		super().setUp()
+		self.healthy = self.canopy
+		self.dead = CanopyStatus.objects.create(name="dead")
+		with self.captureOnCommitCallbacks(execute=True):
+			self.obs = self.create_observation(longitude=1, latitude=1)
+		self.photos = [Photo.objects.create(survey_data=self.obs) for i in range(2)]
+
+	def put(self, **kwargs):
+		data = {'name': 'changed', 'canopy_status': self.dead.id, 'aoi': self.aoi.id, 'longitude': 2, 'latitude': 2,
+			'images': [self.photos[0].id]}
+		data.update(kwargs.pop('data', {}))
+		with self.captureOnCommitCallbacks(execute=True):
+			return self.client.put('/api/observations/{}/'.format(self.obs.id), data, format='json', **kwargs)
+
+	def test_update_if_match(self):
+		"""Test an update from the current version is applied with its photos pruned and its statistics moved."""
+		etag = self.client.get('/api/observations/{}/'.format(self.obs.id))['ETag']
+		self.assertEqual(etag, '"1"')
+		response = self.put(HTTP_IF_MATCH=etag)
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertEqual(response['ETag'], '"2"')
+		self.assertEqual(response.json()['version'], 2)
+
+		obs = SurveyData.objects.get(id=self.obs.id)
+		self.assertEqual((obs.name, obs.canopy_status_id, obs.longitude, obs.version), ('changed', self.dead.id, 2, 2))
+		self.assertGreater(obs.update_date, self.obs.update_date)
+		self.assertEqual(list(obs.photo_set.values_list('id', flat=True)), [self.photos[0].id])
+		self.assertEqual(dict(ObservationStats.objects.filter(count__gt=0).values_list('canopy_status_id', 'count')), {self.dead.id: 1})
+
+	def test_update_conflict(self):
+		"""Test an update from an outdated version is refused with the current observation."""
+		self.put(data={'version': 1})
+		response = self.put(data={'version': 1, 'name': 'stale', 'images': []})
+		self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+		self.assertEqual(response['ETag'], '"2"')
+		self.assertEqual(response.json()['observation']['name'], 'changed')
+		self.assertEqual(SurveyData.objects.get(id=self.obs.id).name, 'changed')
+
+		response = self.put(HTTP_IF_MATCH='W/"1"')
+		self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+		self.assertEqual(self.put(HTTP_IF_MATCH='"x"').status_code, status.HTTP_400_BAD_REQUEST)
+
+	def test_photo_added_meanwhile(self):
+		"""Test a photo added by another device makes the updates from the version before it conflict."""
+		self.temporary_directory(MEDIA_ROOT='')
+		response = self.client.post('/api/images/', {'survey_data': self.obs.id, 'image': 'data:image/jpeg;base64,AAAA'}, format='json')
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertEqual(SurveyData.objects.get(id=self.obs.id).version, 2)
+
+		# the stale device would prune the new photo
+		self.assertEqual(self.put(data={'version': 1}).status_code, status.HTTP_409_CONFLICT)
+		self.assertTrue(Photo.objects.filter(id=response.json()['key']).exists())
+
+	def test_invalid_version(self):
+		"""Test a version that is not a number is refused."""
+		for version in ([1], {'v': 1}, True, 'x'):
+			self.assertEqual(self.put(data={'version': version}).status_code, status.HTTP_400_BAD_REQUEST, version)
+		self.assertEqual(SurveyData.objects.get(id=self.obs.id).version, 1)
+
+	def test_update_without_version(self):
+		"""Test the clients sending no version still update the observation."""
+		self.put()
+		response = self.put(data={'name': 'again'})
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertEqual(SurveyData.objects.get(id=self.obs.id).version, 3)
+
+
+class OwnershipTestCase(UserDataTestCase):
+	"""Test suite for the ownership checks done in the lookups of the protected views."""
+
+	def setUp(self):
+		super().setUp()
+		self.other = User.objects.create(name="other", username="other", email="other@test.com")
+		self.obs = self.create_observation(longitude=1, latitude=1)
+
+	def request(self, user, method, path, data=None):
+		self.client.force_authenticate(user=user)
+		with CaptureQueriesContext(connection) as queries:
+			response = getattr(self.client, method)(path, data, format='json')
+		self.queries = queries.captured_queries
+		return response.status_code
+
+	def test_forbidden_and_missing(self):
+		"""Test the rows of another user give a 403 and the missing rows a 404."""
+		observation = {'name': 'new', 'canopy_status': self.canopy.id, 'longitude': 1, 'latitude': 1}
+		for method, path, data in (
+				('delete', '/api/aois/{}/', None),
+				('get', '/api/aois/{}/observations/', None),
+				('post', '/api/aois/{}/observations/', observation)):
+			self.assertEqual(self.request(self.other, method, path.format(self.aoi.id), data), status.HTTP_403_FORBIDDEN, path)
+			self.assertEqual(self.request(self.other, method, path.format(0), data), status.HTTP_404_NOT_FOUND, path)
+		for method, data in (('put', dict(observation, aoi=self.aoi.id)), ('delete', None)):
+			self.assertEqual(self.request(self.other, method, '/api/observations/{}/'.format(self.obs.id), data), status.HTTP_403_FORBIDDEN)
+			self.assertEqual(self.request(self.other, method, '/api/observations/0/', data), status.HTTP_404_NOT_FOUND)
+		self.assertEqual(self.request(self.other, 'post', '/api/images/', {'survey_data': self.obs.id, 'image': 'data:image/png;base64,AAAA'}),
+			status.HTTP_403_FORBIDDEN)
+		self.assertTrue(AOI.objects.filter(id=self.aoi.id).exists())
+		self.assertTrue(SurveyData.objects.filter(id=self.obs.id).exists())
+
+	def test_delete_observation(self):
+		"""Test the owner deletes an observation in a single lookup, without loading the user."""
+		self.assertEqual(self.request(self.user, 'delete', '/api/observations/{}/'.format(self.obs.id)), status.HTTP_200_OK)
+		self.assertFalse(SurveyData.objects.filter(id=self.obs.id).exists())
+		self.assertTrue(any('DELETE FROM "api_surveydata"' in query['sql'] for query in self.queries))
+		self.assertFalse(any('FROM "api_user"' in query['sql'] for query in self.queries))
+
+
+class SoftDeleteTestCase(UserDataTestCase):
+	"""Test suite for the soft delete of the AOIs and the purge of their observations."""
+
+	def setUp(self):
+		super().setUp()
+		self.obs = [self.create_observation(name="obs{}".format(i), longitude=1 + i / 10, latitude=1) for i in range(5)]
+		Photo.objects.create(survey_data=self.obs[0], image="data:image/jpeg;base64,AAAA")
+
+	def test_delete_hides_the_aoi(self):
+		"""Test a deleted AOI and its observations are gone from the reads while the purge has not run."""
+		# the purge is left out, as if the background worker had not run yet
+		with self.captureOnCommitCallbacks() as callbacks:
+			response = self.client.delete('/api/aois/{}/'.format(self.aoi.id))
+		self.assertEqual(response.status_code, status.HTTP_200_OK)
+		self.assertEqual(len(callbacks), 1)
+		self.assertTrue(AOI.objects.get(id=self.aoi.id).is_deleted)
+		self.assertEqual(SurveyData.objects.filter(aoi=self.aoi).count(), 5)
+
+		self.assertEqual(json.loads(self.client.get('/api/gzs/{}/aois/'.format(self.aoi.geographical_zone_id)).content), [])
+		for method, path in (
+				('get', '/api/aois/{}/observations/'.format(self.aoi.id)),
+				('delete', '/api/aois/{}/'.format(self.aoi.id)),
+				('put', '/api/observations/{}/'.format(self.obs[0].id)),
+				('delete', '/api/observations/{}/'.format(self.obs[0].id))):
+			self.assertEqual(getattr(self.client, method)(path).status_code, status.HTTP_404_NOT_FOUND, path)
+		self.assertEqual(json.loads(self.client.get('/api/observations/{}/'.format(self.obs[1].id)).content), [])
+
+	def test_purge(self):
+		"""Test the purge deletes the observations in batches, then the AOI."""
+		AOI.objects.filter(id=self.aoi.id).update(is_deleted=True)
+		with CaptureQueriesContext(connection) as queries:
+			self.assertEqual(purge_aoi(self.aoi.id, batch_size=2, pause=0), 5)
+		self.assertEqual(sum('DELETE FROM "api_surveydata"' in query['sql'] for query in queries.captured_queries), 3)
+		self.assertFalse(AOI.objects.filter(id=self.aoi.id).exists())
+		self.assertFalse(SurveyData.objects.filter(aoi_id=self.aoi.id).exists())
+		self.assertFalse(Photo.objects.exists())
+		self.assertFalse(ObservationStats.objects.filter(aoi_id=self.aoi.id).exists())
+		# the AOI alone is reported as deleted to the sync
+		self.assertEqual(list(Tombstone.objects.values_list('kind', 'object_id')), [(Tombstone.AOI, self.aoi.id)])
+
+	def test_purge_command(self):
+		"""Test the command purges the deleted AOIs only."""
+		other = AOI.objects.create(name="other", x_min=0, x_max=10, y_min=0, y_max=10, owner=self.user, geographical_zone=self.aoi.geographical_zone)
+		AOI.objects.filter(id=self.aoi.id).update(is_deleted=True)
+		call_command('purge_deleted_aois', '--pause', '0', stdout=io.StringIO())
+		self.assertEqual(list(AOI.objects.values_list('id', flat=True)), [other.id])
@@ -0,0 +1,125 @@
+import json
+import math
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Avg, Count, F
+from django.db.models.functions import Floor
+
+from .caching import get_version
+from .models import AOI, SurveyData
+
+# Observation tiles
+# ------------------------------------------------------------------------------
+# The maps request the observations of a zone as web mercator tiles (z/x/y, as in
+# OpenStreetMap). Each tile is split in a CLUSTER_GRID x CLUSTER_GRID grid and the
+# observations of each cell are aggregated in the database into one cluster, with
+# its count per canopy status. As the other reads, the tiles of a user only hold the
+# observations of their own AOIs, the staff get those of every AOI of the zone. The
+# tiles are kept in the shared cache, each one under its own version, and an observation
+# added, moved or deleted only bumps the versions of the tiles containing its old and
+# new positions, one per zoom level, those of the owner of its AOI and those of the
+# staff. The versions are bumped once the change is committed, a tile built from the
+# rows read before is then cached under a version no longer used.
+
+MAX_ZOOM = 20
+CLUSTER_GRID = 8
+TILE_TIMEOUT = 24 * 3600
+# web mercator does not go further north or south
+MAX_LATITUDE = 85.0511287798
+
+
+def tile_bounds(z, x, y):
+	"""(minx, miny, maxx, maxy) in decimal degrees of the tile x, y at zoom z."""
+	n = 2 ** z
+	minx = x / n * 360 - 180
+	maxx = (x + 1) / n * 360 - 180
+	maxy = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+	miny = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+	return minx, miny, maxx, maxy
+
+
+def tile_at(z, longitude, latitude):
+	"""(x, y) of the tile containing the position at zoom z."""
+	n = 2 ** z
+	latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+	x = int((longitude + 180) / 360 * n)
+	y = int((1 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 * n)
+	return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def is_valid_tile(z, x, y):
+	return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_key(gz, owner, z, x, y):
+	return 'tile:{0}:{1}:{2}:{3}:{4}'.format(gz, 'all' if owner is None else owner, z, x, y)
+
+
+def build_tile(gz, z, x, y, owner=None):
+	"""The clusters of the observations of the zone gz inside the tile, of the AOIs of the user id owner unless None."""
+	minx, miny, maxx, maxy = tile_bounds(z, x, y)
+	width = (maxx - minx) / CLUSTER_GRID
+	height = (maxy - miny) / CLUSTER_GRID
+
+	# same bounds as tile_at: west and north edges included, east and south edges excluded
+	rows = SurveyData.objects.filter(aoi__geographical_zone_id=gz, aoi__is_deleted=False)
+	if owner is not None:
+		rows = rows.filter(aoi__owner_id=owner)
+	rows = rows.filter(longitude__gte=minx, longitude__lt=maxx, latitude__gt=miny, latitude__lte=maxy) \
+		.annotate(cx=Floor((F('longitude') - minx) / width), cy=Floor((F('latitude') - miny) / height)) \
+		.values('cx', 'cy', 'canopy_status_id') \
+		.annotate(count=Count('id'), longitude=Avg('longitude'), latitude=Avg('latitude')) \
+		.order_by()
+
+	cells = {}
+	for row in rows:
+		cell = cells.setdefault((row['cy'], row['cx']), {'count': 0, 'longitude': 0.0, 'latitude': 0.0, 'canopy_status': {}})
+		cell['count'] += row['count']
+		cell['longitude'] += row['longitude'] * row['count']
+		cell['latitude'] += row['latitude'] * row['count']
+		cell['canopy_status'][str(row['canopy_status_id'])] = row['count']
+
+	clusters = []
+	for position in sorted(cells):
+		cell = cells[position]
+		clusters.append({
+			'position': {'longitude': cell['longitude'] / cell['count'], 'latitude': cell['latitude'] / cell['count']},
+			'count': cell['count'],
+			'canopy_status': cell['canopy_status'],
+		})
+	return {'z': z, 'x': x, 'y': y, 'clusters': clusters}
+
+
+def get_tile(gz, z, x, y, owner=None):
+	"""JSON body of the tile, from the shared cache when it is still valid."""
+	key = tile_key(gz, owner, z, x, y)
+	key = '{0}:{1}'.format(key, get_version(key + ':version', TILE_TIMEOUT))
+	body = cache.get(key)
+	if body is None:
+		body = json.dumps(build_tile(gz, z, x, y, owner)).encode('utf-8')
+		cache.set(key, body, TILE_TIMEOUT)
+	return body
+
+
+def invalidate_tiles(positions):
+	"""
+		Bump the versions of the cached tiles containing the given (aoi_id, longitude, latitude)
+		positions, once the current transaction is committed.
+	"""
+	positions = {position for position in positions if None not in position}
+	if not positions:
+		return
+	aois = {aoiId: (gz, owner) for aoiId, gz, owner in
+		AOI.objects.filter(id__in={position[0] for position in positions}).values_list('id', 'geographical_zone_id', 'owner_id')}
+	keys = set()
+	for aoi_id, longitude, latitude in positions:
+		if aoi_id in aois:
+			gz, owner = aois[aoi_id]
+			for z in range(MAX_ZOOM + 1):
+				x, y = tile_at(z, longitude, latitude)
+				keys.add(tile_key(gz, None, z, x, y))
+				if owner is not None:
+					keys.add(tile_key(gz, owner, z, x, y))
+	transaction.on_commit(lambda: cache.set_many({key + ':version': uuid.uuid4().hex for key in keys}, TILE_TIMEOUT))
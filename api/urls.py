@@ -7,15 +7,24 @@ from . import views
 urlpatterns = [
     url(r'^gzs/$', views.getGZ),
     url(r'^gzs/(?P<gz>[0-9]+)/aois/$', views.aoiView),
+    url(r'^gzs/(?P<gz>[0-9]+)/tiles/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)/$', views.tileView),
+    url(r'^gzs/(?P<gz>[0-9]+)/stats/$', views.statsView),
     url(r'^aois/(?P<id>[0-9]+)/$', views.deleteAOI),
     url(r'^users/$', views.userView),
-    url(r'^aois/(?P<id>[0-9]+)/observations/$', views.addObservation),
+    url(r'^aois/(?P<id>[0-9]+)/observations/$', views.aoiObservationsView),
     url(r'^observations/(?P<id>[0-9]+)/$', views.observationView),
+    url(r'^observations/bulk/$', views.bulkObservationView),
     url(r'^images/$', views.addImage),
+    url(r'^images/(?P<id>[0-9]+)/(?P<size>thumbnail|medium|original)/$', views.photoView),
     url(r'^species/$', views.getSpecies),
     url(r'^crowns/$', views.getCrowns),
     url(r'^canopies/$', views.getCanopies),
-    url(r'^upload/$', views.fileUploadView)
+    url(r'^reference/$', views.getReference),
+    url(r'^upload/$', views.fileUploadView),
+    url(r'^sync/$', views.syncView),
+    url(r'^observations/(?P<id>[0-9]+)/images/$', views.photoUploadView),
+    url(r'^uploads/$', views.uploadSessionView),
+    url(r'^uploads/(?P<id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})/$', views.uploadChunkView)
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns)
\ No newline at end of file
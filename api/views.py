@@ -1,8 +1,10 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, JsonResponse
 from django.conf import settings as djangoSettings
+from django.core.cache import cache
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
 from django.utils.crypto import get_random_string
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
@@ -12,13 +14,38 @@ from rest_framework.response import Response
 from rest_framework.views import APIView, exception_handler
 from rest_framework.exceptions import Throttled
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags
 
 from .models import *
 from .serializers import *
+from .filters import InvalidFilter, get_bbox
+from .pagination import InvalidCursor, decode_cursor, encode_cursor, paginate_keyset
+from .readers import read_aois, read_observations
+from .compact import COMPACT_FIELDS, compact_aois, compact_observations, compact_response, is_compact
+from .caching import REFERENCE_BUNDLE, get_reference_data, get_user_zone_ids
+from .derivatives import DERIVATIVE_RETRY, generate_derivatives
+from .storage import IMAGE_CONTENT_TYPES, decode_data_uri, image_extension, store_photo, store_photo_stream
+from .log import log_request
+from . import metrics
+from .purge import purge_aoi
+from .tasks import submit, submit_on_commit
+from .stats import adjust_stats, count_observations, zone_stats
+from .tiles import get_tile, invalidate_tiles, is_valid_tile
 
 import random
 import json
 import base64
+import os
+import re
+import time
+
+# bytes read from the request at once when streaming an upload
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# largest batch accepted by bulkObservationView, and rows per INSERT
+BULK_MAX_OBSERVATIONS = 500
+BULK_BATCH_SIZE = 100
 
 def custom_exception_handler(exc, context):
     response = exception_handler(exc, context)
@@ -46,8 +73,20 @@ def getGZ(request):
 def aoiView(request, gz):
 	gzId = int(gz)
 	if request.method == 'GET':
-		aois = AOI.objects.filter(geographical_zone_id=gzId).filter(owner_id=request.user.id)
-		serialized = AOIReadSerializer(aois, context={'request': request}, many=True)
+		aois = AOI.objects.owned_by(request.user).alive().filter(geographical_zone_id=gzId)
+		try:
+			bbox = get_bbox(request)
+		except InvalidFilter:
+			return Response({'error': 'Invalid bbox'}, status=status.HTTP_400_BAD_REQUEST)
+		if bbox:
+			aois = aois.intersecting(bbox)
+		if request.query_params.get('obs') in ('0', 'false'):
+			# observations are then paged through /api/aois/<id>/observations/
+			serialized = AOISummarySerializer(aois, context={'request': request}, many=True)
+		else:
+			if is_compact(request):
+				return compact_response(request, compact_aois(aois, request.user))
+			return JsonResponse(read_aois(aois, request.user), safe=False)
 
 		return JsonResponse(serialized.data, safe=False)
 
@@ -70,16 +109,14 @@ def aoiView(request, gz):
 @permission_classes((IsAuthenticated, ))
 def deleteAOI(request, id):
 	aoiId = int(id)
-	aoi = AOI.objects.filter(id=aoiId)
+	# a single UPDATE, the AOI is then hidden from every read and its observations
+	# are deleted in the background, in batches (see api/purge.py)
+	deleted = AOI.objects.owned_by(request.user).alive().filter(id=aoiId).update(is_deleted=True, update_date=timezone.now())
 
-	if(aoi):
-		if(aoi[0].owner.id == request.user.id):
-			aoi.delete()
-			return Response(status=status.HTTP_200_OK)
-		else:
-			return Response(status=status.HTTP_403_FORBIDDEN)
-	else:
-		return Response(status=status.HTTP_404_NOT_FOUND)
+	if deleted:
+		submit_on_commit(purge_aoi, aoiId)
+		return Response(status=status.HTTP_200_OK)
+	return notOwnedResponse(AOI.objects.alive(), aoiId)
 
 
 # Gets the user data
@@ -90,141 +127,331 @@ def userView(request):
 	return JsonResponse(serialized.data, safe=False)
 
 
-from datetime import datetime
-
-@api_view(['POST'])
+# Pages through the observations of an area of interest or adds a new one
+@api_view(['GET', 'POST'])
 @permission_classes((IsAuthenticated,))
+def aoiObservationsView(request, id):
+	if request.method == 'GET':
+		return listObservations(request, id)
+	else:
+		return addObservation(request, id)
+
+
+def listObservations(request, id):
+	aoiId = int(id)
+	if not AOI.objects.owned_by(request.user).alive().filter(id=aoiId).exists():
+		return notOwnedResponse(AOI.objects.alive(), aoiId)
+
+	objs = SurveyData.objects.owned_by(request.user).filter(aoi_id=aoiId)
+	compact = is_compact(request)
+	objs = objs.only(*COMPACT_FIELDS, 'update_date') if compact else objs.for_read()
+	try:
+		bbox = get_bbox(request)
+	except InvalidFilter:
+		return Response({'error': 'Invalid bbox'}, status=status.HTTP_400_BAD_REQUEST)
+	if bbox:
+		objs = objs.in_bbox(bbox)
+	try:
+		page, cursor = paginate_keyset(objs, request)
+	except InvalidCursor:
+		return Response({'error': 'Invalid cursor or limit'}, status=status.HTTP_400_BAD_REQUEST)
+
+	if compact:
+		return compact_response(request, {'results': compact_observations(page), 'next': cursor})
+
+	return JsonResponse({'results': read_observations(page), 'next': cursor}, safe=False)
+
+
 def addObservation(request, id):
+    started = time.monotonic()
     aoiId = int(id)
-    aoi = AOI.objects.filter(id=aoiId)
-    user_id = request.user.id
-    user = get_object_or_404(User, id=user_id)
-    user_name = user.name
-    user_username = user.username
-
-    print('{timestamp} -- addObservation. User ID: {user_id}, Name: {user_name}, Username: {user_username}, aoi_id: {id_aoi}'.format(
-        timestamp=datetime.utcnow().isoformat(),
-        user_id=user_id,
-        user_name=user_name,
-        user_username=user_username,
-        id_aoi=aoiId
-    ))
-
-    if aoi:
-        aoi = aoi[0]
-        aoi_name = aoi.name
-
-        if aoi.owner.id == request.user.id:
-            data = JSONParser().parse(request)
-            data['aoi'] = aoiId
-            serialized = SurveyDataWriteSerializer(data=data, context={'request': request})
-
-            #print(json.dumps(serialized, indent=2))
-
-            if serialized.is_valid():
-                serialized = serialized.save()
-                serialized = SurveyDataSerializer(serialized, context={'request': request}, many=False)
-
-                print(json.dumps(serialized.data, indent=2))
-
-                print('{timestamp} -- addImage: response. User ID: {user_id}, Name: {user_name}, Username: {user_username}, aoi_id: {id_aoi}, aoi_name: {aoi_name}, data:{data}'.format(
-                    timestamp=datetime.utcnow().isoformat(),
-                    user_id=user_id,
-                    user_name=user_name,
-                    user_username=user_username,
-                    id_aoi=aoiId,
-                    aoi_name=aoi_name,
-                    data=data
-                ))
-                return JsonResponse(serialized.data, safe=False)
-            else:
-                print('{timestamp} -- addObservation: error 400. User ID: {user_id}, Name: {user_name}, Username: {user_username}'.format(
-                    timestamp=datetime.utcnow().isoformat(),
-                    user_id=user_id,
-                    user_name=user_name,
-                    user_username=user_username
-                ))
-                print('Errors:', serialized.errors)
-                return Response(serialized.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        else:
-            print('{timestamp} -- addObservation: error 403. User ID: {user_id}, Name: {user_name}, Username: {user_username}'.format(
-                timestamp=datetime.utcnow().isoformat(),
-                user_id=user_id,
-                user_name=user_name,
-                user_username=user_username
-            ))
+    if AOI.objects.owned_by(request.user).alive().filter(id=aoiId).exists():
+        data = JSONParser().parse(request)
+        data['aoi'] = aoiId
+        serialized = SurveyDataWriteSerializer(data=data, context={'request': request})
 
-            return Response(status=status.HTTP_403_FORBIDDEN)
+        if serialized.is_valid():
+            serialized = serialized.save()
+            obsId = serialized.id
+            serialized = SurveyDataSerializer(serialized, context={'request': request}, many=False)
 
+            log_request(request, 'addObservation', status.HTTP_200_OK, started, aoi_id=aoiId, observation_id=obsId)
+            return JsonResponse(serialized.data, safe=False)
+        else:
+            log_request(request, 'addObservation', status.HTTP_400_BAD_REQUEST, started, aoi_id=aoiId, errors=serialized.errors)
+            return Response(serialized.errors, status=status.HTTP_400_BAD_REQUEST)
     else:
-        print('{timestamp} -- addObservation: error 404. User ID: {user_id}, Name: {user_name}, Username: {user_username}'.format(
-            timestamp=datetime.utcnow().isoformat(),
-            user_id=user_id,
-            user_name=user_name,
-            user_username=user_username
-        ))
+        response = notOwnedResponse(AOI.objects.alive(), aoiId)
+        log_request(request, 'addObservation', response.status_code, started, aoi_id=aoiId)
+        return response
 
-        return Response(status=status.HTTP_404_NOT_FOUND)
 
 
+# Adds a batch of observations, with their photos, in one transaction
+@api_view(['POST'])
+@permission_classes((IsAuthenticated, ))
+def bulkObservationView(request):
+	items = request.data
+	if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+		return Response({'error': 'Expected a list of observations'}, status=status.HTTP_400_BAD_REQUEST)
+	if len(items) > BULK_MAX_OBSERVATIONS:
+		return Response({'error': 'At most {} observations per request'.format(BULK_MAX_OBSERVATIONS)}, status=status.HTTP_400_BAD_REQUEST)
+
+	# one query per lookup table and for the AOIs, whatever the number of observations
+	lookups = {
+		'tree_species': set(TreeSpecies.objects.values_list('id', flat=True)),
+		'crown_diameter': set(CrownDiameter.objects.values_list('id', flat=True)),
+		'canopy_status': set(CanopyStatus.objects.values_list('id', flat=True)),
+	}
+	aoiIds = {item.get('aoi') for item in items if isinstance(item.get('aoi'), int)}
+	ownedAOIs = set(AOI.objects.owned_by(request.user).filter(id__in=aoiIds).filter(is_deleted=False).values_list('id', flat=True))
+	otherAOIs = set(AOI.objects.filter(id__in=aoiIds - ownedAOIs).filter(is_deleted=False).values_list('id', flat=True)) if aoiIds - ownedAOIs else set()
+
+	results = []
+	pending = {}
+	for item in items:
+		serialized = SurveyDataBulkSerializer(data=item, context={'request': request, 'lookups': lookups})
+		if not serialized.is_valid():
+			results.append({'client_id': item.get('client_id'), 'status': 'invalid', 'errors': serialized.errors})
+			continue
+
+		data = serialized.validated_data
+		clientId = data['client_id']
+		result = {'client_id': clientId}
+		results.append(result)
+		if data['aoi_id'] in otherAOIs:
+			result['status'] = 'forbidden'
+		elif data['aoi_id'] not in ownedAOIs:
+			result['status'] = 'not_found'
+		elif clientId in pending:
+			result['status'] = 'duplicate'
+		else:
+			pending[clientId] = data
+
+	with transaction.atomic():
+		while True:
+			existing = clientObservations(request.user, pending.keys())
+			new = {clientId: data for clientId, data in pending.items() if clientId not in existing}
+			objs = []
+			for clientId, data in new.items():
+				fields = {key: value for key, value in data.items() if key != 'images'}
+				objs.append(SurveyData(owner_id=request.user.id, **fields))
+			try:
+				with transaction.atomic():
+					SurveyData.objects.bulk_create(objs, batch_size=BULK_BATCH_SIZE)
+				break
+			except IntegrityError:
+				# a concurrent retry of the same batch committed some of the rows first, they are
+				# read again and reported as duplicates, only the rows inserted here are counted
+				if not clientObservations(request.user, new.keys()):
+					raise
+		# bulk_create skips the post_save signal invalidating the map tiles and counting the observations
+		invalidate_tiles((obj.aoi_id, obj.longitude, obj.latitude) for obj in objs)
+		adjust_stats(count_observations(objs))
+
+		# bulk_create does not return the ids on every database backend
+		created = clientObservations(request.user, new.keys())
+
+		photos = []
+		for clientId, data in new.items():
+			for image in data.get('images', []):
+				content, ext = image['image']
+				photo = Photo(survey_data_id=created[clientId], compass=image.get('compass'), comment=image.get('comment'))
+				store_photo(photo, content, ext)
+				photos.append(photo)
+		Photo.objects.bulk_create(photos, batch_size=BULK_BATCH_SIZE)
+
+		if photos:
+			# bulk_create skips the post_save signal scheduling the thumbnails
+			for photoId in Photo.objects.filter(survey_data_id__in=created.values()).values_list('id', flat=True):
+				submit_on_commit(generate_derivatives, photoId)
+
+	for result in results:
+		clientId = result['client_id']
+		if 'status' in result:
+			if result['status'] == 'duplicate' and clientId in pending:
+				result['key'] = existing.get(clientId, created.get(clientId))
+		elif clientId in existing:
+			result.update(status='duplicate', key=existing[clientId])
+		else:
+			result.update(status='created', key=created[clientId])
+
+	return JsonResponse({'results': results}, safe=False)
+
 
 @api_view(['GET', 'PUT', 'DELETE'])
 @permission_classes((IsAuthenticated, ))
 def observationView(request, id):
 	obsId = int(id)
 	if request.method == 'GET':
-		objs = SurveyData.objects.filter(id=obsId).filter(owner_id=request.user.id)
-		serialized = SurveyDataSerializer(objs, context={'request': request}, many=True)
-		return JsonResponse(serialized.data, safe=False)
+		objs = SurveyData.objects.owned_by(request.user).alive().filter(id=obsId)
+		if is_compact(request):
+			observations = compact_observations(objs)
+			versions = observations['version']
+			response = compact_response(request, observations)
+		else:
+			observations = read_observations(objs)
+			versions = [obs['version'] for obs in observations]
+			response = JsonResponse(observations, safe=False)
+		if versions:
+			# sent back in If-Match to update the observation
+			response['ETag'] = observationETag(versions[0])
+		return response
 
 	elif(request.method == 'PUT'):
-		obs = SurveyData.objects.filter(id=obsId)
-
-		if(obs):
-			if(obs[0].owner.id == request.user.id):
-
-				data = JSONParser().parse(request)
-				obj = obs[0]
-
-				#data['tree_specie'] = getTreeSpecie(data['tree_specie'], request)
-				if 'images' in data:
-					imagesToKeep = data['images']
-				else:
-					imagesToKeep = []
-
-				serialized = SurveyDataWriteSerializer(obj, data=data, context={'imagesToKeep': imagesToKeep})
-
-				if(serialized.is_valid()):
-
-					serialized.save()
-					return JsonResponse(serialized.data, safe=False)
+		obj = SurveyData.objects.owned_by(request.user).alive().filter(id=obsId).first()
+		if obj is None:
+			return notOwnedResponse(SurveyData.objects.alive(), obsId)
 
-				return Response(serialized.errors)
+		data = JSONParser().parse(request)
 
-			else:
-				return Response(status=status.HTTP_403_FORBIDDEN)
+		#data['tree_specie'] = getTreeSpecie(data['tree_specie'], request)
+		if 'images' in data:
+			imagesToKeep = data['images']
 		else:
-			return Response(status=status.HTTP_404_NOT_FOUND)
+			imagesToKeep = []
+
+		try:
+			version = expectedVersion(request, data)
+		except ValueError:
+			return Response({'error': 'Invalid version'}, status=status.HTTP_400_BAD_REQUEST)
+		serialized = SurveyDataWriteSerializer(obj, data=data, context={'imagesToKeep': imagesToKeep, 'version': version})
+
+		if(serialized.is_valid()):
+
+			try:
+				serialized.save()
+			except VersionConflict:
+				# the current observation, to be merged by the client
+				current = read_observations(SurveyData.objects.filter(id=obsId))
+				if not current:
+					return Response(status=status.HTTP_404_NOT_FOUND)
+				response = JsonResponse({'error': 'Version conflict', 'observation': current[0]},
+					status=status.HTTP_409_CONFLICT, safe=False)
+				response['ETag'] = observationETag(current[0]['version'])
+				return response
+			response = JsonResponse(serialized.data, safe=False)
+			response['ETag'] = observationETag(obj.version)
+			return response
+
+		return Response(serialized.errors)
 
 	else:
-		obs = SurveyData.objects.filter(id=obsId)
+		deleted, _ = SurveyData.objects.owned_by(request.user).alive().filter(id=obsId).delete()
 
-		if(obs):
+		if deleted:
+			return Response(status=status.HTTP_200_OK)
+		return notOwnedResponse(SurveyData.objects.alive(), obsId)
 
-			if(obs[0].owner.id == request.user.id):
 
-				obj = obs[0]
-				obj.save()
-				return Response(status=status.HTTP_200_OK)
+def clientObservations(user, clientIds):
+	'''
+		Ids of the observations of user with the given client ids, keyed by client id.
+	'''
+	return dict(SurveyData.objects.owned_by(user).filter(client_id__in=clientIds).values_list('client_id', 'id'))
 
-			else:
-				return Response(status=status.HTTP_403_FORBIDDEN)
 
-		else:
-			return Response(status=status.HTTP_404_NOT_FOUND)
+def observationETag(version):
+	return '"{}"'.format(version)
 
 
+def expectedVersion(request, data):
+	'''
+		The version of the observation the client is updating, from the If-Match header or
+		the `version` of the body, None when the client sends neither. Raises ValueError
+		when it is not a version.
+	'''
+	ifMatch = request.META.get('HTTP_IF_MATCH')
+	if ifMatch:
+		etags = parse_etags(ifMatch)
+		if '*' in etags:
+			return None
+		if len(etags) != 1:
+			raise ValueError(ifMatch)
+		# GZipMiddleware weakens the ETags of the responses it compresses
+		version = etags[0][2:] if etags[0].startswith('W/') else etags[0]
+		return int(version.strip('"'))
+	if isinstance(data, dict) and data.get('version') is not None:
+		version = data['version']
+		if isinstance(version, bool) or not isinstance(version, (int, str)):
+			raise ValueError(version)
+		return int(version)
+	return None
+
+
+# Gets the rows created, changed or deleted since the last sync
+@api_view(['GET'])
+@permission_classes((IsAuthenticated, ))
+def syncView(request):
+	# taken before querying so rows written meanwhile are picked up by the next sync
+	now = timezone.now()
+	try:
+		since = getSyncTime(request)
+	except InvalidCursor:
+		return Response({'error': 'Invalid since or token'}, status=status.HTTP_400_BAD_REQUEST)
+	if since and since < now - djangoSettings.TOMBSTONE_TTL:
+		# the tombstones of the deletions since then may be purged, the client starts over
+		since = None
+
+	aois = AOI.objects.owned_by(request.user)
+	objs = SurveyData.objects.owned_by(request.user).filter(aoi__is_deleted=False)
+	photos = Photo.objects.filter(survey_data__owner_id=request.user.id).filter(survey_data__aoi__is_deleted=False)
+	tombstones = Tombstone.objects.filter(owner_id=request.user.id)
+	if since:
+		aois = aois.filter(update_date__gte=since)
+		objs = objs.filter(update_date__gte=since)
+		photos = photos.filter(update_date__gte=since)
+		tombstones = tombstones.filter(deleted_at__gte=since)
+	else:
+		# a first sync is a full snapshot, there is nothing to delete on the client yet
+		tombstones = tombstones.none()
+
+	deleted = {Tombstone.AOI: [], Tombstone.OBSERVATION: [], Tombstone.PHOTO: []}
+	for kind, objectId in tombstones.values_list('kind', 'object_id'):
+		deleted[kind].append(objectId)
+	if since:
+		deleted[Tombstone.AOI] += list(aois.filter(is_deleted=True).values_list('id', flat=True))
+
+	return JsonResponse({
+		'token': encode_cursor(now.isoformat()),
+		'full': since is None,
+		'aois': SyncAOISerializer(aois.filter(is_deleted=False), context={'request': request}, many=True).data,
+		'observations': read_observations(objs, with_aoi=True),
+		'photos': SyncPhotoSerializer(photos.only('id', 'survey_data_id', 'compass', 'comment'), context={'request': request}, many=True).data,
+		'deleted': {
+			'aois': deleted[Tombstone.AOI],
+			'observations': deleted[Tombstone.OBSERVATION],
+			'photos': deleted[Tombstone.PHOTO],
+		},
+	}, safe=False)
+
+
+def getSyncTime(request):
+	'''
+		Read the sync start time from either the opaque `token` returned by the previous sync
+		or an ISO 8601 `since` timestamp. Returns None for a full sync.
+	'''
+	token = request.query_params.get('token')
+	since = request.query_params.get('since')
+	if token:
+		values = decode_cursor(token)
+		since = values[0] if len(values) == 1 else None
+		if not isinstance(since, str):
+			raise InvalidCursor(token)
+	if not since:
+		return None
+
+	try:
+		sinceTime = parse_datetime(since)
+	except ValueError:
+		sinceTime = None
+	if sinceTime is None:
+		raise InvalidCursor(since)
+	if timezone.is_naive(sinceTime):
+		sinceTime = timezone.make_aware(sinceTime, timezone.utc)
+	return sinceTime
+
 
 def getTreeSpecies(idOrName, request):
 	'''
@@ -246,99 +473,291 @@ def getTreeSpecies(idOrName, request):
 @api_view(['POST'])
 @permission_classes((IsAuthenticated,))
 def addImage(request):
-
-    user_id = request.user.id
-    user = get_object_or_404(User, id=user_id)
-    user_name = user.name
-    user_username = user.username
-
-    print('{timestamp} -- addImage. User ID: {user_id}, Name: {user_name}, Username: {user_username}'.format(
-        timestamp=datetime.utcnow().isoformat(),
-        user_id=user_id,
-        user_name=user_name,
-        user_username=user_username
-    ))
-
+    started = time.monotonic()
     data = JSONParser().parse(request)
     serialized = PhotoWriteSerializer(data=data, context={'request': request})
 
     if serialized.is_valid():
-        obs = SurveyData.objects.filter(id=data['survey_data'])
-        if obs:
-            if obs[0].owner.id == request.user.id:
+        # loaded by the validation of the survey_data key, its owner is known without another query
+        obs = serialized.validated_data['survey_data']
+        obsId = obs.id
+        if obs.owner_id == request.user.id:
+
+            serialized = serialized.save()
+            photoId = serialized.id
+
+            serialized = PhotoSerializer(serialized, context={'request': request}, many=False)
+
+            log_request(request, 'addImage', status.HTTP_200_OK, started, observation_id=obsId, photo_id=photoId)
+            return JsonResponse(serialized.data, safe=False)
+
+        else:
+            log_request(request, 'addImage', status.HTTP_403_FORBIDDEN, started, observation_id=obsId)
+            return Response(status=status.HTTP_403_FORBIDDEN)
 
-                serialized = serialized.save()
+    else:
+        log_request(request, 'addImage', status.HTTP_400_BAD_REQUEST, started, errors=serialized.errors)
+        #return Response(serialized.errors, status=503)
+        return Response(serialized.errors, status=status.HTTP_400_BAD_REQUEST)
 
-                serialized = PhotoSerializer(serialized, context={'request': request}, many=False)
 
-                print('{timestamp} -- addImage: response. User ID: {user_id}, Name: {user_name}, Username: {user_username}'.format(
-                    timestamp=datetime.utcnow().isoformat(),
-                    user_id=user_id,
-                    user_name=user_name,
-                    user_username=user_username
-                ))
-                return JsonResponse(serialized.data, safe=False)
 
-            else:
-                print('{timestamp} -- addImage: error 403. User ID: {user_id}, Name: {user_name}, Username: {user_username}'.format(
-                    timestamp=datetime.utcnow().isoformat(),
-                    user_id=user_id,
-                    user_name=user_name,
-                    user_username=user_username
-                ))
+# Adds a photo to an observation from a multipart form (field "image") or a raw image body
+@api_view(['POST'])
+@permission_classes((IsAuthenticated, ))
+def photoUploadView(request, id):
+	obsId = int(id)
+	if not SurveyData.objects.owned_by(request.user).alive().filter(id=obsId).exists():
+		return notOwnedResponse(SurveyData.objects.alive(), obsId)
+
+	if request.content_type.startswith('multipart/form-data'):
+		# Django's upload handlers spool big files to a temporary file while parsing
+		upload = request.FILES.get('image')
+		if upload is None:
+			return Response({'image': ['No file was submitted.']}, status=status.HTTP_400_BAD_REQUEST)
+		stream, size, ext = upload, upload.size, image_extension(upload.content_type)
+		params = request.data
+	else:
+		stream, size, ext = request.stream, int(request.META.get('CONTENT_LENGTH') or 0), image_extension(request.content_type)
+		params = request.query_params
+
+	if ext is None:
+		return Response({'image': ['Unsupported content type.']}, status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+	if not size:
+		return Response({'image': ['The submitted file is empty.']}, status=status.HTTP_400_BAD_REQUEST)
+	if size > djangoSettings.PHOTO_MAX_UPLOAD_SIZE:
+		return Response(status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+	try:
+		compass = float(params['compass']) if params.get('compass') not in (None, '') else None
+	except ValueError:
+		return Response({'compass': ['A valid number is required.']}, status=status.HTTP_400_BAD_REQUEST)
+
+	photo = Photo(survey_data_id=obsId, compass=compass, comment=params.get('comment'))
+	store_photo_stream(photo, stream, ext)
+	with transaction.atomic():
+		photo.save()
+		SurveyData.objects.filter(id=obsId).bump_version()
+
+	serialized = PhotoSerializer(photo, context={'request': request}, many=False)
+	return JsonResponse(serialized.data, safe=False)
 
-                return Response(status=status.HTTP_403_FORBIDDEN)
 
-        else:
-            print('{timestamp} -- addImage: error 503 (2). User ID: {user_id}, Name: {user_name}, Username: {user_username}'.format(
-                timestamp=datetime.utcnow().isoformat(),
-                user_id=user_id,
-                user_name=user_name,
-                user_username=user_username
-            ))
+# Starts a resumable photo upload, the content is then sent in chunks to uploadChunkView
+@api_view(['POST'])
+@permission_classes((IsAuthenticated, ))
+def uploadSessionView(request):
+	data = request.data
+	serialized = UploadSessionSerializer(data=data, context={'request': request})
+	if not serialized.is_valid():
+		return Response(serialized.errors, status=status.HTTP_400_BAD_REQUEST)
 
-            return Response(status=503)
+	if serialized.validated_data['survey_data'].owner_id != request.user.id:
+		return Response(status=status.HTTP_403_FORBIDDEN)
+	if serialized.validated_data['size'] > djangoSettings.PHOTO_MAX_UPLOAD_SIZE:
+		return Response(status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
 
-    else:
+	session = serialized.save()
+	os.makedirs(djangoSettings.UPLOAD_TEMP_DIR, exist_ok=True)
+	open(session.path, 'wb').close()
+	return JsonResponse(UploadSessionSerializer(session).data, safe=False)
 
-        print('{timestamp} -- addImage: error 503 (1). User ID: {user_id}, Name: {user_name}, Username: {user_username}'.format(
-            timestamp=datetime.utcnow().isoformat(),
-            user_id=user_id,
-            user_name=user_name,
-            user_username=user_username
-        ))
 
-        print(serialized.errors)
-        #return Response(serialized.errors, status=503)
-        return Response(serialized.errors, status=status.HTTP_400_BAD_REQUEST)
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
 
+# Gets the offset to resume an upload from (GET) or appends a chunk to it (PUT)
+@api_view(['GET', 'PUT'])
+@permission_classes((IsAuthenticated, ))
+def uploadChunkView(request, id):
+	with transaction.atomic():
+		# the lock serializes the chunks of a session sent concurrently
+		session = UploadSession.objects.select_for_update().filter(id=id).first()
+		if session is None:
+			return Response(status=status.HTTP_404_NOT_FOUND)
+		if session.owner_id != request.user.id:
+			return Response(status=status.HTTP_403_FORBIDDEN)
+
+		if request.method == 'PUT':
+			start = session.received
+			length = int(request.META.get('CONTENT_LENGTH') or 0)
+			contentRange = request.META.get('HTTP_CONTENT_RANGE')
+			if contentRange:
+				match = CONTENT_RANGE.match(contentRange)
+				if match is None:
+					return Response({'error': 'Invalid Content-Range'}, status=status.HTTP_400_BAD_REQUEST)
+				start = int(match.group(1))
+				length = int(match.group(2)) - start + 1
+
+			if start != session.received:
+				# the client is out of sync, it resumes from the offset in the response
+				return JsonResponse(UploadSessionSerializer(session).data, status=status.HTTP_409_CONFLICT, safe=False)
+			if length <= 0 or start + length > session.size:
+				return Response(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+			with open(session.path, 'r+b') as partial:
+				# drops what may be left from a chunk interrupted before it was recorded
+				partial.truncate(start)
+				partial.seek(start)
+				remaining = length
+				while remaining > 0:
+					chunk = request.stream.read(min(remaining, UPLOAD_CHUNK_SIZE))
+					if not chunk:
+						break
+					partial.write(chunk)
+					remaining -= len(chunk)
+			session.received = start + length - remaining
+			session.save(update_fields=['received', 'update_date'])
+
+			if session.received == session.size:
+				photo = Photo(survey_data_id=session.survey_data_id, compass=session.compass, comment=session.comment)
+				with open(session.path, 'rb') as partial:
+					store_photo_stream(photo, partial, session.ext)
+				photo.save()
+				SurveyData.objects.filter(id=session.survey_data_id).bump_version()
+				serialized = UploadSessionSerializer(session).data
+				serialized['photo'] = PhotoSerializer(photo, context={'request': request}, many=False).data
+				os.remove(session.path)
+				session.delete()
+				return JsonResponse(serialized, safe=False)
+
+		return JsonResponse(UploadSessionSerializer(session).data, safe=False)
+
+
+# Gets a photo file in the given size (thumbnail, medium or original)
+@api_view(['GET'])
+@permission_classes((IsAuthenticated, ))
+def photoView(request, id, size):
+	photo = Photo.objects.filter(id=int(id)).filter(survey_data__aoi__is_deleted=False).select_related('survey_data').defer('image').first()
+
+	if photo is None:
+		return Response(status=status.HTTP_404_NOT_FOUND)
+	if photo.survey_data.owner_id != request.user.id:
+		return Response(status=status.HTTP_403_FORBIDDEN)
+
+	if size != 'original' and not getattr(photo, size):
+		# not generated yet by the background workers, or uploaded before they existed: the
+		# original is served meanwhile and the copies are queued, once per DERIVATIVE_RETRY
+		if cache.add('derivatives:{}'.format(photo.id), True, DERIVATIVE_RETRY):
+			submit(generate_derivatives, photo.id)
+		size = 'original'
+
+	if size == 'original' and not photo.img:
+		try:
+			content, ext = decode_data_uri(Photo.objects.values_list('image', flat=True).get(id=photo.id))
+		except ValueError:
+			# a legacy row that is not one of the accepted image types
+			return Response(status=status.HTTP_404_NOT_FOUND)
+		response = HttpResponse(content, content_type=IMAGE_CONTENT_TYPES[ext])
+	else:
+		field = photo.img if size == 'original' else getattr(photo, size)
+		# the copies are always JPEG, the originals are stored under one of the IMAGE_CONTENT_TYPES extensions
+		ext = os.path.splitext(field.name)[1][1:].lower() if size == 'original' else 'jpg'
+		response = FileResponse(field.open('rb'), content_type=IMAGE_CONTENT_TYPES.get(ext, 'application/octet-stream'))
+
+	# a photo key always points to the same content
+	response['Cache-Control'] = 'private, max-age=31536000'
+	response['X-Content-Type-Options'] = 'nosniff'
+	return response
+
+
+def notOwnedResponse(objs, objId):
+	'''
+		Response to a request on a row the owned lookup did not find: 403 when the row exists
+		in objs but belongs to another user, 404 otherwise. Only the refused requests pay its query.
+	'''
+	if objs.filter(id=objId).exists():
+		return Response(status=status.HTTP_403_FORBIDDEN)
+	return Response(status=status.HTTP_404_NOT_FOUND)
 
 
+def zoneAccessError(request, gzId):
+	'''
+		Error response when the geographical zone is not available to the user, None otherwise.
+	'''
+	if gzId in get_user_zone_ids(request.user):
+		return None
+	if GeographicalZone.objects.filter(id=gzId).exists():
+		return Response(status=status.HTTP_403_FORBIDDEN)
+	return Response(status=status.HTTP_404_NOT_FOUND)
+
+
+# Gets the observation clusters of a map tile of a geographical zone
 @api_view(['GET'])
 @permission_classes((IsAuthenticated, ))
-def getSpecies(request):
-	objs = TreeSpecies.objects.all()
-	serialized = TreeSpeciesSerializer(objs, context={'request': request}, many=True)
+def tileView(request, gz, z, x, y):
+	gzId, z, x, y = int(gz), int(z), int(x), int(y)
+	error = zoneAccessError(request, gzId)
+	if error:
+		return error
+	if not is_valid_tile(z, x, y):
+		return Response(status=status.HTTP_404_NOT_FOUND)
 
-	return JsonResponse(serialized.data, safe=False);
+	# the staff see the observations of every AOI of the zone, the other users those of their own AOIs
+	owner = None if request.user.is_staff else request.user.id
+	return HttpResponse(get_tile(gzId, z, x, y, owner), content_type='application/json')
 
 
+# Gets the number of observations of a geographical zone per canopy status and crown diameter
 @api_view(['GET'])
 @permission_classes((IsAuthenticated, ))
-def getCrowns(request):
-	objs = CrownDiameter.objects.all()
-	serialized = CrownDiameterSerializer(objs, context={'request': request}, many=True)
+def statsView(request, gz):
+	gzId = int(gz)
+	error = zoneAccessError(request, gzId)
+	if error:
+		return error
+
+	# the staff see the figures of every AOI of the zone, the other users those of their own AOIs
+	aois = None if request.user.is_staff else AOI.objects.owned_by(request.user).alive()
+	return JsonResponse(zone_stats(gzId, aois), safe=False)
+
+
+# Gets the request metrics of the api views in the Prometheus text format, from the allowed addresses only
+def metricsView(request):
+	if request.META.get('REMOTE_ADDR') not in djangoSettings.METRICS_ALLOWED_IPS:
+		return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+	return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def referenceResponse(request, name):
+	'''
+		Response with a cached reference list. Clients sending back the ETag they got
+		in If-None-Match get a 304 without body as long as the list is unchanged.
+	'''
+	body, etag = get_reference_data(name)
+	# weak comparison (RFC 7232): the compression middleware sends W/ in front of the ETag
+	etags = [tag[2:] if tag.startswith('W/') else tag for tag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
+	if etag in etags or '*' in etags:
+		response = HttpResponseNotModified()
+	else:
+		response = HttpResponse(body, content_type='application/json')
+	response['ETag'] = etag
+	response['Cache-Control'] = 'private, no-cache'
+	return response
+
 
-	return JsonResponse(serialized.data, safe=False);
+# Gets the tree species, crown diameters and canopy statuses in one call
+@api_view(['GET'])
+@permission_classes((IsAuthenticated, ))
+def getReference(request):
+	return referenceResponse(request, REFERENCE_BUNDLE)
 
 
 @api_view(['GET'])
 @permission_classes((IsAuthenticated, ))
-def getCanopies(request):
-	objs = CanopyStatus.objects.all()
-	serialized = CanopyStatusSerializer(objs, context={'request': request}, many=True)
+def getSpecies(request):
+	return referenceResponse(request, 'species')
 
-	return JsonResponse(serialized.data, safe=False);
+
+@api_view(['GET'])
+@permission_classes((IsAuthenticated, ))
+def getCrowns(request):
+	return referenceResponse(request, 'crowns')
+
+
+@api_view(['GET'])
+@permission_classes((IsAuthenticated, ))
+def getCanopies(request):
+	return referenceResponse(request, 'canopies')
 
 
 @api_view(['POST'])
@@ -36,6 +36,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+	'api.middleware.MetricsMiddleware',
+	'api.middleware.CompressionMiddleware',
 	'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -139,6 +141,50 @@ STATIC_ROOT = os.path.join(DATA_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(DATA_DIR, 'media')
 
+# Photo uploads
+# ------------------------------------------------------------------------------
+# largest photo accepted by the binary upload endpoints, in bytes
+PHOTO_MAX_UPLOAD_SIZE = 20 * 1024 * 1024
+# where the chunks of the resumable uploads are kept until the upload is complete
+UPLOAD_TEMP_DIR = os.path.join(DATA_DIR, 'uploads_tmp')
+# unfinished resumable uploads older than this are removed by purge_uploads
+UPLOAD_SESSION_TTL = datetime.timedelta(days=2)
+
+# Sync
+# ------------------------------------------------------------------------------
+# deletion records (tombstones) older than this are removed by purge_tombstones. A client
+# whose last sync is older gets the whole user data again, its deletions may be gone
+TOMBSTONE_TTL = datetime.timedelta(days=90)
+
+# Cache
+# ------------------------------------------------------------------------------
+# Holds the reference lists (species, crowns, canopies) among others. With several
+# web worker processes use a shared backend (memcached, redis, database) so the
+# invalidations done by one process are seen by all the others.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Background tasks (photo thumbnails, ...)
+# ------------------------------------------------------------------------------
+# threads per web worker process running the tasks outside of the request
+BACKGROUND_WORKERS = 2
+
+# Admin exports
+# ------------------------------------------------------------------------------
+# where the finished exports are kept until they are downloaded
+EXPORT_ROOT = os.path.join(DATA_DIR, 'exports')
+# finished exports older than this are removed by purge_exports
+EXPORT_TTL = datetime.timedelta(days=1)
+# pending or running exports without progress for this long were lost with a restarted
+# web worker, purge_exports marks them as failed
+EXPORT_STALE_AFTER = datetime.timedelta(hours=1)
+# processes building the exports, shared by the exports queued from a web worker.
+# 0 builds them in the web worker itself once the request is committed (development)
+EXPORT_WORKERS = 2
+
 # SSL
 # ------------------------------------------------------------------------------
 #SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
@@ -148,10 +194,46 @@ MEDIA_ROOT = os.path.join(DATA_DIR, 'media')
 #CSRF_COOKIE_HTTPONLY = False
 #SESSION_COOKIE_AGE = 900
 
+# Response compression
+# ------------------------------------------------------------------------------
+# smaller bodies are sent as they are, compressing them saves less than it costs
+COMPRESSION_MIN_SIZE = 1024
+
+# Request metrics
+# ------------------------------------------------------------------------------
+# addresses allowed to read /metrics/ (Prometheus), requests from anywhere else get a 404
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# django log level of debug.log, DEBUG writes a line for nearly every request
+DJANGO_LOG_LEVEL = os.getenv('DJANGO_LOG_LEVEL', 'INFO')
+
+# api request log: one JSON line per request written by a background thread.
+# API_LOG_LEVEL=WARNING keeps only the failed requests, API_LOG_SAMPLE_RATE=0.1 keeps
+# one successful request out of ten.
+API_LOG_LEVEL = os.getenv('API_LOG_LEVEL', 'INFO')
+API_LOG_SAMPLE_RATE = float(os.getenv('API_LOG_SAMPLE_RATE', '1'))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            '()': 'api.log.StructuredFormatter',
+        },
+    },
+    'filters': {
+        'sampling': {
+            '()': 'api.log.SamplingFilter',
+            'rate': API_LOG_SAMPLE_RATE,
+        },
+    },
     'handlers': {
+        'api': {
+            'class': 'api.log.QueueHandler',
+            'target': 'logging.StreamHandler',
+            'formatter': 'structured',
+            'filters': ['sampling'],
+        },
         'file': {
             'level': 'DEBUG',
             'class': 'logging.handlers.RotatingFileHandler',
@@ -163,7 +245,7 @@ LOGGING = {
     'loggers': {
         'django': {
             'handlers': ['file'],
-            'level': 'DEBUG',
+            'level': DJANGO_LOG_LEVEL,
             'propagate': True,
         },
         'django.template': {
@@ -171,6 +253,11 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        'api': {
+            'handlers': ['api'],
+            'level': API_LOG_LEVEL,
+            'propagate': False,
+        },
     }
 }
 
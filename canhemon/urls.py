@@ -22,6 +22,7 @@ from rest_framework_jwt.views import obtain_jwt_token
 from rest_framework_jwt.views import refresh_jwt_token
 from django.views.generic.base import RedirectView
 from django.contrib.auth import views as auth_views
+from api.views import metricsView
 
 """    
     # password reset service // but it needs a smtp server! 
@@ -51,7 +52,8 @@ urlpatterns = [
     url(r'^settings/', admin.site.urls),
     url(r'^api-token-auth/', obtain_jwt_token),
     url(r'^api-token-refresh/', refresh_jwt_token),
-    url(r'^api/', include('api.urls'))
+    url(r'^api/', include('api.urls')),
+    url(r'^metrics/$', metricsView)
 ]
 
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)